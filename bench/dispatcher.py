@@ -0,0 +1,361 @@
+# End-to-end throughput benchmark for `RestDispatcher`.  We mount the
+# dispatcher in a webapp2 WSGI application backed by the local
+# datastore stub and drive it from several client threads with either a
+# weighted synthetic mix or a recorded request log.  Each variant is a
+# set of mora settings, so serializer and cache changes can be compared
+# side by side under identical traffic.  The `encoder-*` variants pin
+# the JSON encoder and `fetch-json` serializes collections straight from
+# the raw entities instead of from models.
+#
+# A recorded log has one JSON object per line:
+#
+#      {"method": "GET", "path": "/graph/{student}/courses"}
+#      {"method": "PATCH", "path": "/graph/{student}", "body": {"year": 3}}
+#
+# The `{student}` and `{course}` placeholders are replaced by the ids of
+# seeded entities because recorded keys do not exist locally.  Paths
+# without placeholders are replayed as they are.
+import json
+import random
+import threading
+import time
+
+import webapp2
+
+from mora import db
+from mora import rest
+from mora.db import codec
+
+from harness import activate_testbed
+
+
+class Student(db.MoraModel):
+    name = db.StringProperty()
+    email = db.EmailProperty()
+    year = db.IntegerProperty()
+    tags = db.StringListProperty()
+    courses = db.ReverseReferenceProperty('Course', 'student')
+
+
+class Course(db.MoraModel):
+    title = db.StringProperty()
+    description = db.TextProperty()
+    student = db.ReferenceProperty(Student)
+    starts = db.DateTimeProperty()
+
+
+class StudentHandler(rest.RestHandler):
+
+    model = Student
+    raw_json = False
+
+    def show(self):
+        self.response.out.write(self.model.to_json())
+
+    def update(self):
+        self.model.from_json(self.body)
+        self.response.out.write(self.model.to_json())
+
+    def patch(self):
+        self.merge_patch()
+        self.response.out.write(self.model.to_json())
+
+    @rest.rest_index("courses")
+    def course_list(self):
+        if self.raw_json:
+            courses = self.model.courses.fetch_json(20)
+        else:
+            courses = [c.as_json() for c in self.model.courses.fetch(20)]
+        self.response.out.write(codec.dumps(courses))
+
+    @rest.rest_create("courses")
+    def course_create(self):
+        course = Course(student=self.model)
+        course.from_json(self.body)
+        self.response.out.write(course.to_json())
+
+
+class CourseHandler(rest.RestHandler):
+
+    model = Course
+
+    def show(self):
+        self.response.out.write(self.model.to_json())
+
+    def destroy(self):
+        self.model.delete()
+        self.response.out.write('{}')
+
+
+### Variants
+
+# A variant applies some settings and returns a function that undoes
+# them.
+def _baseline():
+    return lambda: None
+
+
+def _no_key_cache():
+    size = db.key_cache.size
+    db.key_cache.resize(0)
+    return lambda: db.key_cache.resize(size)
+
+
+def _no_instrumentation():
+    timing = rest.RestDispatcher.timing
+    accounting = rest.RestDispatcher.rpc_accounting
+    rest.RestDispatcher.timing = False
+    rest.RestDispatcher.rpc_accounting = False
+
+    def undo():
+        rest.RestDispatcher.timing = timing
+        rest.RestDispatcher.rpc_accounting = accounting
+    return undo
+
+
+def _no_identity_map():
+    rest.RestDispatcher.identity_map = False
+
+    def undo():
+        rest.RestDispatcher.identity_map = True
+    return undo
+
+
+def _no_single_flight():
+    db.single_flight.enabled = False
+
+    def undo():
+        db.single_flight.enabled = True
+    return undo
+
+
+# Collection reads are limited so that they cannot crowd out `show`.
+def _admission():
+    rest.RestDispatcher.concurrency_limits = {'GET courses': 2}
+
+    def undo():
+        rest.RestDispatcher.concurrency_limits = {}
+        rest.RestDispatcher.admission.reset()
+    return undo
+
+
+# Collections are serialized from the raw entities (see
+# `db.entity_as_json`).
+def _fetch_json():
+    StudentHandler.raw_json = True
+
+    def undo():
+        StudentHandler.raw_json = False
+    return undo
+
+
+# Every JSON backend can be pinned as the encoder, even one that formats
+# differently from the standard library.  Backends that are not
+# installed fail when their variant is applied.
+def _encoder(name):
+    def variant():
+        codec.configure(encoder=name)
+        return codec.configure
+    return variant
+
+
+VARIANTS = {'baseline': _baseline,
+            'no-key-cache': _no_key_cache,
+            'no-instrumentation': _no_instrumentation,
+            'no-identity-map': _no_identity_map,
+            'no-single-flight': _no_single_flight,
+            'admission': _admission,
+            'fetch-json': _fetch_json}
+VARIANTS.update(('encoder-' + name, _encoder(name))
+                for name, _ in codec.BACKENDS)
+
+
+### Traffic
+
+class Fixtures(object):
+
+    def __init__(self, students=50, courses=5, disposable=500):
+        self.students = []
+        self.courses = []
+        self.disposable = []
+        self._lock = threading.Lock()
+        for i in range(students):
+            student = Student(name=u'Student %d' % i,
+                              email=db.Email(u'student%d@example.com' % i),
+                              year=i % 4,
+                              tags=[u'tag%d' % t for t in range(i % 7)])
+            student.put()
+            self.students.append(student.id)
+            for c in range(courses):
+                course = Course(title=u'Course %d' % c,
+                                description=db.Text(u'lorem ipsum ' * 40),
+                                student=student)
+                course.put()
+                self.courses.append(course.id)
+        for i in range(disposable):
+            course = Course(title=u'Disposable %d' % i)
+            course.put()
+            self.disposable.append(course.id)
+
+    def student(self, rng):
+        return rng.choice(self.students)
+
+    def course(self, rng):
+        return rng.choice(self.courses)
+
+    # Deleted courses are gone for good so each is only handed out once.
+    def take_disposable(self):
+        with self._lock:
+            if self.disposable:
+                return self.disposable.pop()
+
+
+# Synthetic requests are (route, method, path, body) tuples.
+def synthetic(fixtures, rng, kind):
+    if kind == 'show':
+        return ('GET __self__', 'GET', '/graph/%s' % fixtures.student(rng), None)
+    if kind == 'index':
+        return ('GET courses', 'GET',
+                '/graph/%s/courses' % fixtures.student(rng), None)
+    if kind == 'update':
+        body = {'name': u'Renamed %d' % rng.randint(0, 1000),
+                'email': u'renamed@example.com', 'year': rng.randint(0, 3),
+                'tags': [u'a', u'b']}
+        return ('PUT __self__', 'PUT', '/graph/%s' % fixtures.student(rng), body)
+    if kind == 'patch':
+        return ('PATCH __self__', 'PATCH', '/graph/%s' % fixtures.student(rng),
+                {'year': rng.randint(0, 3)})
+    if kind == 'create':
+        return ('POST courses', 'POST',
+                '/graph/%s/courses' % fixtures.student(rng),
+                {'title': u'New course', 'description': u'created'})
+    if kind == 'destroy':
+        course = fixtures.take_disposable()
+        if course is None:
+            return synthetic(fixtures, rng, 'show')
+        return ('DELETE __self__', 'DELETE', '/graph/%s' % course, None)
+    raise ValueError('Unknown request kind %r' % kind)
+
+
+def parse_mix(mix):
+    weights = []
+    for item in mix.split(','):
+        kind, weight = item.split('=')
+        weights.append((kind.strip(), int(weight)))
+    return weights
+
+
+def synthetic_traffic(fixtures, mix, count, seed=0):
+    rng = random.Random(seed)
+    weights = parse_mix(mix)
+    total = sum(weight for _, weight in weights)
+    for _ in xrange(count):
+        pick = rng.randint(1, total)
+        for kind, weight in weights:
+            pick -= weight
+            if pick <= 0:
+                break
+        yield synthetic(fixtures, rng, kind)
+
+
+def recorded_traffic(fixtures, path, count, seed=0):
+    rng = random.Random(seed)
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    for i in xrange(count):
+        record = records[i % len(records)]
+        method = record['method'].upper()
+        request_path = record['path']
+        request_path = request_path.replace('{student}', fixtures.student(rng))
+        request_path = request_path.replace('{course}', fixtures.course(rng))
+        parts = request_path.strip('/').split('/')
+        keyword = parts[2] if len(parts) > 2 else '__self__'
+        yield ('%s %s' % (method, keyword), method, request_path,
+               record.get('body'))
+
+
+### Driver
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def drive(app, requests, threads):
+    requests = list(requests)
+    latencies = {}
+    statuses = {}
+    lock = threading.Lock()
+    position = [0]
+
+    def client():
+        while True:
+            with lock:
+                if position[0] >= len(requests):
+                    return
+                route, method, path, body = requests[position[0]]
+                position[0] += 1
+            request = webapp2.Request.blank(path)
+            request.method = method
+            if body is not None:
+                request.body = json.dumps(body)
+                request.content_type = 'application/json'
+            start = time.time()
+            response = request.get_response(app)
+            elapsed = time.time() - start
+            with lock:
+                latencies.setdefault(route, []).append(elapsed)
+                key = '%s %d' % (route, response.status_int)
+                statuses[key] = statuses.get(key, 0) + 1
+
+    workers = [threading.Thread(target=client) for _ in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    wall = time.time() - start
+
+    routes = {}
+    for route, samples in latencies.iteritems():
+        samples.sort()
+        routes[route] = {'requests': len(samples),
+                         'requests_per_sec': len(samples) / wall,
+                         'p50_ms': _percentile(samples, 0.50) * 1000,
+                         'p95_ms': _percentile(samples, 0.95) * 1000,
+                         'p99_ms': _percentile(samples, 0.99) * 1000}
+    return {'requests': len(requests),
+            'seconds': wall,
+            'requests_per_sec': len(requests) / wall if wall else None,
+            'routes': routes,
+            'statuses': statuses}
+
+
+def run(options):
+    results = []
+    for variant in options.variants.split(','):
+        variant = variant.strip()
+        bed = activate_testbed()
+        undo = VARIANTS[variant]()
+        try:
+            rest.RestDispatcher.setup('/graph', [StudentHandler, CourseHandler])
+            rest.RestDispatcher.metrics.reset()
+            app = rest.RestDispatcher.application()
+            fixtures = Fixtures()
+            if options.traffic:
+                traffic = recorded_traffic(fixtures, options.traffic,
+                                           options.requests)
+            else:
+                traffic = synthetic_traffic(fixtures, options.mix,
+                                            options.requests)
+            result = drive(app, traffic, options.threads)
+        finally:
+            undo()
+            bed.deactivate()
+        result.update({'name': 'dispatcher', 'variant': variant,
+                       'threads': options.threads,
+                       'traffic': options.traffic or options.mix})
+        results.append(result)
+    return results
@@ -0,0 +1,88 @@
+# Shared helpers for mora's benchmark suites.  Every suite module has
+# a `run(options)` function that returns a list of result dicts built
+# with `measure`, and `bin/bench.py` collects them into one JSON
+# report.
+import gc
+import time
+import platform
+
+from google.appengine.ext import testbed
+
+
+# Benchmarks run against the local service stubs, never the network.
+def activate_testbed():
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_user_stub()
+    bed.init_blobstore_stub()
+    return bed
+
+
+# Allocation figures come in two flavours.  `retained_objects_per_op`
+# is the net number of gc-tracked objects left alive per call when the
+# results are kept and the collector is disabled, which is the size of
+# the structures an operation builds.  Stock Python 2.7 cannot count
+# short-lived allocations, so `peak_bytes_per_op` is only reported when
+# a `tracemalloc` module is importable.
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def _retained_objects(fn, iterations):
+    keep = []
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        for _ in xrange(iterations):
+            keep.append(fn())
+        after = gc.get_count()[0]
+    finally:
+        gc.enable()
+    return float(after - before) / iterations
+
+
+def _peak_bytes(fn):
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        fn()
+        return tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+
+
+# `measure` runs `fn` in `repeat` rounds of `iterations` calls and
+# reports the best round, which is the least disturbed by the rest of
+# the machine.
+def measure(name, fn, iterations=1000, repeat=3, **extra):
+    fn()
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        for _ in xrange(iterations):
+            fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    result = {'name': name,
+              'iterations': iterations,
+              'seconds': best,
+              'ops_per_sec': iterations / best if best else None,
+              'retained_objects_per_op':
+                  _retained_objects(fn, min(iterations, 200)),
+              'peak_bytes_per_op': _peak_bytes(fn)}
+    result.update(extra)
+    return result
+
+
+def environment():
+    return {'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'tracemalloc': tracemalloc is not None}
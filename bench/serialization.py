@@ -0,0 +1,268 @@
+# Serialization microbenchmarks.  We build synthetic models that use
+# every property type in mora.db and time `as_json`, `to_json` and
+# `from_json` on whole entities, each property's own `as_json` and
+# `from_json`, the JSON libraries the codec can choose from, and
+# `iso8601.parse_date`.  Entities come in a small and a large shape so
+# that list and blob sizes are realistic for both list views and detail
+# views.  Documents with plain and compressed text and blob properties
+# compare stored sizes and write and read latencies.
+import random
+import datetime
+
+from mora import db
+from mora.db import iso8601
+from google.appengine.api import datastore
+from google.appengine.api import users
+
+from harness import activate_testbed, measure
+
+
+class BenchTarget(db.MoraModel):
+    name = db.StringProperty()
+
+
+class BenchEntity(db.MoraModel):
+    # Primitives
+    int_ = db.IntegerProperty()
+    float_ = db.FloatProperty()
+    bool_ = db.BooleanProperty()
+    str_ = db.StringProperty()
+    text = db.TextProperty()
+
+    # Temporal
+    date = db.DateProperty()
+    time = db.TimeProperty()
+    datetime = db.DateTimeProperty()
+
+    # Binary data
+    byte_str = db.ByteStringProperty()
+    blob = db.BlobProperty()
+    blob_ref = db.BlobReferenceProperty()
+
+    # Special Google Data Protocol & GeoRSS GML Properties
+    geopt = db.GeoPtProperty()
+    address = db.PostalAddressProperty()
+    phone = db.PhoneNumberProperty()
+    email = db.EmailProperty()
+    im = db.IMProperty()
+    link = db.LinkProperty()
+    category = db.CategoryProperty()
+    rating = db.RatingProperty()
+
+    # Special User Property
+    user = db.UserProperty()
+
+    # References
+    reference = db.ReferenceProperty(BenchTarget)
+    self_reference = db.SelfReferenceProperty()
+
+    # Lists
+    int_list = db.ListProperty(int)
+    key_list = db.ListProperty(db.Key)
+    datetime_list = db.ListProperty(datetime.datetime)
+    str_list = db.StringListProperty()
+
+    @db.computed_property(db.IntegerProperty())
+    def int_total(self):
+        return sum(self.int_list)
+
+
+# A row of a list view.  Unlike `BenchEntity`, which has a computed and
+# a blob reference property, it can be serialized from the raw entity
+# without building a model.
+class BenchRow(db.MoraModel):
+    name = db.StringProperty()
+    year = db.IntegerProperty()
+    starts = db.DateTimeProperty()
+    email = db.EmailProperty()
+    reference = db.ReferenceProperty(BenchTarget)
+    tags = db.StringListProperty()
+
+
+class BenchDocument(db.MoraModel):
+    text = db.TextProperty()
+    blob = db.BlobProperty()
+
+
+class BenchCompressedDocument(db.MoraModel):
+    text = db.CompressedTextProperty()
+    blob = db.CompressedBlobProperty()
+
+
+# The two entity shapes.  `items` is the length of every list and
+# `payload` the size in bytes of the text and blob values.
+SHAPES = {'small': {'items': 5, 'payload': 256},
+          'large': {'items': 200, 'payload': 64 * 1024}}
+
+
+def _blob_key():
+    # BlobReferenceProperty resolves its BlobInfo from the datastore, so
+    # we write one directly instead of going through an upload.
+    info = datastore.Entity('__BlobInfo__', name='bench-blob')
+    info['content_type'] = 'application/octet-stream'
+    info['creation'] = datetime.datetime(2012, 1, 1)
+    info['filename'] = 'bench.bin'
+    info['size'] = 1024
+    datastore.Put(info)
+    return db.BlobKey('bench-blob')
+
+
+def make_entity(items, payload, blob_key, targets):
+    now = datetime.datetime(2012, 5, 17, 10, 30, 15, 250000)
+    entity = BenchEntity(
+        int_=42,
+        float_=3.14159,
+        bool_=True,
+        str_=u'A synthetic benchmark entity',
+        text=db.Text(u'x' * payload),
+        date=now.date(),
+        time=now.time(),
+        datetime=now,
+        byte_str=db.ByteString('b' * min(payload, 400)),
+        blob=db.Blob('\x00\x01\x02\x03' * (payload / 4)),
+        blob_ref=blob_key,
+        geopt=db.GeoPt(45.256, -71.92),
+        address=db.PostalAddress(u'500 West 45th Street\nNew York, NY 10036'),
+        phone=db.PhoneNumber(u'(425) 555-8080 ext. 72585'),
+        email=db.Email(u'bench@example.com'),
+        im=db.IM('http://schemas.google.com/g/2005#MSN', u'bench@msn.com'),
+        link=db.Link(u'http://www.example.com/bench'),
+        category=db.Category(u'benchmarks'),
+        rating=db.Rating(97),
+        user=users.User(email='bench@example.com', _auth_domain='example.com'),
+        reference=targets[0],
+        int_list=range(items),
+        key_list=[t.key() for t in targets[:items]],
+        datetime_list=[now + datetime.timedelta(minutes=i)
+                       for i in range(items)],
+        str_list=[u'tag%d' % i for i in range(items)])
+    entity.put()
+    entity.self_reference = entity
+    entity.put()
+    return BenchEntity.get(entity.key())
+
+
+# Markup is what compressed properties are meant for, so documents are
+# paragraphs of words drawn from a small vocabulary.
+WORDS = (u'the mora datastore model property query cursor entity key '
+         u'student course graph handler request response json value').split()
+
+
+def make_document(model_class, payload):
+    rng = random.Random(payload)
+    paragraphs = []
+    size = 0
+    while size < payload:
+        paragraph = u'<p class="body">%s</p>\n' % u' '.join(
+            rng.choice(WORDS) for _ in range(12))
+        paragraphs.append(paragraph)
+        size += len(paragraph)
+    text = u''.join(paragraphs)
+    document = model_class(text=db.Text(text),
+                           blob=db.Blob(text.encode('utf-8')))
+    document.put()
+    return document
+
+
+# The first date is the form mora's own `as_json` produces.
+DATES = ['2012-05-17T10:30:15.250000+00:00',
+         '2007-01-25T12:00:00Z',
+         '2007-01-25T12:00:00.123456+02:00',
+         '1983-04-05T19:36:35.716Z']
+
+
+def run(options):
+    bed = activate_testbed()
+    try:
+        return _run(options)
+    finally:
+        bed.deactivate()
+
+
+def _run(options):
+    iterations = options.iterations
+    results = []
+    blob_key = _blob_key()
+    targets = [BenchTarget(name=u'target %d' % i) for i in range(200)]
+    for target in targets:
+        target.put()
+
+    for shape, size in sorted(SHAPES.items()):
+        entity = make_entity(size['items'], size['payload'], blob_key, targets)
+        data = entity.as_json()
+        # `from_json` ignores the computed and user properties, and a
+        # blob goes back in as the string it came out as.
+        scratch = BenchEntity()
+
+        results.append(measure('entity/as_json', entity.as_json,
+                               iterations, shape=shape))
+        results.append(measure('entity/to_json', entity.to_json,
+                               iterations, shape=shape,
+                               bytes=len(entity.to_json())))
+        results.append(measure('entity/from_json',
+                               lambda: scratch.from_json(data, save=False),
+                               iterations, shape=shape))
+
+        for name, prop in sorted(BenchEntity.properties().items()):
+            results.append(measure('property/%s/as_json' % type(prop).__name__,
+                                   lambda: prop.as_json(entity),
+                                   iterations, shape=shape, property=name))
+            value = prop.as_json(entity)
+            results.append(measure('property/%s/from_json' % type(prop).__name__,
+                                   lambda: prop.from_json(scratch, value),
+                                   iterations, shape=shape, property=name))
+
+        # Serializing a fetched entity by building its model, as `fetch`
+        # and `as_json` do, and straight from the raw entity (see
+        # `db.entity_as_json`).  `BenchEntity` takes the model path
+        # either way; `fast_path` tells which classes do not.
+        row = BenchRow(name=u'A list view row', year=2012,
+                       starts=datetime.datetime(2012, 9, 1, 8, 30),
+                       email=db.Email(u'bench@example.com'),
+                       reference=targets[0],
+                       tags=[u'tag%d' % i for i in range(size['items'])])
+        row.put()
+        for model in (entity, row):
+            raw = datastore.Get(model.key())
+            extra = {'shape': shape, 'model': type(model).__name__,
+                     'fast_path': db._raw_json_plan(type(model)) is not None}
+            results.append(measure(
+                'raw/model', lambda: type(model).from_entity(raw).as_json(),
+                iterations, **extra))
+            results.append(measure('raw/entity_as_json',
+                                   lambda: db.entity_as_json(raw),
+                                   iterations, **extra))
+
+        # A fetched document only inflates its compressed values when
+        # they are read, so `get` and `get+read` are reported apart.
+        for model_class in (BenchDocument, BenchCompressedDocument):
+            document = make_document(model_class, size['payload'])
+            key = document.key()
+            stored = len(db.model_to_protobuf(document).Encode())
+            rounds = max(1, iterations / 10)
+            extra = {'shape': shape, 'model': model_class.__name__}
+            results.append(measure('document/put', document.put, rounds,
+                                   entity_bytes=stored, **extra))
+            results.append(measure('document/get', lambda: db.get(key),
+                                   rounds, **extra))
+            results.append(measure('document/get+read',
+                                   lambda: db.get(key).text, rounds, **extra))
+            results.append(measure('document/as_json', document.as_json,
+                                   iterations, **extra))
+
+    # Every JSON library mora's codec could pick, on the large entity.
+    # `same_output` tells whether the codec would use it for encoding.
+    data = entity.as_json()
+    text = db.codec.dumps(data)
+    for backend in db.codec.available():
+        results.append(measure('codec/%s/dumps' % backend.name,
+                               lambda: backend.dumps(data), iterations,
+                               same_output=db.codec.compatible(backend)))
+        results.append(measure('codec/%s/loads' % backend.name,
+                               lambda: backend.loads(text), iterations))
+
+    for date in DATES:
+        results.append(measure('iso8601/parse_date',
+                               lambda: iso8601.parse_date(date),
+                               iterations * 10, input=date))
+    return results
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+import json
+import optparse
+import os
+import sys
+
+USAGE = """%prog [options] SDK_PATH LIB_PATH [SUITE...]
+Run benchmark suites for mora and print a JSON report.
+
+SDK_PATH    Path to the SDK installation
+LIB_PATH    Path to project libraries
+SUITE       Names of modules in bench/ to run (default: serialization)
+
+The dispatcher suite also reads --threads, --requests, --mix, --traffic
+and --variants."""
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_PATH = os.path.join(ROOT_PATH, 'bench')
+
+
+def main(sdk_path, lib_path, suites, options):
+    sys.path.insert(0, sdk_path)
+    sys.path.append(lib_path)
+    sys.path.append(ROOT_PATH)
+    sys.path.append(BENCH_PATH)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    import harness
+
+    report = {'environment': harness.environment(), 'suites': {}}
+    for suite in suites:
+        module = __import__(suite)
+        report['suites'][suite] = module.run(options)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(USAGE)
+    parser.add_option('-n', '--iterations', type='int', default=1000,
+                      help='calls per timed round [default: %default]')
+    parser.add_option('-o', '--output',
+                      help='write the JSON report to this file')
+    parser.add_option('-t', '--threads', type='int', default=4,
+                      help='concurrent clients [default: %default]')
+    parser.add_option('-r', '--requests', type='int', default=2000,
+                      help='requests per variant [default: %default]')
+    parser.add_option('--mix', default='show=50,index=20,update=10,'
+                      'patch=5,create=10,destroy=5',
+                      help='weighted synthetic request mix [default: %default]')
+    parser.add_option('--traffic',
+                      help='replay recorded requests from this NDJSON file')
+    parser.add_option('--variants', default='baseline',
+                      help='comma separated variants to compare '
+                      '[default: %default]')
+    options, args = parser.parse_args()
+    if len(args) < 2:
+        print 'Error: At least 2 arguments required.'
+        parser.print_help()
+        sys.exit(1)
+    SDK_PATH = args[0]
+    LIB_PATH = args[1]
+    SUITES = args[2:] or ['serialization']
+    main(SDK_PATH, LIB_PATH, SUITES, options)
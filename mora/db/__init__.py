@@ -53,30 +53,63 @@
 # and `polymodel` modules.  We have to dig at GAE's guts a bit to
 # shoehorn in better per type JSON support but most of this can be
 # accomplished with simple subclassing.
+import os
+import sys
 import logging
-import base64
 import datetime
+import time
+import zlib
+import hashlib
+import threading
+import collections
+import importlib
 import iso8601
+import codec
 
-from xml.sax import saxutils
 from google.appengine.ext import db
+from google.appengine.ext import blobstore
 from google.appengine.ext.db import polymodel
-from google.appengine.api import datastore
 from google.appengine.api import users
-from google.appengine.ext import blobstore
+from google.appengine.api import datastore
+from google.appengine.api import datastore_types
+from google.appengine.api import namespace_manager
+from google.appengine.api import apiproxy_stub_map
+
+# Cold start latency is user visible on GAE, so modules that only some
+# code paths need are imported on first use.  A `_LazyModule` stands in
+# for the module and imports it when one of its attributes is first
+# looked up.  Several names can be given, in which case the first one
+# that imports is used.
+class _LazyModule(object):
+
+    def __init__(self, *names):
+        self._names = names
+        self._module = None
+
+    def _mora_import(self):
+        if self._module is None:
+            for name in self._names:
+                try:
+                    self._module = importlib.import_module(name)
+                    break
+                except ImportError:
+                    if name == self._names[-1]:
+                        raise
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._mora_import(), attr)
+
+base64 = _LazyModule('base64')
+saxutils = _LazyModule('xml.sax.saxutils')
+memcache = _LazyModule('google.appengine.api.memcache')
 
 # GAE supports a couple of versions of Python and the GAE environment.
-# We will try to use the latest modules and then use `ImportError`
-# exceptions to select older variations.
-try:
-    import json
-except ImportError:
-    from django.utils import simplejson as json
-
-try:
-    import webapp2 as webapp
-except ImportError:
-    from google.appengine.ext import webapp
+# We will try to use the latest modules and then fall back to older
+# variations.  mora itself encodes and decodes through `codec`, which
+# picks the fastest JSON library available; `json` remains for
+# applications that use it from here.
+json = _LazyModule('json', 'django.utils.simplejson')
 
 ### Keys and Errors
 
@@ -125,8 +158,6 @@ ConfigurationError = db.ConfigurationError
 ReservedWordError = db.ReservedWordError
 DerivedPropertyError = db.DerivedPropertyError
 
-Query = db.Query
-get = db.get
 
 
 ### Help Functions
@@ -134,11 +165,28 @@ get = db.get
 # As a consequence of allowing string class specifiers for
 # `ReferenceProperty` and `ReverseReferenceProperty` we must provide a
 # `PolyModel` aware replacement for `db.class_for_kind`.
+#
+# Resolved kinds are remembered in `_kind_cache` since every lookup
+# otherwise scans the whole polymodel class map.  A cached class is only
+# used while it is still the registered class for its kind, so
+# redefining a model (as tests do) picks up the new class.
+_kind_cache = {}
+
+def _registered(cls, kind):
+  if issubclass(cls, polymodel.PolyModel):
+    return polymodel._class_map.get(cls._class_key()) is cls
+  return db._kind_map.get(kind) is cls
+
 def class_for_kind(kind):
+  cls = _kind_cache.get(kind)
+  if cls is not None and _registered(cls, kind):
+    return cls
   for t in polymodel._class_map.keys():
       if kind == t[-1]:
+        _kind_cache[kind] = polymodel._class_map[t]
         return polymodel._class_map[t]
   try:
+    _kind_cache[kind] = db._kind_map[kind]
     return db._kind_map[kind]
   except KeyError:
     raise KindError('No implementation for kind \'%s\'' % kind)
@@ -150,6 +198,954 @@ def create(kind, **kwds):
     _class = class_for_kind(kind)
     return _class(**kwds)
 
+# `merge_patch` implements the [RFC 7386][rfc7386] merge algorithm for
+# plain JSON values.  Members of the patch that are `null` are removed
+# from the target, objects are merged recursively and everything else
+# replaces the target value.  The target is never modified in place.
+def merge_patch(target, patch):
+    if not isinstance(patch, dict):
+        return patch
+    if isinstance(target, dict):
+        result = dict(target)
+    else:
+        result = {}
+    for name, value in patch.iteritems():
+        if value is None:
+            result.pop(name, None)
+        else:
+            result[name] = merge_patch(result.get(name), value)
+    return result
+
+
+### Key Cache
+
+# Every serialized entity carries its own key as `id` and every
+# reference carries the key it points at.  Encoding a key means
+# serializing a protocol buffer and base64 encoding it, and decoding
+# goes the other way, so we keep a bounded, least recently used map
+# between keys and their string form.  All of mora's key conversions
+# go through the shared `key_cache` so its statistics cover them all.
+class KeyCache(object):
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._strings = collections.OrderedDict()
+        self._keys = collections.OrderedDict()
+
+    def _lookup(self, table, item):
+        with self._lock:
+            try:
+                value = table.pop(item)
+            except KeyError:
+                self.misses += 1
+                return None
+            table[item] = value
+            self.hits += 1
+            return value
+
+    def _store(self, table, item, value):
+        with self._lock:
+            table.pop(item, None)
+            table[item] = value
+            while len(table) > self.size:
+                table.popitem(last=False)
+
+    # Returns the urlsafe string for a key.
+    def encode(self, key):
+        value = self._lookup(self._strings, key)
+        if value is None:
+            value = str(key)
+            self._store(self._strings, key, value)
+            self._store(self._keys, value, key)
+        return value
+
+    # Returns the key for a urlsafe string.  Like `Key` this raises
+    # `BadKeyError` when the string is not a key.  Failures are not
+    # cached.
+    def decode(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('ascii', 'replace')
+        key = self._lookup(self._keys, value)
+        if key is None:
+            key = Key(value)
+            self._store(self._keys, value, key)
+            self._store(self._strings, key, value)
+        return key
+
+    def resize(self, size):
+        with self._lock:
+            self.size = size
+            for table in (self._strings, self._keys):
+                while len(table) > size:
+                    table.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._strings.clear()
+            self._keys.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': float(self.hits) / total if total else 0.0,
+                    'size': max(len(self._strings), len(self._keys)),
+                    'max_size': self.size}
+
+key_cache = KeyCache()
+
+def key_to_str(key):
+    return key_cache.encode(key)
+
+def str_to_key(value):
+    return key_cache.decode(value)
+
+
+### Request Timing
+
+# A `RequestTimer` accumulates the time spent in named phases of a
+# request.  The REST dispatcher starts one per request and mora's own
+# code reports into whichever timer is active on the current thread, so
+# serialization time shows up next to key decoding and datastore time.
+# When no timer is active the cost is a single thread-local lookup.
+_request_local = threading.local()
+
+class RequestTimer(object):
+
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+        self.started = time.time()
+        self.total = None
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def finish(self):
+        self.total = time.time() - self.started
+        return self.total
+
+    # Formats the phases as a [Server-Timing][servertiming] header with
+    # durations in milliseconds.
+    # [servertiming]: https://www.w3.org/TR/server-timing/ "Server Timing"
+    def header(self):
+        entries = ['%s;dur=%.2f' % (name, seconds * 1000)
+                   for name, seconds in self.phases.iteritems()]
+        if self.total is not None:
+            entries.append('total;dur=%.2f' % (self.total * 1000))
+        return ', '.join(entries)
+
+def current_timer():
+    return getattr(_request_local, 'timer', None)
+
+def start_timer():
+    timer = _request_local.timer = RequestTimer()
+    return timer
+
+def stop_timer():
+    timer = current_timer()
+    _request_local.timer = None
+    return timer
+
+# `timed` is used as a context manager around a phase:
+#
+#      with timed('serialize'):
+#          ...
+class timed(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.timer = current_timer()
+
+    def __enter__(self):
+        if self.timer is not None:
+            self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.timer is not None:
+            self.timer.add(self.name, time.time() - self.start)
+        return False
+
+
+### RPC Accounting
+
+# The most expensive mistakes are datastore calls made inside loops,
+# for example dereferencing a `ReferenceProperty` or iterating a
+# `ReverseReferenceProperty` for every item of a list.  An `RpcCounter`
+# counts every datastore RPC made on the current thread while it is
+# active, together with the application code that issued it.  We hook
+# into the API proxy rather than into mora's own calls so that RPCs
+# made by App Engine's `db` on our behalf are counted as well.
+#
+# Counting is cheap: only the number of each kind of call is kept.
+# When a kind of call is made more than `threshold` times we look up
+# the code that made it and log a warning, or raise `TooManyRpcsError`
+# when the counter is `strict`.  With `call_sites` on, every RPC is
+# attributed to its call site and the threshold applies to each site
+# on its own, which is more precise but walks the stack on every RPC.
+# Tests can set `RpcCounter.strict = True` to make N+1 patterns fail
+# loudly, and can assert on the counts directly:
+#
+#      with db.RpcCounter() as rpcs:
+#          ...
+#      self.assertEqual(rpcs.get, 1)
+#
+# Counters nest.  An RPC is counted by the active counter and by every
+# counter that was active when it was started.
+class TooManyRpcsError(Error):
+    pass
+
+_MORA_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class RpcCounter(object):
+
+    threshold = 10
+    strict = False
+    call_sites = False
+
+    def __init__(self, threshold=None, strict=None, call_sites=None):
+        if threshold is not None:
+            self.threshold = threshold
+        if strict is not None:
+            self.strict = strict
+        if call_sites is not None:
+            self.call_sites = call_sites
+        self.counts = collections.defaultdict(int)
+        self.sites = collections.defaultdict(int)
+        self.parent = None
+        self._warned = set()
+
+    get = property(lambda self: self.counts['Get'])
+    query = property(lambda self: self.counts['RunQuery'])
+    put = property(lambda self: self.counts['Put'])
+    delete = property(lambda self: self.counts['Delete'])
+    total = property(lambda self: sum(self.counts.itervalues()))
+
+    def start(self):
+        hooks = apiproxy_stub_map.apiproxy.GetPreCallHooks()
+        hooks.Append('mora_rpc_counter', _count_rpc, 'datastore_v3')
+        self.parent = current_rpc_counter()
+        _request_local.rpcs = self
+        return self
+
+    def stop(self):
+        _request_local.rpcs = self.parent
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    # `site` is a function returning the call site, so that it is only
+    # looked up when it is needed.
+    def record(self, call, site):
+        self.counts[call] += 1
+        count = self.counts[call]
+        if self.call_sites:
+            site = site()
+            self.sites[(call, site)] += 1
+            count = self.sites[(call, site)]
+        if count <= self.threshold:
+            return
+        if not self.call_sites:
+            site = site()
+            self.sites[(call, site)] += 1
+        message = ('%s issued %d datastore %s calls, '
+                   'which looks like an N+1 pattern' % (site, count, call))
+        if self.strict:
+            raise TooManyRpcsError(message)
+        if (call, site) not in self._warned:
+            self._warned.add((call, site))
+            logging.warning(message)
+
+    def report(self):
+        return {'counts': dict(self.counts),
+                'sites': [{'call': call, 'site': site, 'count': count}
+                          for (call, site), count in self.sites.iteritems()]}
+
+def current_rpc_counter():
+    return getattr(_request_local, 'rpcs', None)
+
+# The call site is the innermost frame that belongs neither to App
+# Engine nor to mora.  The frames are walked directly, without reading
+# any source, to keep the lookup cheap.
+def _rpc_call_site():
+    frame = sys._getframe(1)
+    while frame is not None:
+        code = frame.f_code
+        path = os.path.abspath(code.co_filename)
+        if not path.startswith(_MORA_PATH) and \
+                'google/appengine' not in path:
+            return '%s:%d (%s)' % (code.co_filename, frame.f_lineno,
+                                   code.co_name)
+        frame = frame.f_back
+    return 'unknown'
+
+def _count_rpc(service, call, request, response):
+    counter = current_rpc_counter()
+    if counter is None:
+        return
+    found = []
+
+    def site():
+        if not found:
+            found.append(_rpc_call_site())
+        return found[0]
+
+    while counter is not None:
+        counter.record(call, site)
+        counter = counter.parent
+
+
+### Identity Map
+
+# Within one request the same entity tends to be loaded several times:
+# by the dispatcher, when a `ReferenceProperty` is dereferenced and
+# again by handler code.  While an `IdentityMap` is active on the
+# current thread, mora's `get` and reference dereferencing return the
+# model that was already loaded for a key and only fetch the keys they
+# have not seen, in one batch.  The REST dispatcher keeps one for each
+# request.
+#
+# Writes keep the map consistent: a model written with mora's `put`, or
+# its own, replaces whatever the map held for its key once the write has
+# succeeded, and a deleted key maps to `None`.
+# Reads and writes inside a transaction bypass the map and writes
+# there drop the key from it, since the transaction may still fail.
+# Models loaded by queries are not added.
+#
+#      with db.IdentityMap():
+#          a = db.get(key)
+#          b = db.get(key)      # no RPC, `b is a`
+_MISSING = object()
+
+_in_transaction = getattr(db, 'is_in_transaction', lambda: False)
+
+class IdentityMap(object):
+
+    def __init__(self):
+        self.models = {}
+        self.parent = None
+        self.hits = 0
+        self.misses = 0
+
+    def start(self):
+        self.parent = current_identity_map()
+        _request_local.identity_map = self
+        return self
+
+    def stop(self):
+        _request_local.identity_map = self.parent
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def get(self, keys):
+        missing = []
+        for key in keys:
+            if self.models.get(key, _MISSING) is _MISSING:
+                missing.append(key)
+        if missing:
+            missing = list(collections.OrderedDict.fromkeys(missing))
+            for key, model in zip(missing, _fetch(missing)):
+                self.models[key] = model
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+        return [self.models[key] for key in keys]
+
+    def written(self, model):
+        if model.has_key():
+            if _in_transaction():
+                self.models.pop(model.key(), None)
+            else:
+                self.models[model.key()] = model
+
+    def deleted(self, key):
+        if _in_transaction():
+            self.models.pop(key, None)
+        else:
+            self.models[key] = None
+
+    def clear(self):
+        self.models.clear()
+
+def current_identity_map():
+    return getattr(_request_local, 'identity_map', None)
+
+def _key_of(value):
+    if isinstance(value, basestring):
+        return str_to_key(value)
+    if isinstance(value, db.Model):
+        return value.key()
+    return value
+
+# `get` is `db.get` that goes through the active identity map and
+# shares its RPC with concurrent identical gets.
+def get(keys, **kwargs):
+    identity_map = current_identity_map()
+    if kwargs or _in_transaction():
+        return db.get(keys, **kwargs)
+    if identity_map is None:
+        if isinstance(keys, (list, tuple)):
+            return _fetch([_key_of(k) for k in keys])
+        return _fetch([_key_of(keys)])[0]
+    if isinstance(keys, (list, tuple)):
+        return identity_map.get([_key_of(k) for k in keys])
+    return identity_map.get([_key_of(keys)])[0]
+
+# `prefetch` resolves the named `ReferenceProperty`s of many models with
+# a single batch get instead of one get per dereference:
+#
+#      courses = student.courses.fetch(20)
+#      db.prefetch(courses, 'teacher', 'room')
+def prefetch(models, *names):
+    pending = []
+    for model in models:
+        for name in names:
+            prop = getattr(type(model), name)
+            key = prop.get_value_for_datastore(model)
+            if key is not None and \
+                    getattr(model, '_RESOLVED' + prop._attr_name(), None) is None:
+                pending.append((model, prop, key))
+    if not pending:
+        return
+    if current_identity_map() is None:
+        with IdentityMap():
+            resolved = get([key for _, _, key in pending])
+    else:
+        resolved = get([key for _, _, key in pending])
+    for (model, prop, key), value in zip(pending, resolved):
+        if value is not None:
+            setattr(model, '_RESOLVED' + prop._attr_name(), value)
+
+
+### Single Flight
+
+# On a multithreaded instance a burst of requests for one popular
+# resource makes many threads fetch the same keys, or run the same
+# query, at the same moment.  `single_flight` lets the first of them
+# make the RPC while the others wait for it and get copies of its
+# result, so models are never shared between threads.  mora's `get`,
+# the identity map and our `Query.fetch` go through it.
+#
+# A thread that waited longer than `timeout` seconds, or whose leader
+# failed, makes the RPC itself.  A completed write of a kind stops new
+# readers from joining reads of that kind that are still in flight, so
+# a thread always sees its own writes.  Reads in a transaction are
+# never shared.
+#
+#      db.single_flight.stats()
+#      {'calls': 1200, 'coalesced': 310, 'timeouts': 0}
+class _Flight(object):
+
+    def __init__(self, kinds):
+        self.kinds = kinds
+        self.done = threading.Event()
+        self.waiting = 0
+        self.shared = None
+        self.failed = False
+
+class SingleFlight(object):
+
+    enabled = True
+    timeout = 5.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.calls = 0
+        self.coalesced = 0
+        self.timeouts = 0
+
+    # `share` turns the leader's result into something every waiting
+    # thread can `copy` its own result from.  It only runs when some
+    # thread is waiting.
+    def run(self, key, kinds, function, share, copy):
+        if not self.enabled or _in_transaction():
+            return function()
+        _watch_writes()
+        with self.lock:
+            self.calls += 1
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight(kinds)
+            else:
+                flight.waiting += 1
+        if leader:
+            return self._lead(key, flight, function, share)
+        return self._follow(flight, function, copy)
+
+    def _lead(self, key, flight, function, share):
+        try:
+            result = function()
+            with self.lock:
+                self._drop(key, flight)
+            if flight.waiting:
+                flight.shared = share(result)
+            return result
+        except:
+            flight.failed = True
+            raise
+        finally:
+            with self.lock:
+                self._drop(key, flight)
+            flight.done.set()
+
+    def _follow(self, flight, function, copy):
+        if not flight.done.wait(self.timeout):
+            with self.lock:
+                self.timeouts += 1
+            return function()
+        if flight.failed:
+            return function()
+        with self.lock:
+            self.coalesced += 1
+        return copy(flight.shared)
+
+    def _drop(self, key, flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    def forget(self, kinds):
+        with self.lock:
+            for key, flight in self.flights.items():
+                if flight.kinds & kinds:
+                    del self.flights[key]
+
+    def stats(self):
+        return {'calls': self.calls,
+                'coalesced': self.coalesced,
+                'timeouts': self.timeouts}
+
+single_flight = SingleFlight()
+
+# Entities are shared as encoded protocol buffers, which are immutable,
+# and every thread decodes its own.
+def _share_entities(entities):
+    return [e.ToPb().Encode() if e is not None else None for e in entities]
+
+def _copy_entities(shared):
+    return [datastore.Entity.FromPb(pb) if pb is not None else None
+            for pb in shared]
+
+def _model_from_entity(entity):
+    return db.class_for_kind(entity.kind()).from_entity(entity)
+
+# Fetches the models for a list of keys like `db.get` does.
+def _fetch(keys):
+    entities = single_flight.run(('get', tuple(keys)),
+                                 frozenset(k.kind() for k in keys),
+                                 lambda: datastore.Get(keys),
+                                 _share_entities, _copy_entities)
+    return [_model_from_entity(e) if e is not None else None
+            for e in entities]
+
+def _share_results(result):
+    results, cursor = result
+    return ([r if isinstance(r, Key) else r._entity.ToPb().Encode()
+             for r in results], cursor)
+
+def _copy_results(result):
+    shared, cursor = result
+    return ([r if isinstance(r, Key) else
+             _model_from_entity(datastore.Entity.FromPb(r))
+             for r in shared], cursor)
+
+
+### Query Cache
+
+# Collection queries, like those behind a `ReverseReferenceProperty` or
+# a `rest_index` action, tend to run again and again between writes.
+# The query cache remembers the keys a `fetch` returned under a
+# signature of the query (its kind, filters, ancestor, sort orders,
+# cursors, limit and offset) and serves later fetches of the same query
+# with a single batch get of those keys, through the identity map when
+# one is active.
+#
+# Every kind has a generation number in each namespace that goes up
+# whenever an entity of that kind is written or deleted there, and the
+# namespace and generation are part of every cache key, so a write
+# makes all cached results for its kind in its namespace unreachable at
+# once.  Generations are bumped from an API proxy hook
+# after the write succeeded, or after the commit for writes made in a
+# transaction, so writes made with App Engine's own `db` count as well.
+#
+# Caching is enabled for all queries of a model class by setting
+# `query_cache = True` in its class body, or for a single query with
+# `cached()`:
+#
+#      student.courses.cached().fetch(20)
+#
+# Generations are only bumped for kinds with a `query_cache` class, or
+# that this instance has run a `cached()` query for, so with the
+# memcache backend a kind should be marked in its class when other
+# instances write it.
+#
+# The default backend keeps generations and results in memcache, which
+# all instances share.  `MemoryQueryBackend` keeps them in the instance
+# and suits tests and single instance deployments:
+#
+#      db.query_cache.backend = db.MemoryQueryBackend()
+#
+# Queries without an ancestor are eventually consistent, so one run
+# shortly after a write may miss it, and caching its result under the
+# new generation would keep serving the stale result.  Such results are
+# not cached until `settle` seconds after the kind's last write.
+# Ancestor queries are strongly consistent and always cached.  Results
+# also expire after `ttl` seconds.  Projection queries and fetches with
+# extra options are never cached.
+class MemoryQueryBackend(object):
+
+    max_entries = 10000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.generations = {}
+        self.bumps = {}
+        self.results = {}
+
+    def generation(self, kind):
+        return self.generations.get(kind, 0)
+
+    def bumped(self, kind):
+        return self.bumps.get(kind, 0)
+
+    def bump(self, kinds):
+        with self.lock:
+            now = time.time()
+            for kind in kinds:
+                self.generations[kind] = self.generations.get(kind, 0) + 1
+                self.bumps[kind] = now
+
+    def get(self, key):
+        entry = self.results.get(key)
+        if entry is not None and entry[0] > time.time():
+            return entry[1]
+
+    # Results of old generations are never read again, so when the
+    # cache is full we drop what expired and, failing that, everything.
+    def set(self, key, value, ttl):
+        with self.lock:
+            if len(self.results) >= self.max_entries:
+                now = time.time()
+                self.results = dict((k, v) for k, v in self.results.iteritems()
+                                    if v[0] > now)
+                if len(self.results) >= self.max_entries:
+                    self.results = {}
+            self.results[key] = (time.time() + ttl, value)
+
+# A generation counter that memcache evicted starts again from the
+# current time in milliseconds, which is beyond any value it had before,
+# so results cached under the old values can not come back.
+class MemcacheQueryBackend(object):
+
+    prefix = 'mora:query:'
+
+    def generation(self, kind):
+        key = self.prefix + 'generation:' + kind
+        value = memcache.get(key)
+        if value is None:
+            memcache.add(key, int(time.time() * 1000))
+            value = memcache.get(key)
+        return value
+
+    # When the kind was last written, or 0 if that is not known.
+    def bumped(self, kind):
+        return memcache.get(self.prefix + 'bumped:' + kind) or 0
+
+    def bump(self, kinds):
+        memcache.offset_multi(dict((kind, 1) for kind in kinds),
+                              key_prefix=self.prefix + 'generation:',
+                              initial_value=int(time.time() * 1000))
+        memcache.set_multi(dict((kind, time.time()) for kind in kinds),
+                           key_prefix=self.prefix + 'bumped:')
+
+    def get(self, key):
+        return memcache.get(self.prefix + key)
+
+    def set(self, key, value, ttl):
+        memcache.set(self.prefix + key, value, time=ttl)
+
+class QueryCache(object):
+
+    ttl = 300
+    settle = 1.0
+
+    def __init__(self, backend=None):
+        self.backend = backend or MemcacheQueryBackend()
+        self.hits = 0
+        self.misses = 0
+
+    # Generations are kept per namespace and kind, so `bump` takes
+    # `(namespace, kind)` pairs.
+    def bump(self, kinds):
+        if kinds:
+            self.backend.bump(['%s:%s' % kind for kind in kinds])
+
+    def fetch(self, query, limit, offset):
+        _watch_writes()
+        kind = '%s:%s' % (query._mora_namespace(), query._model_class.kind())
+        key = '%s:%s:%s' % (kind, self.backend.generation(kind),
+                            query._mora_signature(limit, offset))
+        entry = self.backend.get(key)
+        if entry is not None:
+            self.hits += 1
+            keys, query._mora_cursor = entry
+            keys = [str_to_key(k) for k in keys]
+            if query._keys_only:
+                return keys
+            return [m for m in get(keys) if m is not None]
+
+        self.misses += 1
+        results = query._mora_fetch(limit, offset)
+        if not self._settled(query, kind):
+            return results
+        cursor = query._mora_cursor
+        if query._keys_only:
+            keys = [key_to_str(k) for k in results]
+        else:
+            keys = [key_to_str(m.key()) for m in results]
+        self.backend.set(key, (keys, cursor), self.ttl)
+        return results
+
+    def _settled(self, query, kind):
+        if any(call[0] == 'ancestor' for call in query._mora_calls):
+            return True
+        return time.time() - self.backend.bumped(kind) >= self.settle
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': float(self.hits) / total if total else 0.0}
+
+query_cache = QueryCache()
+
+# Kinds whose writes bump generations.
+_cached_kinds = set()
+_cached_classes_seen = [0]
+
+def _kind_is_cached(kind):
+    classes = db._kind_map.values() + polymodel._class_map.values()
+    if len(classes) != _cached_classes_seen[0]:
+        for model_class in classes:
+            if getattr(model_class, 'query_cache', False):
+                _cached_kinds.add(model_class.kind())
+        _cached_classes_seen[0] = len(classes)
+    return kind in _cached_kinds
+
+# The `(namespace, kind)` pairs of written keys.
+def _written_kinds(keys):
+    return frozenset((key.name_space(), key.path().element_list()[-1].type())
+                     for key in keys)
+
+def _written(kinds):
+    single_flight.forget(frozenset(kind for _, kind in kinds))
+    query_cache.bump([(namespace, kind) for namespace, kind in kinds
+                      if _kind_is_cached(kind)])
+
+# Writes made in a transaction only count once it commits.
+def _after_write(service, call, request, response):
+    if call in ('Commit', 'Rollback'):
+        pending = getattr(_request_local, 'transaction_kinds', {})
+        kinds = pending.pop(request.handle(), None)
+        if kinds and call == 'Commit':
+            _written(frozenset(kinds))
+        return
+    if call == 'Put':
+        kinds = _written_kinds(e.key() for e in request.entity_list())
+    elif call == 'Delete':
+        kinds = _written_kinds(request.key_list())
+    else:
+        return
+    if request.has_transaction():
+        if not hasattr(_request_local, 'transaction_kinds'):
+            _request_local.transaction_kinds = {}
+        _request_local.transaction_kinds.setdefault(
+            request.transaction().handle(), set()).update(kinds)
+    else:
+        _written(kinds)
+
+# The hook has to be installed on every API proxy that is used, and
+# tests replace the proxy, so we check before every write and shared
+# or cached read.
+_watched_proxy = [None]
+
+def _watch_writes():
+    proxy = apiproxy_stub_map.apiproxy
+    if _watched_proxy[0] is not proxy:
+        proxy.GetPostCallHooks().Append('mora_writes', _after_write,
+                                        'datastore_v3')
+        _watched_proxy[0] = proxy
+
+def _signature_value(value):
+    if isinstance(value, db.Model):
+        value = value.key()
+    if isinstance(value, Key):
+        return key_to_str(value)
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, (list, tuple)):
+        return tuple(_signature_value(v) for v in value)
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    return value
+
+# Our `Query` records how it was built so that it can be cached.
+# `MoraModel.all`, `MoraPolyModel.all` and `ReverseReferenceProperty`
+# return one.
+class Query(db.Query):
+
+    def __init__(self, model_class=None, *args, **kwargs):
+        self._mora_calls = [('init', args, tuple(sorted(kwargs.items())))]
+        self._mora_cache = None
+        self._mora_cursor = None
+        super(Query, self).__init__(model_class, *args, **kwargs)
+
+    def filter(self, property_operator, value):
+        self._mora_calls.append(('filter', property_operator,
+                                 _signature_value(value)))
+        return super(Query, self).filter(property_operator, value)
+
+    def ancestor(self, ancestor):
+        self._mora_calls.append(('ancestor', _signature_value(ancestor)))
+        return super(Query, self).ancestor(ancestor)
+
+    def order(self, property):
+        self._mora_calls.append(('order', property))
+        return super(Query, self).order(property)
+
+    def with_cursor(self, start_cursor=None, end_cursor=None):
+        self._mora_calls.append(('cursor', start_cursor, end_cursor))
+        self._mora_cursor = None
+        return super(Query, self).with_cursor(start_cursor, end_cursor)
+
+    # Filters are sorted since their order does not change the result;
+    # sort orders and cursors keep theirs.  The app and namespace the
+    # query runs in are part of the signature, so that queries of
+    # tenants in different namespaces never share results.
+    def _mora_signature(self, limit, offset):
+        filters = sorted(c for c in self._mora_calls
+                         if c[0] in ('filter', 'ancestor'))
+        others = [c for c in self._mora_calls
+                  if c[0] not in ('filter', 'ancestor')]
+        signature = repr((self._mora_namespace(), getattr(self, '_app', None),
+                          filters, others, limit, offset))
+        return hashlib.md5(signature).hexdigest()
+
+    # The namespace of the request, unless the query names one.
+    def _mora_namespace(self):
+        namespace = getattr(self, '_namespace', None)
+        if namespace is None:
+            namespace = namespace_manager.get_namespace()
+        return namespace or ''
+
+    def cached(self, enabled=True):
+        self._mora_cache = enabled
+        if enabled:
+            _cached_kinds.add(self._model_class.kind())
+        return self
+
+    def _mora_cached(self):
+        if self._mora_cache is not None:
+            return self._mora_cache
+        return getattr(self._model_class, 'query_cache', False)
+
+    def fetch(self, limit, offset=0, **kwargs):
+        if kwargs or getattr(self, '_projection', None):
+            self._mora_cursor = None
+            return super(Query, self).fetch(limit, offset, **kwargs)
+        if self._mora_cached() and not _in_transaction():
+            return query_cache.fetch(self, limit, offset)
+        return self._mora_fetch(limit, offset)
+
+    # Runs the query through `single_flight` and keeps its end cursor.
+    def _mora_fetch(self, limit, offset):
+        kind = self._model_class.kind()
+        results, self._mora_cursor = single_flight.run(
+            ('query', kind, self._mora_signature(limit, offset)),
+            frozenset([kind]), lambda: self._mora_run(limit, offset),
+            _share_results, _copy_results)
+        return results
+
+    def _mora_run(self, limit, offset):
+        self._mora_cursor = None
+        results = super(Query, self).fetch(limit, offset)
+        try:
+            cursor = super(Query, self).cursor()
+        except (AssertionError, Error):
+            cursor = None
+        return results, cursor
+
+    # `fetch_entities` returns the raw `datastore.Entity` results and
+    # `fetch_json` their `as_json` representations, built without
+    # creating models (see `entity_as_json`).  Both bypass the query
+    # cache and `single_flight`.
+    def fetch_entities(self, limit, offset=0):
+        self._mora_cursor = None
+        raw_query = self._get_query()
+        entities = list(raw_query.Run(limit=limit, offset=offset))
+        self._last_raw_query = raw_query
+        return entities
+
+    def fetch_json(self, limit, offset=0, include=None, exclude=None):
+        entities = self.fetch_entities(limit, offset)
+        if self._keys_only:
+            return [key_to_str(k) for k in entities]
+        return [entity_as_json(e, include, exclude) for e in entities]
+
+    # `fetch_fields` is `fetch_json` with `include=fields`, for list
+    # views that need only a few properties.  When all of them can be
+    # read from an index it can run a projection query instead, so that
+    # only those values are read and converted (see `projection_for`).
+    # Queries the datastore refuses to project, for instance for lack of
+    # a composite index, are run again as a full fetch.
+    #
+    # Entities that were written before a property existed are not in
+    # its index, and a projection query leaves them out.  Only a model
+    # class with `projection_queries = True` in its body, which promises
+    # that every entity has every property, is projected.  Others are
+    # always fetched whole.
+    def fetch_fields(self, fields, limit, offset=0):
+        projection = None
+        if not self._keys_only and \
+                getattr(self._model_class, 'projection_queries', False):
+            projection = projection_for(self._model_class, fields)
+        if projection:
+            self._projection = projection
+            try:
+                entities = self.fetch_entities(limit, offset)
+            except (BadQueryError, BadRequestError, NeedIndexError):
+                entities = None
+            finally:
+                self._projection = None
+            if entities is not None:
+                return [projected_as_json(self._model_class, e, fields)
+                        for e in entities]
+        return self.fetch_json(limit, offset, include=fields)
+
+    # After a fetch served from the cache, or shared with another
+    # thread, the cursor is the one that came with the result.
+    def cursor(self):
+        if self._mora_cursor is not None:
+            return self._mora_cursor
+        return super(Query, self).cursor()
+
 
 ### Properties
 
@@ -262,6 +1258,20 @@ class DateTimeProperty(db.DateTimeProperty):
       value = iso8601.parse_date(value)
     setattr(model_instance, attr_name, value)
 
+# An `UpdatedProperty` is a `DateTimeProperty` that is set on every
+# write.  Declaring one opts a model into delta sync, see
+# `changes_since`.
+class UpdatedProperty(DateTimeProperty):
+
+  def __init__(self, verbose_name=None, **kwargs):
+    kwargs['auto_now'] = True
+    super(UpdatedProperty, self).__init__(verbose_name, **kwargs)
+
+  def __property_config__(self, model_class, property_name):
+    super(UpdatedProperty, self).__property_config__(model_class,
+                                                     property_name)
+    model_class._mora_updated = self
+
 class DateProperty(db.DateProperty):
 
   def as_json(self, model_instance, value=None):
@@ -299,36 +1309,69 @@ class TimeProperty(db.TimeProperty):
 
 ### Binary data
 
-class ByteStringProperty(db.ByteStringProperty):
+# Binary values are base64 encoded in JSON.  A property created with
+# `as_url=True` is represented by the URL that `RestDispatcher` serves
+# its raw bytes from instead, with `content_type` as their type and
+# support for `Range` requests:
+#
+#      photo = db.BlobProperty(as_url=True, content_type='image/jpeg')
+#
+#      {"photo": "/graph/ag9kZXZ.../_blob/photo", ...}
+#
+# The URL is made from the property's `url_template`, which the
+# dispatcher serving the model gives its path when the model's handler
+# is connected.  A model that was not saved yet has no URL and is
+# base64 encoded.  Sending the URL back in `from_json` leaves the value
+# alone.
+class _BinaryJSON(object):
+
+  url_template = '/%(id)s/_blob/%(name)s'
 
-  def as_json(self, model_instance, value=None):
-    if value is None:
-      value = self.get_value_for_datastore(model_instance)
+  def __init__(self, *args, **kwargs):
+    self.as_url = kwargs.pop('as_url', False)
+    self.content_type = kwargs.pop('content_type', 'application/octet-stream')
+    super(_BinaryJSON, self).__init__(*args, **kwargs)
 
+  def url(self, model_instance):
+    return self._url(model_instance.key())
+
+  def _url(self, key):
+    return self.url_template % {'id': key_to_str(key), 'name': self.name}
+
+  def _raw_json(self, value, key):
     if value is None: return None
 
+    if self.as_url:
+      return self._url(key)
+
     encoded = base64.urlsafe_b64encode(value)
     return saxutils.escape(encoded)
 
-  def from_json(self, model_instance, value, attr_name=None):
-    if attr_name is None: attr_name = self.name
-    setattr(model_instance, attr_name, value)
-
-class BlobProperty(db.BlobProperty):
-
   def as_json(self, model_instance, value=None):
     if value is None:
       value = self.get_value_for_datastore(model_instance)
 
     if value is None: return None
 
+    if self.as_url and model_instance.has_key():
+      return self.url(model_instance)
+
     encoded = base64.urlsafe_b64encode(value)
     return saxutils.escape(encoded)
 
   def from_json(self, model_instance, value, attr_name=None):
     if attr_name is None: attr_name = self.name
+    if self.as_url and model_instance.has_key() and \
+          value == self.url(model_instance):
+      return
     setattr(model_instance, attr_name, value)
 
+class ByteStringProperty(_BinaryJSON, db.ByteStringProperty):
+  pass
+
+class BlobProperty(_BinaryJSON, db.BlobProperty):
+  pass
+
 class BlobReferenceProperty(blobstore.BlobReferenceProperty):
 
   def as_json(self, model_instance, value=None):
@@ -358,6 +1401,218 @@ class BlobReferenceProperty(blobstore.BlobReferenceProperty):
       setattr(model_instance, attr_name, value)
 
 
+### Compressed Properties
+
+# `CompressedTextProperty` and `CompressedBlobProperty` store their
+# values zlib compressed, which makes large HTML bodies or serialized
+# documents a fraction of the entity, RPC and memcache size.  In Python
+# and in JSON they are a `TextProperty` and a `BlobProperty`.
+#
+#      body = db.CompressedTextProperty()
+#
+# Values are only inflated when they are first read, so a model that
+# is loaded and written back without reading them never decompresses
+# or compresses them again.  Values shorter than `threshold` bytes, or
+# that do not get smaller, are stored as they are.  Either way the
+# stored bytes start with a marker, and values without one, written
+# before a `TextProperty` or `BlobProperty` became compressed, load as
+# they are.
+#
+# No marker can be told apart from every possible legacy value: an
+# old value that happens to start with `mz\x00` or `mz\x01` is taken
+# for a compressed one.  Text rarely holds a NUL character, but before
+# making a `BlobProperty` of arbitrary bytes compressed, check that
+# none of its values starts with a marker.
+_DEFLATED = 'mz\x01'
+_STORED = 'mz\x00'
+
+def _deflate(data, threshold, level):
+  if len(data) >= threshold:
+    compressed = zlib.compress(data, level)
+    if len(compressed) < len(data):
+      return Blob(_DEFLATED + compressed)
+  return Blob(_STORED + data)
+
+def _inflate(data):
+  if data.startswith(_DEFLATED):
+    return zlib.decompress(data[len(_DEFLATED):])
+  return data[len(_STORED):]
+
+def _is_deflated(value):
+  return isinstance(value, str) and \
+      (value.startswith(_DEFLATED) or value.startswith(_STORED))
+
+class _Deflated(object):
+
+  __slots__ = ('data',)
+
+  def __init__(self, data):
+    self.data = data
+
+class _CompressedProperty(object):
+
+  threshold = 256
+  level = 6
+
+  def __init__(self, *args, **kwargs):
+    self.threshold = kwargs.pop('threshold', self.threshold)
+    self.level = kwargs.pop('level', self.level)
+    super(_CompressedProperty, self).__init__(*args, **kwargs)
+
+  def __get__(self, model_instance, model_class):
+    if model_instance is None:
+      return self
+    value = getattr(model_instance, self._attr_name(), None)
+    if isinstance(value, _Deflated):
+      # Inflating is not a change, so we bypass `__setattr__`, which
+      # would invalidate a materialized JSON copy.
+      value = self._decode(_inflate(value.data))
+      model_instance.__dict__[self._attr_name()] = value
+    return value
+
+  def validate(self, value):
+    if isinstance(value, _Deflated):
+      return value
+    return super(_CompressedProperty, self).validate(value)
+
+  def get_value_for_datastore(self, model_instance):
+    value = getattr(model_instance, self._attr_name(), None)
+    if isinstance(value, _Deflated):
+      return Blob(value.data)
+    if value is None:
+      return None
+    return _deflate(self._encode(value), self.threshold, self.level)
+
+  def make_value_from_datastore(self, value):
+    if _is_deflated(value):
+      return _Deflated(value)
+    return super(_CompressedProperty, self).make_value_from_datastore(value)
+
+  def as_json(self, model_instance, value=None):
+    if value is None:
+      value = self.__get__(model_instance, type(model_instance))
+
+    if value is None: return None
+
+    return super(_CompressedProperty, self).as_json(model_instance, value)
+
+  def _raw_json(self, value, key):
+    if _is_deflated(value):
+      value = self._decode(_inflate(value))
+    convert = getattr(super(_CompressedProperty, self), '_raw_json', None)
+    if convert is not None:
+      return convert(value, key)
+
+    if value is None: return None
+
+    return super(_CompressedProperty, self).as_json(None, value)
+
+class CompressedTextProperty(_CompressedProperty, TextProperty):
+
+  def _encode(self, value):
+    return value.encode('utf-8')
+
+  def _decode(self, data):
+    return Text(data.decode('utf-8'))
+
+class CompressedBlobProperty(_CompressedProperty, BlobProperty):
+
+  def _encode(self, value):
+    return value
+
+  def _decode(self, data):
+    return Blob(data)
+
+
+### JSON Values
+
+# A `JsonProperty` holds any value that can be encoded as JSON, like
+# nested dictionaries and lists, and stores it as compact JSON text, or
+# compressed like a `CompressedTextProperty` with `compressed=True`.
+#
+#      settings = db.JsonProperty()
+#      history = db.JsonProperty(compressed=True)
+#
+# The stored text is only decoded when the attribute is first read.
+# Until then `as_json` returns it as a `codec.RawJSON`, which `to_json`
+# and the REST handlers put into their output as it is, so a model
+# that is loaded and serialized never decodes it.  Models with a
+# `JsonProperty` therefore have to be encoded with `codec.dumps`
+# rather than a JSON library.
+#
+# A value that was read may have been changed in place, so from then
+# on it is encoded again when it is written or serialized.
+class _StoredJson(object):
+
+  __slots__ = ('value',)
+
+  def __init__(self, value):
+    self.value = value
+
+  def text(self):
+    if _is_deflated(self.value):
+      return _inflate(self.value)
+    return self.value
+
+class JsonProperty(db.Property):
+
+  threshold = 256
+  level = 6
+
+  def __init__(self, verbose_name=None, compressed=False, **kwargs):
+    kwargs.setdefault('indexed', False)
+    self.compressed = compressed
+    super(JsonProperty, self).__init__(verbose_name, **kwargs)
+
+  def __get__(self, model_instance, model_class):
+    if model_instance is None:
+      return self
+    value = getattr(model_instance, self._attr_name(), None)
+    if isinstance(value, _StoredJson):
+      value = codec.loads(value.text())
+      model_instance.__dict__[self._attr_name()] = value
+    return value
+
+  def validate(self, value):
+    if isinstance(value, _StoredJson):
+      return value
+    return super(JsonProperty, self).validate(value)
+
+  def get_value_for_datastore(self, model_instance):
+    value = getattr(model_instance, self._attr_name(), None)
+    if isinstance(value, _StoredJson):
+      return value.value
+    if value is None:
+      return None
+    text = codec.compact(value)
+    if isinstance(text, unicode):
+      text = text.encode('utf-8')
+    if self.compressed:
+      return _deflate(text, self.threshold, self.level)
+    return Text(text, 'utf-8')
+
+  def make_value_from_datastore(self, value):
+    if value is None:
+      return None
+    return _StoredJson(value)
+
+  def as_json(self, model_instance, value=None):
+    if value is None:
+      value = getattr(model_instance, self._attr_name(), None)
+      if isinstance(value, _StoredJson):
+        return codec.RawJSON(value.text())
+    return value
+
+  def _raw_json(self, value, key):
+    if value is None: return None
+
+    return codec.RawJSON(_StoredJson(value).text())
+
+  def from_json(self, model_instance, value, attr_name=None):
+    if attr_name is None: attr_name = self.name
+    setattr(model_instance, attr_name, value)
+
+
 ### Special Google Data Protocol Properties
 
 # GeoPtProperty
@@ -608,12 +1863,32 @@ class ReferenceProperty(db.ReferenceProperty):
     if self.reference_class is db._SELF_REFERENCE:
       self.reference_class = model_class
 
+  # Dereferencing works as in App Engine except that the referenced
+  # model is loaded with mora's `get`, which consults the identity map.
+  def __get__(self, model_instance, model_class):
+    if model_instance is None:
+      return self
+    reference_id = getattr(model_instance, self._attr_name(), None)
+    if reference_id is None:
+      return None
+    resolved_name = '_RESOLVED' + self._attr_name()
+    resolved = getattr(model_instance, resolved_name, None)
+    if resolved is not None:
+      return resolved
+    instance = get(reference_id)
+    if instance is None:
+      raise ReferencePropertyResolveError(
+          'ReferenceProperty failed to be resolved: %s' %
+          reference_id.to_path())
+    setattr(model_instance, resolved_name, instance)
+    return instance
+
   def validate(self, value):
     if isinstance(value, datastore.Key):
       return value
 
     if isinstance(value, str):
-      return datastore.Key(value)
+      return str_to_key(value)
 
     if value is not None and not value.has_key():
       raise BadValueError(
@@ -646,7 +1921,7 @@ class ReferenceProperty(db.ReferenceProperty):
 
     if value is None: return None
 
-    return unicode(value)
+    return key_to_str(value)
 
   def from_json(self, model_instance, value, attr_name=None):
     if attr_name is None: attr_name = self.name
@@ -655,9 +1930,9 @@ class ReferenceProperty(db.ReferenceProperty):
     elif type(value) is dict and 'id' in value:
       #If there is an id in this struct then we know what you meant.
       # TODO: use isinstance
-      setattr(model_instance, attr_name, Key(value['id']))
+      setattr(model_instance, attr_name, str_to_key(value['id']))
     else:
-      setattr(model_instance, attr_name, Key(value))
+      setattr(model_instance, attr_name, str_to_key(value))
 
 
 ### ReverseReferenceProperty
@@ -756,13 +2031,40 @@ def SelfReferenceProperty(verbose_name=None, **attrs):
 # property.  And second, we have added an `as_json` method that uses
 # this type to produce an appropriate representation for the JSON
 # encoder.
+#
+# Computed properties can also be memoized per instance with
+# `cache=True`.  The value is kept on the instance until one of the
+# attributes named in `depends` is set, at which point it is computed
+# again on the next access.  Reads made while the entity is being
+# written use a cached value when there is one but never fill the
+# cache, since the key of a new entity is only complete once the write
+# has finished.
 class ComputedProperty(db.Property):
 
-  def __init__(self, value_function, kind, name, indexed=True):
+  def __init__(self, value_function, kind, name, indexed=True,
+               cache=False, depends=()):
       super(ComputedProperty, self).__init__(indexed=indexed)
       self.__value_function = value_function
       self._kind = kind
       self._name = name
+      self._cache = cache
+      self._depends = tuple(depends)
+
+  def __property_config__(self, model_class, property_name):
+      super(ComputedProperty, self).__property_config__(model_class,
+                                                        property_name)
+      if not self._cache:
+          return
+      # Each model class keeps a map from attribute names to the cached
+      # computed properties that depend on them.  Subclasses start with
+      # a copy of their parent's map.
+      if '_mora_dependents' not in model_class.__dict__:
+          inherited = getattr(model_class, '_mora_dependents', {})
+          model_class._mora_dependents = dict(
+              (k, list(v)) for k, v in inherited.iteritems())
+      for dependency in self._depends:
+          model_class._mora_dependents.setdefault(dependency, []).append(
+              property_name)
 
   def __set__(self, *args):
       raise db.DerivedPropertyError(
@@ -771,6 +2073,22 @@ class ComputedProperty(db.Property):
   def __get__(self, model_instance, model_class):
       if model_instance is None:
           return self
+      if not self._cache:
+          return self.__value_function(model_instance)
+      cache = model_instance.__dict__.get('_mora_computed')
+      if cache is None:
+          cache = model_instance.__dict__['_mora_computed'] = {}
+      try:
+          return cache[self.name]
+      except KeyError:
+          value = cache[self.name] = self.__value_function(model_instance)
+          return value
+
+  def get_value_for_datastore(self, model_instance):
+      if self._cache:
+          cache = model_instance.__dict__.get('_mora_computed')
+          if cache and self.name in cache:
+              return cache[self.name]
       return self.__value_function(model_instance)
 
   def as_json(self, model_instance):
@@ -785,18 +2103,129 @@ class ComputedProperty(db.Property):
 # Bruce Eckel has put together a nice [decorator tutorial][eckel] that
 # demonstrates advanced decorator usage.
 # [eckel]: http://www.artima.com/weblogs/viewpost.jsp?thread=240845 "Python Decorators II: Decorator Arguments"
+#
+# To memoize an expensive aggregate we might write:
+#
+#      @computed_property(IntegerProperty(), cache=True, depends=['scores'])
+#      def total(self):
+#          return sum(self.scores)
 class computed_property(object):
 
-  def __init__(self, kind, indexed=True):
+  def __init__(self, kind, indexed=True, cache=False, depends=()):
     self.kind = kind
     self.indexed = indexed
+    self.cache = cache
+    self.depends = depends
 
   def __call__(self, f, *args):
     return ComputedProperty(f,
                             *args,
                             kind=self.kind,
                             name=f.func_name,
-                            indexed=self.indexed)
+                            indexed=self.indexed,
+                            cache=self.cache,
+                            depends=self.depends)
+
+
+### Materialized JSON
+
+# For kinds that are read far more often than they are written we can
+# serialize once per write instead of once per read.  Declaring a
+# `MaterializedJsonProperty` on a model makes every write store the
+# model's `as_json` output, already encoded, in an unindexed `Text`
+# property, and `to_json` then returns the stored copy:
+#
+#      class Article(MoraModel):
+#          title = StringProperty()
+#          body = TextProperty()
+#          _json = MaterializedJsonProperty(version=1)
+#
+# The copy is computed in `get_value_for_datastore`, so it is written by
+# `put` on the model, by `mora.db.put` and by everything in mora that
+# writes through them.  The key of a new entity is only complete after
+# the write, so the copy holds a placeholder string for `id` that
+# `to_json` replaces with the encoded id.  Both are encoded with the
+# same encoder as the rest of the copy, so this works with any JSON
+# library.  A copy whose placeholder cannot be found exactly once is
+# not used.
+#
+# A stored copy is only used while it can be trusted.  It carries a
+# fingerprint made of `version` and the names and types of the model's
+# serialized properties, so adding or changing a property invalidates
+# old copies on its own; bump `version` when `as_json` changes in a
+# way the properties do not show.  Setting any property on the model
+# also stops the copy from being used until the next write.  Changes
+# made in place, like appending to a list property, cannot be seen, so
+# call `invalidate_json` after them.
+#
+# The copy counts against the entity size limit.
+_ID_PLACEHOLDER = u'\x00mora:id'
+
+class MaterializedJsonProperty(TextProperty):
+
+  def __init__(self, version=1, **kwargs):
+      super(MaterializedJsonProperty, self).__init__(**kwargs)
+      self.version = version
+
+  def __property_config__(self, model_class, property_name):
+      super(MaterializedJsonProperty, self).__property_config__(
+          model_class, property_name)
+      model_class._mora_materialized = self
+
+  # The fingerprint is computed once per model class, since polymodel
+  # subclasses share the property but not the set of properties.  We
+  # also note whether the class serializes an `id`.
+  def shape(self, model_class):
+      shape = model_class.__dict__.get('_mora_json_shape')
+      if shape is None:
+          names = [(p, type(p_kind).__name__)
+                   for p, p_kind in model_class._json_properties()]
+          fingerprint = zlib.crc32(','.join('%s=%s' % n for n in names))
+          shape = ('%s.%08x' % (self.version, fingerprint & 0xffffffff),
+                   'id' in dict(names))
+          model_class._mora_json_shape = shape
+      return shape
+
+  def get_value_for_datastore(self, model_instance):
+      fingerprint, has_id = self.shape(type(model_instance))
+      exclude = [self.name, 'id'] if has_id else [self.name]
+      try:
+          data = model_instance.as_json(exclude=exclude)
+      except NotSavedError:
+          value = None
+      else:
+          data.pop('id', None)
+          if has_id:
+              data['id'] = _ID_PLACEHOLDER
+          value = Text('%s:%s' % (fingerprint, codec.dumps(data)))
+      model_instance.__dict__[self._attr_name()] = value
+      model_instance.__dict__['_mora_json_fresh'] = value is not None
+      return value
+
+  # The stored copy with the id filled in, or None when there is no copy
+  # that can be used.
+  def stored_json(self, model_instance):
+      if not model_instance.__dict__.get('_mora_json_fresh'):
+          return None
+      value = model_instance.__dict__.get(self._attr_name())
+      if not value:
+          return None
+      fingerprint, has_id = self.shape(type(model_instance))
+      stored, _, text = value.partition(':')
+      if stored != fingerprint:
+          return None
+      if has_id:
+          placeholder = codec.dumps(_ID_PLACEHOLDER)
+          if text.count(placeholder) != 1:
+              return None
+          text = text.replace(placeholder, codec.dumps(model_instance.id))
+      return text.encode('utf-8')
+
+  def as_json(self, model_instance, value=None):
+      return None
+
+  def from_json(self, model_instance, value, attr_name=None):
+      pass
 
 
 ### Lists
@@ -864,46 +2293,45 @@ def property_class_for_item_type(item_type):
     return property_type
 
 
+# `from_json` on the item property needs somewhere to put the value.
+class _ItemHolder(object):
+    value = None
+
 class ListProperty(db.ListProperty):
 
-  def as_json(self, model_instance, value=None):
-      result = []
+  # The property used to convert individual items is built once per
+  # list property rather than on every conversion.
+  def _item_property(self):
+      property_type = self.__dict__.get('_mora_item_property')
+      if property_type is None:
+          if self.item_type in (int, long):
+              item_type = (int, long)
+          else:
+              item_type = self.item_type
 
+          property_type = property_class_for_item_type(item_type)
+          property_type = self._mora_item_property = property_type()
+      return property_type
+
+  def as_json(self, model_instance, value=None):
       if value is None:
           value = self.get_value_for_datastore(model_instance)
 
       if value is None: return []
 
-      if self.item_type in (int, long):
-          item_type = (int, long)
-      else:
-          item_type = self.item_type
-
-      property_type = property_class_for_item_type(item_type)
-      property_type = property_type()
-
-      for i in value:
-          result.append(property_type.as_json(False, i))
+      property_type = self._item_property()
 
-      return result
+      return [property_type.as_json(False, i) for i in value]
 
   def from_json(self, model_instance, value, attr_name=None):
       if attr_name is None: attr_name = self.name
 
       data = []
 
-      if self.item_type in (int, long):
-          item_type = (int, long)
-      else:
-          item_type = self.item_type
-
-      property_type = property_class_for_item_type(item_type)
-      property_type = property_type()
+      property_type = self._item_property()
 
+      obj = _ItemHolder()
       for i in value:
-          class Tmp():
-              value = None
-          obj = Tmp()
           property_type.from_json(obj, i, 'value')
           data.append(obj.value)
 
@@ -922,13 +2350,70 @@ Model = db.Model
 # into a mixin.
 class ModelMixin(object):
 
+    _mora_dependents = {}
+    _mora_materialized = None
+    _mora_updated = None
+    query_cache = False
+    projection_queries = False
+
+    # Setting an attribute that a cached computed property depends on
+    # throws away the memoized value.  Setting a property also makes a
+    # materialized JSON copy stale.
+    def __setattr__(self, name, value):
+        super(ModelMixin, self).__setattr__(name, value)
+        dependents = self._mora_dependents.get(name)
+        if dependents:
+            cache = self.__dict__.get('_mora_computed')
+            if cache:
+                for dependent in dependents:
+                    cache.pop(dependent, None)
+        if self._mora_materialized is not None and \
+                name in self._json_attributes():
+            self.__dict__.pop('_mora_json_fresh', None)
+
+    # The instance attributes that hold the values of the properties
+    # that a materialized JSON copy is built from.
+    @classmethod
+    def _json_attributes(cls):
+        attributes = cls.__dict__.get('_mora_json_attributes')
+        if attributes is None:
+            attributes = frozenset(
+                p_kind._attr_name() for p_kind in cls.properties().values()
+                if not isinstance(p_kind, (ComputedProperty,
+                                           MaterializedJsonProperty)))
+            cls._mora_json_attributes = attributes
+        return attributes
+
+    # Stops a materialized JSON copy from being used until the model is
+    # written again.
+    def invalidate_json(self):
+        self.__dict__.pop('_mora_json_fresh', None)
+
+    # Throws away the memoized values of the named computed properties
+    # or all of them when no names are given.
+    def invalidate_computed(self, *names):
+        cache = self.__dict__.get('_mora_computed')
+        if not cache:
+            return
+        if not names:
+            cache.clear()
+        for name in names:
+            cache.pop(name, None)
+
     def _json_dumps(self, obj):
-        return json.dumps(obj)
+        return codec.dumps(obj)
 
+    # A model with an up to date materialized copy returns the copy.
     def _to_json(self, options={}, include=None, exclude=None):
-        return json.dumps(self.as_json(options=options,
-                                       include=include,
-                                       exclude=exclude))
+        with timed('serialize'):
+            if self._mora_materialized is not None and \
+                    not include and not exclude:
+                text = self._mora_materialized.stored_json(self)
+                if text is not None:
+                    return text
+            return codec.dumps(self.as_json(options=options,
+                                            include=include,
+                                            exclude=exclude))
 
     # This returns representation of the model as a JSON string.
     def to_json(self, options={}, include=None, exclude=None):
@@ -938,13 +2423,20 @@ class ModelMixin(object):
     # properties checking them against the properties we should expose
     # (via `include` and `exclude`).  We then call the individual
     # properties' `as_json` methods to build the final representation.
+    #
+    # Without `include` or `exclude` we use the class's precomputed list
+    # of public properties instead of copying the property map.
     def _as_json(self, options={}, include=None, exclude=None):
         result = {}
+        if not include and not exclude:
+            for p, p_kind in self._json_properties():
+                result[p] = p_kind.as_json(self)
+            return result
         available_properties = self.properties()
         if include:
             properties = include
         else:
-            properties = self.properties().keys()
+            properties = available_properties.keys()
             if exclude:
                 for x in exclude:
                     properties.remove(x)
@@ -952,10 +2444,22 @@ class ModelMixin(object):
             if p[0:1] == "_":
                 continue
             if p in available_properties:
-                p_kind = self.properties()[p]
+                p_kind = available_properties[p]
                 result[p] = p_kind.as_json(self)
         return result
 
+    # The public properties of a model class in `as_json` order.  The
+    # list is built on first use, or by `warmup`, and kept on the class.
+    @classmethod
+    def _json_properties(cls):
+        plan = cls.__dict__.get('_mora_json_properties')
+        if plan is None:
+            plan = [(p, p_kind) for p, p_kind in cls.properties().iteritems()
+                    if p[0:1] != "_" and
+                    not isinstance(p_kind, MaterializedJsonProperty)]
+            cls._mora_json_properties = plan
+        return plan
+
     # Since overriding `as_json` is pretty common and calling super
     # class methods is a pain in Python, we put the core behavior in
     # `_as_json`.
@@ -985,17 +2489,103 @@ class ModelMixin(object):
     def from_json(self, data, options={}, include=None, exclude=None, save=True):
         return self._from_json(data, options, include, exclude, save)
 
+    # `merge_patch` applies an [RFC 7386][rfc7386] merge patch to the
+    # model.  Unlike `from_json`, only the properties named in the patch
+    # are touched.  Each named property is compared with its current
+    # `as_json` representation and only properties that actually change
+    # are passed to their `from_json` hooks.  If nothing changed we skip
+    # the write entirely.  The return value tells the caller whether
+    # the model was modified.
+    # [rfc7386]: http://tools.ietf.org/html/rfc7386 "JSON Merge Patch"
+    def _merge_patch(self, patch, options={}, include=None, exclude=None, save=True):
+        if not isinstance(patch, dict):
+            raise BadValueError('A merge patch must be a JSON object')
+        available_properties = self.properties()
+        changed = False
+        for p, value in patch.iteritems():
+            if p[0:1] == "_":
+                continue
+            if include and p not in include:
+                continue
+            if exclude and p in exclude:
+                continue
+            if p not in available_properties:
+                continue
+            p_kind = available_properties[p]
+            if isinstance(p_kind, (ComputedProperty,
+                                   MaterializedJsonProperty)):
+                continue
+            current = p_kind.as_json(self)
+            if isinstance(current, codec.RawJSON):
+                current = getattr(self, p)
+            if isinstance(value, dict) and isinstance(current, dict):
+                value = merge_patch(current, value)
+            if value == current:
+                continue
+            # A `null` removes a member in a merge patch.  For lists the
+            # closest equivalent is the empty list and everything else
+            # is simply cleared since not every `from_json` hook
+            # accepts `None`.
+            if value is None and isinstance(p_kind, db.ListProperty):
+                p_kind.from_json(self, [])
+            elif value is None:
+                setattr(self, p, None)
+            else:
+                p_kind.from_json(self, value)
+            if p_kind.as_json(self) != current:
+                changed = True
+        if changed and save: self.put()
+        return changed
+
+    def merge_patch(self, patch, options={}, include=None, exclude=None, save=True):
+        return self._merge_patch(patch, options, include, exclude, save)
+
 
 ### MoraModel
 # We use our mixin to define Mora's base model.
 class MoraModel(db.Model, ModelMixin):
 
-    @computed_property(StringProperty(default=""))
+    # The id only changes when the entity is loaded or written, both of
+    # which replace the model's internal `_entity`.
+    @computed_property(StringProperty(default=""), cache=True,
+                       depends=['_entity', '_key'])
     def id(self):
         if self.is_saved():
-            return str(self.key())
+            return key_to_str(self.key())
         return ""
 
+    @classmethod
+    def all(cls, **kwds):
+        return Query(cls, **kwds)
+
+    # A model read from the datastore has an up to date materialized
+    # JSON copy, if it has one at all.
+    @classmethod
+    def from_entity(cls, entity):
+        model = super(MoraModel, cls).from_entity(entity)
+        model.__dict__['_mora_json_fresh'] = True
+        return model
+
+    # Deleting a model with an `UpdatedProperty` leaves a tombstone.
+    def delete(self, **kwargs):
+        _watch_writes()
+        record_tombstones([self])
+        super(MoraModel, self).delete(**kwargs)
+        _deleted([self.key()])
+
+    def _populate_internal_entity(self, *args, **kwargs):
+        _watch_writes()
+        return super(MoraModel, self)._populate_internal_entity(
+            *args, **kwargs)
+
+    # The identity map only learns about a write once it succeeded.
+    def put(self, **kwargs):
+        key = super(MoraModel, self).put(**kwargs)
+        _stored([self])
+        return key
+
+    save = put
+
     # We also add the method `class_name` to our base model to mirror
     # the `class_name` method in Google's `PolyModel` class.
     @classmethod
@@ -1011,14 +2601,468 @@ class MoraModel(db.Model, ModelMixin):
 # And we also use our mixin to define Mora's base polymodel.
 class MoraPolyModel(polymodel.PolyModel, ModelMixin):
 
-    @computed_property(StringProperty(default=""))
+    @computed_property(StringProperty(default=""), cache=True,
+                       depends=['_entity', '_key'])
     def id(self):
         if self.is_saved():
-            return str(self.key())
+            return key_to_str(self.key())
         return ""
 
+    # This is `PolyModel.all` with our `Query`.
+    @classmethod
+    def all(cls, **kwds):
+        query = Query(cls, **kwds)
+        if cls != cls.__root_class__:
+            query.filter(polymodel._CLASS_KEY_PROPERTY + ' =',
+                         cls.class_name())
+        return query
+
+    @classmethod
+    def from_entity(cls, entity):
+        model = super(MoraPolyModel, cls).from_entity(entity)
+        model.__dict__['_mora_json_fresh'] = True
+        return model
+
+    def delete(self, **kwargs):
+        _watch_writes()
+        record_tombstones([self])
+        super(MoraPolyModel, self).delete(**kwargs)
+        _deleted([self.key()])
+
+    def _populate_internal_entity(self, *args, **kwargs):
+        _watch_writes()
+        return super(MoraPolyModel, self)._populate_internal_entity(
+            *args, **kwargs)
+
+    # The identity map only learns about a write once it succeeded.
+    def put(self, **kwargs):
+        key = super(MoraPolyModel, self).put(**kwargs)
+        _stored([self])
+        return key
+
+    save = put
+
     # We also add the method `class_name` here to mirror the
     # `class_name` method in Google's `PolyModel` class.
     @classmethod
     def class_name(cls):
         return cls.__name__
+
+
+### Raw Entities
+
+# Serializing models that are only read, like a `show` response, a
+# collection or an export, spends most of its time building the models:
+# every property's descriptor and validation runs, and `as_json` then
+# takes each value out again.  `entity_as_json` builds the `as_json`
+# dictionary of a low-level `datastore.Entity` directly, applying each
+# property's converter to the stored value:
+#
+#      entities = Course.all().filter('student =', student).fetch_entities(20)
+#      data = [db.entity_as_json(e) for e in entities]
+#
+# or simply `query.fetch_json(20)`.
+#
+# Properties convert stored values with `as_json(None, value)`, or with
+# `_raw_json(value, key)` when their stored form differs from the
+# model's.  The `id` comes from the key.  Classes that override
+# `as_json` or `_as_json`, or that have a `BlobReferenceProperty` or a
+# computed property other than `id`, are serialized by building the
+# model as usual.  A computed property's stored value may be stale,
+# and `as_json` computes it again.
+def class_for_entity(entity):
+    model_class = db.class_for_kind(entity.kind())
+    if issubclass(model_class, polymodel.PolyModel) and \
+            polymodel._CLASS_KEY_PROPERTY in entity:
+        model_class = polymodel._class_map.get(
+            tuple(entity[polymodel._CLASS_KEY_PROPERTY]), model_class)
+    return model_class
+
+def _raw_converter(p_kind):
+    convert = getattr(p_kind, '_raw_json', None)
+    if convert is not None:
+        return convert
+    if p_kind is MoraModel.id or p_kind is MoraPolyModel.id:
+        return lambda value, key: key_to_str(key)
+    empty = [] if isinstance(p_kind, db.ListProperty) else None
+
+    def convert(value, key):
+        if value is None:
+            return empty
+        return p_kind.as_json(None, value)
+    return convert
+
+def _needs_model(p_kind):
+    if p_kind is MoraModel.id or p_kind is MoraPolyModel.id:
+        return False
+    return isinstance(p_kind, (BlobReferenceProperty, ComputedProperty))
+
+# The `(name, stored name, property, converter)` of each property in
+# `as_json` order, or `None` for classes that need their models.
+def _raw_json_plan(model_class):
+    plan = model_class.__dict__.get('_mora_raw_json_plan', _MISSING)
+    if plan is _MISSING:
+        plan = None
+        if model_class.as_json.im_func is ModelMixin.as_json.im_func and \
+                model_class._as_json.im_func is ModelMixin._as_json.im_func:
+            properties = model_class._json_properties()
+            if not any(_needs_model(p_kind) for _, p_kind in properties):
+                plan = [(p, p_kind.name, p_kind, _raw_converter(p_kind))
+                        for p, p_kind in properties]
+        model_class._mora_raw_json_plan = plan
+    return plan
+
+def entity_as_json(entity, include=None, exclude=None):
+    model_class = class_for_entity(entity)
+    plan = _raw_json_plan(model_class)
+    if plan is None:
+        model = model_class.from_entity(entity)
+        return model.as_json(include=include, exclude=exclude)
+    key = entity.key()
+    result = {}
+    for p, name, p_kind, convert in plan:
+        if include and p not in include:
+            continue
+        if exclude and p in exclude:
+            continue
+        value = entity.get(name, _MISSING)
+        if value is _MISSING:
+            value = p_kind.default_value()
+        result[p] = convert(value, key)
+    return result
+
+# Index values are restored to the type the property stores.  Only
+# single valued properties of these types can be projected; lists
+# would return a row per value.
+_INDEX_VALUE_TYPES = {basestring: unicode,
+                      str: str,
+                      unicode: unicode,
+                      bool: bool,
+                      int: long,
+                      long: long,
+                      float: float,
+                      datetime.datetime: datetime.datetime,
+                      datetime.date: datetime.datetime,
+                      datetime.time: datetime.datetime,
+                      db.Email: db.Email,
+                      db.Link: db.Link,
+                      db.Category: db.Category,
+                      db.PhoneNumber: db.PhoneNumber,
+                      db.PostalAddress: db.PostalAddress,
+                      db.Rating: db.Rating}
+
+def _index_value_type(p_kind):
+    if p_kind is MoraModel.id or p_kind is MoraPolyModel.id:
+        return None
+    if not getattr(p_kind, 'indexed', True):
+        return None
+    return _INDEX_VALUE_TYPES.get(p_kind.data_type)
+
+# The stored names to project to serialize `fields` of `model_class`,
+# or `None` when one of them cannot be read from an index.  The `id`
+# comes from the key and needs no projection.
+def projection_for(model_class, fields):
+    plan = _raw_json_plan(model_class)
+    if plan is None or not fields:
+        return None
+    entries = dict((p, (name, p_kind)) for p, name, p_kind, _ in plan)
+    names = []
+    for field in fields:
+        if field not in entries:
+            return None
+        name, p_kind = entries[field]
+        if p_kind is MoraModel.id or p_kind is MoraPolyModel.id:
+            continue
+        if _index_value_type(p_kind) is None:
+            return None
+        if name not in names:
+            names.append(name)
+    return tuple(names) or None
+
+# `entity_as_json` for a row of a projection query.  Projected entities
+# lack the polymodel class, so the queried class is given.
+def projected_as_json(model_class, entity, fields):
+    key = entity.key()
+    result = {}
+    for p, name, p_kind, convert in _raw_json_plan(model_class):
+        if p not in fields:
+            continue
+        value = entity.get(name)
+        if value is not None:
+            value_type = _index_value_type(p_kind)
+            if value_type is not None and not isinstance(value, value_type):
+                value = datastore_types.RestoreFromIndexValue(value,
+                                                              value_type)
+        result[p] = convert(value, key)
+    return result
+
+
+### Delta Sync
+
+# Clients that keep a copy of a collection can ask for what changed
+# since their last sync instead of downloading the collection again.
+# A model opts in by declaring an `UpdatedProperty`:
+#
+#      class Course(MoraModel):
+#          title = StringProperty()
+#          student = ReferenceProperty(Student)
+#          updated = UpdatedProperty()
+#
+# `changes_since(Course, token, student=student)` then returns the
+# courses of `student` that were written after `token` and the ids of
+# those that were deleted, with a new token to pass next time.  Changes
+# are found with a range query on the updated property and deletes
+# with a range query over tombstones, so the cost follows the number of
+# changes rather than the size of the collection.  A token of `None`
+# returns the whole collection, `limit` models at a time, and `more` is
+# true while there are further pages.
+#
+# Deleting a model through `delete` on the model or `mora.db.delete`
+# first writes a `Tombstone` with its id, its classes and the keys it
+# references.  Keyword filters must name `ReferenceProperty`s so that
+# the tombstones can be filtered the same way.  A model that moves to
+# another collection shows up in the new one only.
+#
+# Non-ancestor queries are eventually consistent, so writes from the
+# last `settle` seconds may not be visible yet.  The token never moves
+# past that point and such recent changes are simply sent again.
+#
+# The queries need composite indexes, e.g. for the example above:
+#
+#      - kind: Course
+#        properties:
+#        - name: student
+#        - name: updated
+#      - kind: MoraTombstone
+#        properties:
+#        - name: kinds
+#        - name: refs
+#        - name: deleted
+class Tombstone(MoraModel):
+    entity = StringProperty()
+    kinds = StringListProperty()
+    refs = StringListProperty()
+    deleted = DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def kind(cls):
+        return 'MoraTombstone'
+
+    # Tombstones are only needed until every client has synced past
+    # them.  Clients holding an older token should fetch the whole
+    # collection again.
+    @classmethod
+    def purge(cls, before, batch_size=500):
+        while True:
+            keys = cls.all(keys_only=True).filter(
+                'deleted <', before).fetch(batch_size)
+            if not keys:
+                return
+            db.delete(keys)
+
+
+def record_tombstones(models):
+    tombstones = []
+    for model in models:
+        if getattr(model, '_mora_updated', None) is None or \
+                not model.is_saved():
+            continue
+        if isinstance(model, polymodel.PolyModel):
+            kinds = list(model.class_key())
+        else:
+            kinds = [model.class_name()]
+        refs = []
+        for prop in model.properties().itervalues():
+            if isinstance(prop, db.ReferenceProperty):
+                key = prop.get_value_for_datastore(model)
+                if key is not None:
+                    refs.append(key_to_str(key))
+        tombstones.append(Tombstone(key_name='t:' + model.id,
+                                    entity=model.id, kinds=kinds, refs=refs))
+    if tombstones:
+        db.put(tombstones)
+
+
+# `delete` is `db.delete` that leaves tombstones for models with an
+# `UpdatedProperty`.  Keys of such models are read first since the
+# tombstones record the keys the models reference.
+def delete(models, **kwargs):
+    _watch_writes()
+    if not isinstance(models, (list, tuple)):
+        models = [models]
+    deleting = []
+    fetching = []
+    for model in models:
+        if isinstance(model, basestring):
+            model = str_to_key(model)
+        if isinstance(model, Key):
+            # Only a subclass of a polymodel may have opted in.
+            model_class = db._kind_map.get(model.kind())
+            if getattr(model_class, '_mora_updated', None) or \
+                    isinstance(model_class, type) and \
+                    issubclass(model_class, polymodel.PolyModel):
+                fetching.append(model)
+        else:
+            deleting.append(model)
+    deleting.extend(m for m in get(fetching) if m is not None)
+    record_tombstones(deleting)
+    db.delete(models, **kwargs)
+    _deleted([_key_of(m) for m in models])
+
+
+# `put` is `db.put` that also updates the active identity map once the
+# models are written.
+def put(models, **kwargs):
+    keys = db.put(models, **kwargs)
+    if isinstance(models, (list, tuple)):
+        _stored(models)
+    else:
+        _stored([models])
+    return keys
+
+
+def _stored(models):
+    identity_map = current_identity_map()
+    if identity_map is not None:
+        for model in models:
+            identity_map.written(model)
+
+
+def _deleted(keys):
+    identity_map = current_identity_map()
+    if identity_map is not None:
+        for key in keys:
+            identity_map.deleted(key)
+
+
+def _sync_token(when, ids):
+    token = codec.dumps({'t': when.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+                         'ids': sorted(ids)})
+    return base64.urlsafe_b64encode(token)
+
+
+def _parse_sync_token(token):
+    try:
+        data = codec.loads(base64.urlsafe_b64decode(str(token)))
+        when = datetime.datetime.strptime(data['t'], '%Y-%m-%dT%H:%M:%S.%f')
+        return when, set(data['ids'])
+    except (TypeError, ValueError, KeyError):
+        raise BadValueError('Invalid sync token %r' % token)
+
+
+def changes_since(model_class, token=None, limit=500, settle=1.0,
+                  **filters):
+    updated = model_class._mora_updated
+    if updated is None:
+        raise BadValueError('%s has no UpdatedProperty' %
+                            model_class.class_name())
+    start, seen = None, set()
+    if token:
+        start, seen = _parse_sync_token(token)
+
+    changed = model_class.all()
+    deleted = Tombstone.all().filter('kinds =', model_class.class_name())
+    for name, value in filters.iteritems():
+        if isinstance(value, db.Model):
+            value = value.key()
+        changed.filter(name + ' =', value)
+        deleted.filter('refs =', key_to_str(value))
+    if start is not None:
+        changed.filter(updated.name + ' >=', start)
+        deleted.filter('deleted >=', start)
+    changed.order(updated.name)
+    deleted.order('deleted')
+
+    # Both streams are read in time order and merged.  A stream that
+    # filled its fetch may have more after its last item, so the page
+    # ends there.
+    fetch = limit + len(seen)
+    models = changed.fetch(fetch)
+    tombstones = deleted.fetch(fetch)
+    changes = [(getattr(m, updated.name), m.id, m) for m in models]
+    changes += [(t.deleted, t.entity, None) for t in tombstones]
+    changes = [c for c in changes if c[0] != start or c[1] not in seen]
+    changes.sort(key=lambda c: c[:2])
+    more = False
+    for stream in (models, tombstones):
+        if len(stream) == fetch:
+            more = True
+            end = stream[-1]
+            end = getattr(end, updated.name) if stream is models \
+                else end.deleted
+            changes = [c for c in changes if c[0] <= end]
+    if len(changes) > limit:
+        more = True
+        changes = changes[:limit]
+
+    when, ids = start, seen
+    if changes:
+        when = changes[-1][0]
+        ids = set(c[1] for c in changes if c[0] == when)
+        if when == start:
+            ids |= seen
+    # Everything after the horizon is sent again next time, so there is
+    # no point in asking for more pages now.
+    horizon = DateTimeProperty.now() - datetime.timedelta(seconds=settle)
+    if when is not None and when > horizon:
+        when, ids, more = max(horizon, start or horizon), set(), False
+        if when == start:
+            ids = seen
+    if when is None:
+        when = datetime.datetime.min.replace(year=1970)
+    # A model that was deleted and then created again under the same
+    # key has a tombstone as well as a later change, since it exists.
+    # Only the change is sent so that clients do not drop a live model.
+    changed = [c[2] for c in changes if c[2] is not None]
+    live = set(m.id for m in changed)
+    return {'changed': changed,
+            'deleted': [c[1] for c in changes
+                        if c[2] is None and c[1] not in live],
+            'since': _sync_token(when, ids),
+            'more': more}
+
+
+### Warmup
+
+# The first request on a fresh instance pays for everything mora builds
+# lazily: kind lookups, the per-class list of serialized properties,
+# list item converters, string reference classes and the modules that
+# are only imported on first use.  `warmup` builds all of it for every
+# mora model class that has been defined and returns the number of
+# classes it prepared.  See `mora.warmup` for the `/_ah/warmup` entry
+# point.
+def warmup():
+    for module in (base64, saxutils):
+        module._mora_import()
+    codec.encoder()
+
+    classes = set(db._kind_map.values()) | set(polymodel._class_map.values())
+    classes = [c for c in classes if issubclass(c, ModelMixin)]
+    for model_class in classes:
+        class_for_kind(model_class.class_name())
+        model_class._json_properties()
+        _raw_json_plan(model_class)
+        if model_class._mora_materialized is not None:
+            model_class._json_attributes()
+            model_class._mora_materialized.shape(model_class)
+        for prop in model_class.properties().itervalues():
+            if isinstance(prop, ListProperty):
+                prop._item_property()
+            elif isinstance(prop, ReferenceProperty) and \
+                    isinstance(prop.reference_class, basestring):
+                try:
+                    prop.reference_class = class_for_kind(prop.reference_class)
+                except KindError:
+                    logging.warning('Reference %s.%s has undefined class %s',
+                                    model_class.class_name(), prop.name,
+                                    prop.reference_class)
+        for klass in model_class.__mro__:
+            for attr in klass.__dict__.itervalues():
+                if isinstance(attr, ReverseReferenceProperty):
+                    try:
+                        attr._model
+                    except KindError:
+                        logging.warning('Reverse reference on %s has an '
+                                        'undefined class',
+                                        model_class.class_name())
+    return len(classes)
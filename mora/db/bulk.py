@@ -0,0 +1,441 @@
+#     (c) 2012 James Dean Palmer
+#     Mora may be freely distributed under the Apache 2.0
+#     licence.  You may obtain a copy of this license at
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# *bulk* moves whole kinds in and out of the datastore as
+# [NDJSON][ndjson]: one JSON object per line, each produced by the
+# model's `as_json`.  Binary values are always written base64 encoded,
+# including those of properties that `as_json` represents by URL, so
+# that the records carry the bytes.
+#
+#      from mora.db import bulk
+#
+#      bulk.export(Student, '/tmp/students', shards=16, workers=16)
+#      bulk.export(lambda: course.students, '/tmp/course-students')
+#
+# The source is a model class or a function returning a fresh query,
+# such as a `ReverseReferenceProperty` collection.  The query must not
+# have sort orders of its own since the export orders by key.
+#
+# The kind is split into key ranges using the datastore's `__scatter__`
+# sample and every range is exported by its own worker into its own
+# gzipped file, `<path>-00003-of-00016.ndjson.gz`.  Datastore calls
+# spend most of their time waiting, so worker threads scale until the
+# datastore or the disk is the bottleneck.
+#
+# After every batch the worker appends one complete gzip member to its
+# file and records the byte offset and the query cursor in
+# `<path>.checkpoint`.  If the export is interrupted, running it again
+# truncates each file to its last recorded offset and continues from
+# the cursor.  The checkpoint is removed once every shard is done.
+#
+# `load` is the reverse.  It reads NDJSON files, gzipped or not, in
+# chunks of `batch_size` lines and hands the chunks to worker threads
+# that decode them, build models with `from_json` and write each chunk
+# with a single batch `put`.  The class of each record comes from its
+# `_kind` field, which `export` writes, through `class_for_kind`, so
+# `MoraPolyModel` subclasses come back as themselves.  Binary values are
+# decoded before `from_json`, which takes raw bytes:
+#
+#      bulk.load(glob.glob('/tmp/students-*.ndjson.gz'))
+#
+# Finished chunks are recorded in `<first path>.checkpoint` and skipped
+# when a failed load is run again.  A chunk that was written but not
+# yet recorded when the load failed is written again; pass
+# `keep_keys=True` to reuse the exported ids so that this overwrites
+# rather than duplicates.
+# [ndjson]: http://ndjson.org/ "Newline delimited JSON"
+import os
+import sys
+import base64
+import gzip
+import time
+import Queue
+import logging
+import threading
+
+from google.appengine.api import datastore
+
+from . import codec
+from . import Error, key_to_str, str_to_key, class_for_kind, put
+from . import Query, entity_as_json, class_for_entity
+from . import BlobProperty, ByteStringProperty
+
+
+### Helpers
+
+# The `(name, property)` pairs of a class's binary properties.
+def _binary_properties(model_class):
+    properties = model_class.__dict__.get('_mora_binary_properties')
+    if properties is None:
+        properties = [(p, prop) for p, prop in
+                      model_class.properties().iteritems()
+                      if isinstance(prop, (BlobProperty, ByteStringProperty))]
+        model_class._mora_binary_properties = properties
+    return properties
+
+
+# Runs `function` on every item with up to `workers` threads.  The first
+# exception stops the remaining work and is re-raised here.
+def _parallel(function, items, workers):
+    queue = Queue.Queue()
+    for item in items:
+        queue.put(item)
+    errors = []
+
+    def work():
+        while not errors:
+            try:
+                item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                function(item)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=work)
+               for _ in range(max(1, min(workers, len(items))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+
+# A checkpoint is a JSON document that is replaced atomically on every
+# save so that a crash never leaves it half written.
+class Checkpoint(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = None
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            self.state = codec.loads(f.read())
+        return self.state
+
+    def save(self):
+        with self.lock:
+            temp = self.path + '.tmp'
+            with open(temp, 'w') as f:
+                f.write(codec.dumps(self.state))
+            os.rename(temp, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+### Export
+
+# Split points for `shards` key ranges of `kind`.  Entities get a
+# `__scatter__` value with a small probability, so ordering by it gives
+# a uniform sample of keys.  Small kinds may have no sample at all and
+# are exported as a single range.
+def split_points(kind, shards, oversample=32):
+    if shards < 2:
+        return []
+    query = datastore.Query(kind, keys_only=True)
+    query.Order('__scatter__')
+    try:
+        keys = sorted(query.Get(shards * oversample))
+    except Error:
+        logging.warning('No __scatter__ sample for %s, exporting it as '
+                        'a single range', kind)
+        return []
+    points = []
+    step = len(keys) / float(shards)
+    for i in range(1, shards):
+        key = keys[int(step * i)] if keys else None
+        if key is not None and (not points or points[-1] != key):
+            points.append(key)
+    return points
+
+
+class Export(object):
+
+    def __init__(self, source, path, shards=8, workers=8, batch_size=200,
+                 include=None, exclude=None, kind_field='_kind'):
+        if isinstance(source, type):
+            self.make_query = source.all
+        else:
+            self.make_query = source
+        self.model_class = self.make_query()._model_class
+        self.path = path
+        self.shards = shards
+        self.workers = workers
+        self.batch_size = batch_size
+        self.include = include
+        self.exclude = exclude
+        self.kind_field = kind_field
+        self.checkpoint = Checkpoint(path + '.checkpoint')
+        self.lock = threading.Lock()
+        self.rows = 0
+
+    def _plan(self):
+        state = self.checkpoint.load()
+        kind = self.model_class.class_name()
+        if state is not None:
+            if state['kind'] != kind:
+                raise ValueError('%s is a checkpoint for %s, not %s' %
+                                 (self.checkpoint.path, state['kind'], kind))
+            logging.info('Resuming export of %s from %s', kind,
+                         self.checkpoint.path)
+            return state
+
+        points = [key_to_str(k) for k in
+                  split_points(self.model_class.kind(), self.shards)]
+        bounds = [None] + points + [None]
+        count = len(bounds) - 1
+        shards = []
+        for i in range(count):
+            shards.append({'file': '%s-%05d-of-%05d.ndjson.gz' %
+                                   (self.path, i, count),
+                           'start': bounds[i], 'end': bounds[i + 1],
+                           'cursor': None, 'offset': 0, 'rows': 0,
+                           'done': False})
+        self.checkpoint.state = {'kind': kind, 'shards': shards}
+        self.checkpoint.save()
+        return self.checkpoint.state
+
+    def _query(self, shard):
+        query = self.make_query()
+        if shard['start']:
+            query.filter('__key__ >=', str_to_key(shard['start']))
+        if shard['end']:
+            query.filter('__key__ <', str_to_key(shard['end']))
+        query.order('__key__')
+        return query
+
+    def _line(self, model):
+        data = model.as_json(include=self.include, exclude=self.exclude)
+        for p, prop in _binary_properties(type(model)):
+            if prop.as_url and data.get(p) is not None:
+                data[p] = base64.urlsafe_b64encode(getattr(model, p))
+        if self.kind_field:
+            data[self.kind_field] = model.class_name()
+        return codec.dumps(data) + '\n'
+
+    def _entity_line(self, entity):
+        model_class = class_for_entity(entity)
+        if any(prop.as_url for _, prop in _binary_properties(model_class)):
+            return self._line(model_class.from_entity(entity))
+        data = entity_as_json(entity, self.include, self.exclude)
+        if self.kind_field:
+            data[self.kind_field] = class_for_entity(entity).class_name()
+        return codec.dumps(data) + '\n'
+
+    # mora's queries hand us raw entities, which are serialized without
+    # building models.
+    def _lines(self, query):
+        if isinstance(query, Query):
+            entities = query.fetch_entities(self.batch_size)
+            return [self._entity_line(e) for e in entities]
+        return [self._line(m) for m in query.fetch(self.batch_size)]
+
+    def _export_shard(self, shard):
+        query = self._query(shard)
+        mode = 'r+b' if os.path.exists(shard['file']) else 'wb'
+        with open(shard['file'], mode) as f:
+            f.seek(shard['offset'])
+            f.truncate()
+            while True:
+                if shard['cursor']:
+                    query.with_cursor(shard['cursor'])
+                lines = self._lines(query)
+                if not lines:
+                    break
+                member = gzip.GzipFile(fileobj=f, mode='wb')
+                member.write(''.join(lines))
+                member.close()
+                f.flush()
+                shard['cursor'] = query.cursor()
+                shard['offset'] = f.tell()
+                shard['rows'] += len(lines)
+                with self.lock:
+                    self.rows += len(lines)
+                self.checkpoint.save()
+                if len(lines) < self.batch_size:
+                    break
+        shard['done'] = True
+        self.checkpoint.save()
+
+    def run(self):
+        start = time.time()
+        state = self._plan()
+        pending = [s for s in state['shards'] if not s['done']]
+        _parallel(self._export_shard, pending, self.workers)
+        self.checkpoint.remove()
+        seconds = time.time() - start
+        report = {'kind': state['kind'],
+                  'rows': sum(s['rows'] for s in state['shards']),
+                  'exported': self.rows,
+                  'files': [s['file'] for s in state['shards']],
+                  'seconds': seconds,
+                  'rows_per_sec': self.rows / seconds if seconds else None}
+        logging.info('Exported %d %s rows in %.1fs (%.0f rows/s)',
+                     report['exported'], report['kind'], seconds,
+                     report['rows_per_sec'] or 0)
+        return report
+
+
+# Exports `source` to gzipped NDJSON files next to `path` and returns a
+# report with the row count, the files written and the throughput.
+# `rows` counts the whole export, `exported` only what this run wrote.
+def export(source, path, **options):
+    return Export(source, path, **options).run()
+
+
+### Import
+
+def _open(path):
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == '\x1f\x8b'
+    if compressed:
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+class Load(object):
+
+    def __init__(self, paths, model_class=None, workers=4, batch_size=200,
+                 kind_field='_kind', keep_keys=False, checkpoint=None,
+                 progress=None, progress_interval=10):
+        if isinstance(paths, basestring):
+            paths = [paths]
+        self.paths = list(paths)
+        self.model_class = model_class
+        self.workers = workers
+        self.batch_size = batch_size
+        self.kind_field = kind_field
+        self.keep_keys = keep_keys
+        self.checkpoint = Checkpoint(checkpoint or
+                                     self.paths[0] + '.checkpoint')
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.lock = threading.Lock()
+        self.rows = 0
+        self.start = None
+        self.reported = None
+
+    # Chunks are `(path, index, lines)`.  Chunks finished by an earlier
+    # run are skipped without being decoded.
+    def _chunks(self, done):
+        for path in self.paths:
+            finished = done.get(path, ())
+            index = 0
+            lines = []
+            with _open(path) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    lines.append(line)
+                    if len(lines) == self.batch_size:
+                        if index not in finished:
+                            yield path, index, lines
+                        index += 1
+                        lines = []
+            if lines and index not in finished:
+                yield path, index, lines
+
+    def _model(self, data):
+        model_class = self.model_class
+        if self.kind_field and data.get(self.kind_field):
+            model_class = class_for_kind(data[self.kind_field])
+        if model_class is None:
+            raise ValueError('Record without a %s field and no model class '
+                             'given' % self.kind_field)
+        if self.keep_keys and data.get('id'):
+            model = model_class(key=str_to_key(data['id']))
+        else:
+            model = model_class()
+        for p, prop in _binary_properties(model_class):
+            if data.get(p) is not None:
+                data[p] = base64.urlsafe_b64decode(str(data[p]))
+        model.from_json(data, save=False)
+        return model
+
+    def _load_chunk(self, chunk):
+        path, index, lines = chunk
+        put([self._model(codec.loads(line)) for line in lines])
+        with self.lock:
+            self.rows += len(lines)
+            self.checkpoint.state['chunks'].setdefault(path, []).append(index)
+            self.checkpoint.save()
+            now = time.time()
+            if now - self.reported >= self.progress_interval:
+                self.reported = now
+                self._report_progress(now)
+
+    def _report_progress(self, now):
+        seconds = now - self.start
+        rate = self.rows / seconds if seconds else 0
+        logging.info('Loaded %d rows in %.1fs (%.0f rows/s)',
+                     self.rows, seconds, rate)
+        if self.progress is not None:
+            self.progress(self.rows, seconds)
+
+    def run(self):
+        self.start = self.reported = time.time()
+        state = self.checkpoint.load()
+        if state is None:
+            state = self.checkpoint.state = {'chunks': {}}
+        else:
+            logging.info('Resuming load from %s', self.checkpoint.path)
+        done = dict((path, set(indexes))
+                    for path, indexes in state['chunks'].iteritems())
+
+        # Reading stays at most a few chunks ahead of the workers.  A
+        # failed worker keeps draining the queue so the reader never
+        # blocks on it.
+        queue = Queue.Queue(maxsize=self.workers * 2)
+        errors = []
+
+        def work():
+            while True:
+                chunk = queue.get()
+                if chunk is None:
+                    return
+                if errors:
+                    continue
+                try:
+                    self._load_chunk(chunk)
+                except Exception:
+                    errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target=work)
+                   for _ in range(max(1, self.workers))]
+        for thread in threads:
+            thread.start()
+        try:
+            for chunk in self._chunks(done):
+                if errors:
+                    break
+                queue.put(chunk)
+        finally:
+            for thread in threads:
+                queue.put(None)
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+        self.checkpoint.remove()
+        seconds = time.time() - self.start
+        self._report_progress(time.time())
+        return {'rows': self.rows,
+                'seconds': seconds,
+                'rows_per_sec': self.rows / seconds if seconds else None}
+
+
+# Loads NDJSON files into the datastore and returns a report with the
+# number of rows this run wrote and the throughput.
+def load(paths, **options):
+    return Load(paths, **options).run()
@@ -0,0 +1,423 @@
+#     (c) 2012 James Dean Palmer
+#     Mora may be freely distributed under the Apache 2.0
+#     licence.  You may obtain a copy of this license at
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# *codec* is the one place mora turns JSON text into Python values and
+# back.  Several JSON libraries may be installed next to the standard
+# library and some of them are a lot faster, so the first time JSON is
+# encoded or decoded we pick the fastest library available for each
+# direction.
+#
+# Output must not depend on what happens to be installed.  The standard
+# library's `json` (or `django.utils.simplejson` on old runtimes) is the
+# reference: before an encoder is used we encode a probe document with
+# it and with the reference and only keep it if the output is byte for
+# byte identical.  A decoder likewise has to decode the probe to the
+# same values.  Libraries that format differently, like ujson and orjson
+# with their compact separators and shortened floats, therefore usually
+# end up decoding only.
+#
+# The choice can be overridden with `configure`:
+#
+#      from mora.db import codec
+#      codec.configure(encoder='json', decoder='ujson')
+#
+# or with the `MORA_JSON_ENCODER` and `MORA_JSON_DECODER` environment
+# variables.  A configured backend is used even if it fails the probe.
+import os
+import re
+import codecs
+import binascii
+import logging
+import importlib
+import threading
+
+
+### Backends
+
+# A backend adapts a JSON library to the `dumps`/`loads` pair mora
+# uses.  `dumps` returns a `str` like the standard library does.
+#
+# Three more functions are optional.  `compact` encodes without spaces
+# after separators, for storage.  `raw_dumps` is `dumps` passing
+# objects it cannot encode to `_raw_default`, which is how `RawJSON`
+# values get into the output, and `raw_compact` is `compact` doing the
+# same.
+class Backend(object):
+
+    def __init__(self, name, dumps, loads, compact=None, raw_dumps=None,
+                 raw_compact=None):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+        self.compact = compact or dumps
+        self.raw_dumps = raw_dumps
+        self.raw_compact = raw_compact
+
+    def __repr__(self):
+        return '<codec.Backend %s>' % self.name
+
+
+# The standard library and simplejson encode exactly like their `dumps`
+# with encoders that are made once.
+def _encoders(json):
+    return {'compact': json.JSONEncoder(separators=(',', ':')).encode,
+            'raw_dumps': json.JSONEncoder(default=_raw_default).encode,
+            'raw_compact': json.JSONEncoder(separators=(',', ':'),
+                                            default=_raw_default).encode}
+
+
+def _stdlib():
+    try:
+        json = importlib.import_module('json')
+    except ImportError:
+        json = importlib.import_module('django.utils.simplejson')
+    return Backend('json', json.dumps, json.loads, **_encoders(json))
+
+
+# simplejson is only worth using with its C extension; the pure Python
+# version is slower than the standard library.
+def _simplejson():
+    simplejson = importlib.import_module('simplejson')
+    importlib.import_module('simplejson._speedups')
+    return Backend('simplejson', simplejson.dumps, simplejson.loads,
+                   **_encoders(simplejson))
+
+
+# ujson has no `default` hook but puts what `RawJSON.__json__` returns
+# into its output as it is.
+def _ujson():
+    ujson = importlib.import_module('ujson')
+    return Backend('ujson',
+                   lambda obj: ujson.dumps(obj, ensure_ascii=True,
+                                           escape_forward_slashes=False),
+                   ujson.loads)
+
+
+# orjson's output is compact already.
+def _orjson():
+    orjson = importlib.import_module('orjson')
+
+    def raw_dumps(obj):
+        return orjson.dumps(obj, default=_raw_default).decode('utf-8')
+    return Backend('orjson',
+                   lambda obj: orjson.dumps(obj).decode('utf-8'),
+                   orjson.loads, raw_dumps=raw_dumps, raw_compact=raw_dumps)
+
+
+# Candidates from fastest to slowest.  Applications can register more
+# with `register`.
+BACKENDS = [('orjson', _orjson),
+            ('ujson', _ujson),
+            ('simplejson', _simplejson),
+            ('json', _stdlib)]
+
+
+def register(name, loader, first=True):
+    entry = (name, loader)
+    if first:
+        BACKENDS.insert(0, entry)
+    else:
+        BACKENDS.insert(len(BACKENDS) - 1, entry)
+    reset()
+
+
+### Selection
+
+# The probe exercises what differs between libraries: escaping of
+# non-ASCII and control characters, float formatting, big integers and
+# nesting.  Every dictionary has a single key so that key order, which
+# no library guarantees, cannot make outputs differ.
+PROBE = [{u'text': u'caf\xe9 \u2603 "quoted" \\ </script>\n\t\x01'},
+         {u'numbers': [0, -1, 2 ** 40, 2 ** 70, 0.1, -2.5, 1e22, 1.5e-7]},
+         {u'constants': [True, False, None]},
+         {u'nested': [[], {}, [{u'a': [u'']}]]}]
+
+
+def _load(name):
+    for candidate, loader in BACKENDS:
+        if candidate == name:
+            return loader()
+    raise ValueError('Unknown JSON backend %r' % name)
+
+
+# The backends that can be imported here, fastest first.
+def available():
+    backends = []
+    for name, loader in BACKENDS:
+        try:
+            backends.append(loader())
+        except ImportError:
+            pass
+    return backends
+
+
+def _encodes_like(backend, reference):
+    try:
+        return backend.dumps(PROBE) == reference.dumps(PROBE)
+    except Exception:
+        return False
+
+
+def _decodes_like(backend, reference):
+    try:
+        return backend.loads(reference.dumps(PROBE)) == PROBE
+    except Exception:
+        return False
+
+
+# Whether a backend encodes exactly like the reference, which is what
+# automatic selection requires of an encoder.
+def compatible(backend):
+    return _encodes_like(backend, _stdlib())
+
+
+_lock = threading.Lock()
+_config = {'encoder': None, 'decoder': None}
+
+# The selected `(encoder, decoder)` pair.  It is replaced as a whole so
+# that `dumps` and `loads` can read it without taking the lock.
+_selected = None
+
+
+# Picks the encoder and decoder.  This runs once, on the first `dumps`
+# or `loads`, so applications that never touch JSON never import a JSON
+# library.
+def _select():
+    global _selected
+    with _lock:
+        if _selected is not None:
+            return _selected
+        reference = _stdlib()
+        encoder = _config['encoder'] or os.environ.get('MORA_JSON_ENCODER')
+        decoder = _config['decoder'] or os.environ.get('MORA_JSON_DECODER')
+        if encoder:
+            encoder = _load(encoder)
+        if decoder:
+            decoder = _load(decoder)
+        for backend in available():
+            if encoder and decoder:
+                break
+            if encoder is None and _encodes_like(backend, reference):
+                encoder = backend
+            if decoder is None and _decodes_like(backend, reference):
+                decoder = backend
+        _selected = (encoder or reference, decoder or reference)
+        logging.debug('mora JSON encoder: %s, decoder: %s',
+                      _selected[0].name, _selected[1].name)
+        return _selected
+
+
+# Forces particular backends by name.  `None` leaves a direction to
+# automatic selection.
+def configure(encoder=None, decoder=None):
+    if encoder is not None:
+        _load(encoder)
+    if decoder is not None:
+        _load(decoder)
+    _config['encoder'] = encoder
+    _config['decoder'] = decoder
+    reset()
+
+
+# Forgets the current choice; the next call selects again.
+def reset():
+    global _selected
+    with _lock:
+        _selected = None
+
+
+def encoder():
+    return (_selected or _select())[0]
+
+
+def decoder():
+    return (_selected or _select())[1]
+
+
+### Encoding and Decoding
+
+# Documents holding a `RawJSON` that the selected encoder cannot take
+# are encoded by the standard library, which is loaded once for this.
+_fallback = []
+
+
+def _fallback_backend():
+    if not _fallback:
+        _fallback.append(_stdlib())
+    return _fallback[0]
+
+
+def dumps(obj):
+    backend = (_selected or _select())[0]
+    if backend.raw_dumps is None:
+        try:
+            return backend.dumps(obj)
+        except TypeError:
+            backend = _fallback_backend()
+    return _encode_raw(backend.raw_dumps, obj)
+
+
+# Compact JSON for storage, which only has to decode to the same values.
+# A `RawJSON`, like a `JsonProperty` value copied from another model's
+# `as_json`, is stored as its text.
+def compact(obj):
+    backend = (_selected or _select())[0]
+    if backend.raw_compact is None:
+        try:
+            return backend.compact(obj)
+        except TypeError:
+            backend = _fallback_backend()
+    return _encode_raw(backend.raw_compact, obj)
+
+
+def _encode_raw(encode, obj):
+    texts = _raw_local.texts = []
+    text = encode(obj)
+    if texts:
+        if isinstance(text, unicode):
+            texts = [t.decode('utf-8') for t in texts]
+        text = _RAW_PLACEHOLDER.sub(lambda m: texts[int(m.group(1))], text)
+    return text
+
+
+def loads(s):
+    return (_selected or _select())[1].loads(s)
+
+
+### Raw JSON
+
+# `RawJSON` is text that is already JSON, like a stored `JsonProperty`
+# value.  `dumps` puts it into its output as it is rather than decoding
+# and encoding it again:
+#
+#      codec.dumps({'settings': codec.RawJSON('{"theme":"dark"}')})
+#
+# The JSON libraries themselves do not know it, so documents holding
+# one have to be encoded with `dumps`.
+class RawJSON(object):
+
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        self.text = text
+
+    def __json__(self):
+        return self.text
+
+    def __eq__(self, other):
+        return isinstance(other, RawJSON) and other.text == self.text
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'RawJSON(%r)' % self.text
+
+
+# A `RawJSON` is first encoded as a placeholder string, which is then
+# replaced by its text.  Placeholders hold a random token so that no
+# string in the document can pass for one.
+_RAW_TOKEN = binascii.hexlify(os.urandom(8))
+_RAW_PLACEHOLDER = re.compile(r'"\\u0000%s:(\d+)"' % _RAW_TOKEN)
+_raw_local = threading.local()
+
+
+def _raw_default(obj):
+    if isinstance(obj, RawJSON):
+        texts = _raw_local.texts
+        texts.append(obj.text)
+        return u'\x00%s:%d' % (_RAW_TOKEN, len(texts) - 1)
+    raise TypeError('%r is not JSON serializable' % (obj,))
+
+
+### Incremental Decoding
+
+# `iter_array` decodes a JSON array from a file-like `read` function
+# and yields its elements one at a time, so a large array never has to
+# be held in memory as text and as values at once.  Only the unparsed
+# remainder of the text is kept.  The standard library's decoder is
+# used since it is the one that can decode a value in the middle of a
+# string.
+#
+# An element that spans reads is decoded again once more text has
+# arrived.  Reads grow with the element so this stays linear in its
+# size.  A number might continue in the next read when it ends at the
+# end of the text read so far, or where a read split it after its `.`
+# or `e` (`raw_decode` takes the `1` of `1.` for a whole number), so
+# one followed by nothing or by a character numbers are made of is
+# decoded again after another read.
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_NUMBER_CHARACTERS = frozenset(u'0123456789+-.eE')
+
+
+class _Text(object):
+
+    def __init__(self, read, chunk_size):
+        self.read = read
+        self.chunk_size = chunk_size
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.text = u''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size=None):
+        if self.eof:
+            return False
+        chunk = self.read(max(size or 0, self.chunk_size))
+        self.eof = not chunk
+        self.text = self.text[self.pos:] + self.utf8.decode(chunk, self.eof)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            self.pos = _WHITESPACE.match(self.text, self.pos).end()
+            if self.pos < len(self.text) or not self.fill():
+                return self.text[self.pos:self.pos + 1]
+
+    def value(self, raw_decode):
+        self.peek()
+        while True:
+            try:
+                value, end = raw_decode(self.text, self.pos)
+            except ValueError:
+                if not self.fill(len(self.text)):
+                    raise
+                continue
+            following = self.text[end:end + 1]
+            if isinstance(value, (int, long, float)) and \
+                    (not following or following in _NUMBER_CHARACTERS) and \
+                    self.fill(len(self.text)):
+                continue
+            self.pos = end
+            return value
+
+
+def iter_array(read, chunk_size=64 * 1024):
+    try:
+        json = importlib.import_module('json')
+    except ImportError:
+        json = importlib.import_module('django.utils.simplejson')
+    raw_decode = json.JSONDecoder().raw_decode
+    text = _Text(read, chunk_size)
+
+    if text.peek() != u'[':
+        raise ValueError('Expected a JSON array')
+    text.pos += 1
+    if text.peek() == u']':
+        text.pos += 1
+    else:
+        while True:
+            yield text.value(raw_decode)
+            c = text.peek()
+            text.pos += 1
+            if c == u']':
+                break
+            if c != u',':
+                raise ValueError('Expected , or ] in JSON array')
+    if text.peek():
+        raise ValueError('Extra data after JSON array')
@@ -38,17 +38,21 @@
 # accomplished with simple subclassing.
 import logging
 import sys
-import inspect
+import math
+import time
+import hashlib
+import bisect
+import threading
+import collections
 from mora import db
 
+# JSON goes through mora's codec, which picks the fastest JSON library
+# available (see `mora.db.codec`).
+codec = db.codec
+
 # GAE supports a couple of versions of Python and the GAE environment.
 # We will try to use the latest modules and then use `ImportError`
 # exceptions to select older variations.
-try:
-    import json
-except ImportError:
-    from django.utils import simplejson as json
-
 try:
     import webapp2 as webapp
 except ImportError:
@@ -67,11 +71,20 @@ except ImportError:
 #      @rest_index("courses")
 #      def course_list(self):
 #          # return the courses..
-def rest_index(keyword):
+#
+# An index can be given the `Cache-Control` policy and `Vary` header of
+# its responses (see `cache_control` below):
+#
+#      @rest_index("courses", cache="public, max-age=60")
+def rest_index(keyword, cache=None, vary=None):
     def wrap(f):
         def wrapped(*args, **kwargs):
             return f(*args, **kwargs)
         setattr(wrapped, "_mora_verb", ("GET " + keyword, f.func_name))
+        if cache is not None:
+            setattr(wrapped, "_mora_cache", (cache, vary))
+        elif hasattr(f, "_mora_cache"):
+            setattr(wrapped, "_mora_cache", f._mora_cache)
         return wrapped
     return wrap
 
@@ -108,6 +121,24 @@ def rest_action(keyword):
     return wrap
 
 
+# `cache_control` sets the caching policy of any GET action, including
+# `show`:
+#
+#      @cache_control("public, max-age=300", vary="Accept-Language")
+#      def show(self):
+#          # show the course..
+#
+# Successful GET responses get the policy of their action, or else the
+# handler's `cache` attribute (`show_cache` for `show`), unless the
+# action set a `Cache-Control` header itself.  Errors and responses to
+# other verbs are always sent with `Cache-Control: no-store`.
+def cache_control(cache, vary=None):
+    def wrap(f):
+        setattr(f, "_mora_cache", (cache, vary))
+        return f
+    return wrap
+
+
 ### Dispatcher Exceptions
 
 # DispatchErrors may be thrown when something goes wrong and will be
@@ -117,14 +148,251 @@ def rest_action(keyword):
 #
 # * 400: InvalidHttpVerb
 # * 400: InvalidUri
+# * 400: InvalidPatch
+# * 400: InvalidJson
+# * 400: InvalidSyncToken
+# * 400: InvalidCursor
 # * 404: ResourceNotFound
 # * 405: UnsupportedHttpVerb
+# * 413: RequestEntityTooLarge
+# * 416: RequestedRangeNotSatisfiable
+# * 429: TooManyRequests
+# * 503: ServiceUnavailable
+#
+# `headers` are added to the error response.
 class DispatchError(Exception):
 
-    def __init__(self, code=None, message=None):
+    def __init__(self, code=None, message=None, headers=None):
         super(DispatchError, self).__init__()
         self.code = code
         self.message = message
+        self.headers = headers
+
+### Route Metrics
+
+# The dispatcher keeps a latency histogram for every route it serves,
+# where a route is the HTTP verb, the kind of the addressed model and
+# the keyword.  Requests that fail before the keyword is matched to an
+# action have an empty kind and keyword, and those for a keyword the
+# handler does not know have the keyword `unknown`.  Observing a
+# request is a dictionary lookup, a bisect and an increment under a
+# lock, so this is cheap enough to leave on.  The histograms can be
+# exported in the Prometheus [text format][prometheus] by
+# `MetricsHandler`.
+# [prometheus]: http://prometheus.io/docs/instrumenting/exposition_formats/ "Exposition formats"
+class LatencyHistogram(object):
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+
+class RouteMetrics(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+
+    def observe(self, route, seconds):
+        with self._lock:
+            histogram = self.histograms.get(route)
+            if histogram is None:
+                histogram = self.histograms[route] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+
+    def text(self):
+        name = 'mora_request_duration_seconds'
+        lines = ['# HELP %s Time spent dispatching REST requests.' % name,
+                 '# TYPE %s histogram' % name]
+        with self._lock:
+            for route in sorted(self.histograms):
+                histogram = self.histograms[route]
+                labels = 'verb="%s",kind="%s",keyword="%s"' % tuple(
+                    _escape_label(label) for label in route)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',),
+                                        histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket{%s,le="%s"} %d' %
+                                 (name, labels, bound, cumulative))
+                lines.append('%s_sum{%s} %r' % (name, labels, histogram.sum))
+                lines.append('%s_count{%s} %d' %
+                             (name, labels, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value):
+    return unicode(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+### Admission Control
+
+# When an instance is overloaded it is better to turn some requests
+# away at once than to let every request wait for a thread until they
+# all time out.  The dispatcher admits a request before it loads the
+# addressed model, using limits configured on `RestDispatcher`:
+#
+#      class Dispatcher(RestDispatcher):
+#          max_in_flight = 40
+#          concurrency_limits = {'GET courses': 8, 'POST': 10}
+#          rate_limits = {'POST like': (5, 20)}
+#
+# Limits are keyed by verb and keyword, like `'GET courses'` or
+# `'PUT __self__'`, or by verb alone.  A request over a concurrency
+# limit, or over `max_in_flight` requests in the instance, gets a 503
+# with a `Retry-After` header.  A rate limit is a token bucket of a
+# rate per second and an optional burst, and a request that finds it
+# empty gets a 429 with the time until the next token.  Rejections are
+# counted and exported by `MetricsHandler`.
+class ConcurrencyLimit(object):
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self.active >= self.limit:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    # Takes a token and returns 0, or returns the seconds until there
+    # is one.
+    def take(self):
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    # Gives back a token taken for a request that was turned away after
+    # all.
+    def refund(self):
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+
+
+class Admission(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.limiters = {}
+        self.rejections = collections.defaultdict(int)
+
+    # Limiters are made on first use and again when their setting
+    # changes.
+    def _limiter(self, key, setting, factory):
+        with self._lock:
+            limiter = self.limiters.get((key, setting))
+            if limiter is None:
+                if isinstance(setting, tuple):
+                    limiter = factory(*setting)
+                else:
+                    limiter = factory(setting)
+                self.limiters[(key, setting)] = limiter
+            return limiter
+
+    # Rejections are counted by the limit that was hit rather than by
+    # the request's keyword, which the client chooses.
+    def _reject(self, limit, reason):
+        with self._lock:
+            self.rejections[(limit, reason)] += 1
+
+    # Returns the concurrency limits the request holds, which have to be
+    # given back to `release`, or raises a `DispatchError`.  Concurrency
+    # is checked before any tokens are taken, and the tokens of a
+    # request that another rate limit turns away are refunded, so a
+    # rejected request leaves every bucket as it was.
+    def admit(self, dispatcher, verb, keyword):
+        keys = (verb + ' ' + keyword, verb)
+        limits = [('*', dispatcher.max_in_flight)]
+        limits.extend((key, dispatcher.concurrency_limits.get(key))
+                      for key in keys)
+        acquired = []
+        for key, limit in limits:
+            if limit is None:
+                continue
+            limiter = self._limiter(('concurrency', key), limit,
+                                    ConcurrencyLimit)
+            if not limiter.acquire():
+                self.release(acquired)
+                self._reject(key, 'concurrency')
+                raise DispatchError(
+                    503, "ServiceUnavailable",
+                    {'Retry-After': str(dispatcher.retry_after)})
+            acquired.append(limiter)
+
+        taken = []
+        for key in keys:
+            rate = dispatcher.rate_limits.get(key)
+            if rate is None:
+                continue
+            bucket = self._limiter(('rate', key), rate, TokenBucket)
+            wait = bucket.take()
+            if wait:
+                for other in taken:
+                    other.refund()
+                self.release(acquired)
+                self._reject(key, 'rate')
+                raise DispatchError(429, "TooManyRequests",
+                                    {'Retry-After': str(int(math.ceil(wait)))})
+            taken.append(bucket)
+        return acquired
+
+    def release(self, acquired):
+        for limiter in acquired:
+            limiter.release()
+
+    def reset(self):
+        with self._lock:
+            self.limiters = {}
+            self.rejections = collections.defaultdict(int)
+
+    def text(self):
+        name = 'mora_rejected_requests_total'
+        lines = ['# HELP %s Requests turned away by admission control.' % name,
+                 '# TYPE %s counter' % name]
+        with self._lock:
+            for labels in sorted(self.rejections):
+                lines.append('%s{limit="%s",reason="%s"} %d' %
+                             ((name,) + tuple(_escape_label(label)
+                                              for label in labels) +
+                              (self.rejections[labels],)))
+        return '\n'.join(lines) + '\n'
+
 
 ### REST Dispatcher
 
@@ -135,6 +403,31 @@ class RestDispatcher(webapp.RequestHandler):
     base_path = ""
     rest_handlers = {}
 
+    # Each request is timed phase by phase.  The phases are reported in
+    # a `Server-Timing` header and the total goes into the per-route
+    # histograms in `metrics`.
+    timing = True
+    metrics = RouteMetrics()
+
+    # Each request also counts its datastore RPCs in `rpcs`, which warns
+    # about (or in strict mode fails on) N+1 access patterns.  Turning
+    # on `rpc_call_sites` attributes every RPC to the code that made it,
+    # at the cost of walking the stack for each one.
+    rpc_accounting = True
+    rpc_call_sites = False
+
+    # Entities loaded during a request are kept in a `db.IdentityMap`
+    # so that loading one again, or dereferencing a reference to it,
+    # does not cost another RPC.  The map is dropped with the request.
+    identity_map = True
+
+    # Admission control, see above.  No limits are set by default.
+    max_in_flight = None
+    concurrency_limits = {}
+    rate_limits = {}
+    retry_after = 1
+    admission = Admission()
+
 
     # We setup the dispatcher with a path it should use and a list of
     # RestHandlers connected to specific models.
@@ -152,6 +445,33 @@ class RestDispatcher(webapp.RequestHandler):
         return (cls.base_path + "/.*", RestDispatcher)
 
 
+    # webapp2 answers verbs outside of an application's
+    # `allowed_methods` with a 501 before we ever see the request, so
+    # PATCH has to be allowed by the application that mounts us.
+    # `application` builds one that allows it, with our route after
+    # `routes`:
+    #
+    #      app = RestDispatcher.application([('/_mora/metrics',
+    #                                         MetricsHandler)])
+    #
+    # An application built some other way can be given to
+    # `allow_patch`.  Clients of one that is not can still POST with
+    # `_method=PATCH`.
+    @classmethod
+    def application(cls, routes=(), **kwargs):
+        application = webapp.WSGIApplication(list(routes) + [cls.route()],
+                                             **kwargs)
+        return cls.allow_patch(application)
+
+
+    @classmethod
+    def allow_patch(cls, application):
+        allowed = getattr(application, 'allowed_methods', None)
+        if allowed is not None:
+            application.allowed_methods = allowed.union(('PATCH',))
+        return application
+
+
     @classmethod
     def connect(cls, rest_handler):
         model = rest_handler.model
@@ -159,26 +479,65 @@ class RestDispatcher(webapp.RequestHandler):
         # classes. This allows us to emulate polymorphic handlers
         # without ambiguity.
         if hasattr(model, '__iter__'):
-            for m in model:
-                cls.rest_handlers[m.class_name()] = rest_handler
+            models = list(model)
         else:
-            cls.rest_handlers[model.class_name()] = rest_handler
+            models = [model]
+        for m in models:
+            cls.rest_handlers[m.class_name()] = rest_handler
+
+            # Binary properties served as URLs point at this dispatcher.
+            for prop in m.properties().itervalues():
+                if getattr(prop, 'as_url', False):
+                    prop.url_template = (cls.base_path +
+                                         '/%(id)s/_blob/%(name)s')
+
+        # Scanning the handler for its actions is deferred until the
+        # first request that needs them so that `setup` stays cheap on
+        # a cold instance.  Reconnecting a handler rescans it.
+        if '_mora_verbs' in rest_handler.__dict__:
+            delattr(rest_handler, '_mora_verbs')
+
+
+    # When we dispatch to a RestHandler subclass for the first time we
+    # scan its methods looking for methods that were decorated as rest
+    # actions.  We walk the class dictionaries rather than using
+    # `inspect.getmembers`, which would resolve every attribute of the
+    # class.  The most derived definition of each name wins, so an
+    # undecorated override removes an inherited action.
+    @classmethod
+    def verbs(cls, rest_handler):
+        verbs = rest_handler.__dict__.get('_mora_verbs')
+        if verbs is not None:
+            return verbs
+
+        members = {}
+        for klass in reversed(rest_handler.__mro__):
+            members.update(klass.__dict__)
 
         verbs = {}
-        # When we connect RestHandler subclasses to this class we also
-        # scan their methods looking for methods that were decorated
-        # as rest actions.
-        for k, v in inspect.getmembers(rest_handler):
+        for k, v in members.iteritems():
             if hasattr(v, "_mora_verb"):
                 verbs.update([getattr(v, "_mora_verb")])
 
         # We also include the standard rest methods.
         verbs.update({"GET __self__": "show",
                       "DELETE __self__": "destroy",
-                      "PUT __self__": "update"})
+                      "PUT __self__": "update",
+                      "PATCH __self__": "patch"})
 
         # We then attach this list of actions to the class.
         setattr(rest_handler, "_mora_verbs", verbs)
+        return verbs
+
+
+    # `warmup` scans every connected handler now rather than on its
+    # first request and returns the number of handlers scanned.
+    @classmethod
+    def warmup(cls):
+        handlers = set(cls.rest_handlers.values())
+        for rest_handler in handlers:
+            cls.verbs(rest_handler)
+        return len(handlers)
 
 
     def __init__(self, request=None, response=None):
@@ -205,18 +564,59 @@ class RestDispatcher(webapp.RequestHandler):
         self.action('POST')
 
 
+    def patch(self, *_):
+        self.action('PATCH')
+
+
     def action(self, act, exceptions=False):
 
         # The action method handles exceptions by recursively calling
         # itself such that we have one spot that we can catch
-        # `DispatchError`s.
+        # `DispatchError`s.  This is also where a request's timer is
+        # started and its measurements are reported.
         if not exceptions:
+            self._mora_route = (act, "", "")
+            timer = None
+            if self.timing:
+                timer = db.start_timer()
+            self.rpcs = None
+            if self.rpc_accounting:
+                self.rpcs = db.RpcCounter(
+                    call_sites=self.rpc_call_sites).start()
+            identity_map = None
+            if self.identity_map:
+                identity_map = db.IdentityMap().start()
+            self._mora_admitted = None
+            self._mora_cache = None
+            # webapp2 starts every response with `Cache-Control:
+            # no-cache`.  It is taken out so that a header found after
+            # the action is one the action set.
+            self._mora_default_cache = self.response.headers.pop(
+                'Cache-Control', None)
             try:
                 self.action(act, exceptions=True)
+                self._cache_headers()
             except DispatchError as error:
                 self.response.status = error.code
                 self.response.content_type = 'application/json'
-                self.response.out.write(json.dumps({"error": error.message}))
+                for name, value in (error.headers or {}).iteritems():
+                    self.response.headers[name] = value
+                self.response.headers['Cache-Control'] = 'no-store'
+                self.response.out.write(codec.dumps({"error": error.message}))
+            finally:
+                if self._mora_admitted is not None:
+                    self.admission.release(self._mora_admitted)
+                if identity_map is not None:
+                    identity_map.stop()
+                if self.rpcs is not None:
+                    self.rpcs.stop()
+                    logging.debug('%s %s made datastore calls %r',
+                                  act, self.request.path,
+                                  dict(self.rpcs.counts))
+                if timer is not None:
+                    db.stop_timer()
+                    self.metrics.observe(self._mora_route, timer.finish())
+                    self.response.headers['Server-Timing'] = timer.header()
             return
 
         # We also support a special `_method` argument to change the
@@ -225,8 +625,9 @@ class RestDispatcher(webapp.RequestHandler):
         # other oddball cases.
         if self.request.get("_method"):
             act = self.request.get("_method")
-            if not(act in ["GET", "POST", "DELETE", "PUT"]):
+            if not(act in ["GET", "POST", "DELETE", "PUT", "PATCH"]):
                 raise DispatchError(400, "InvalidHttpVerb")
+            self._mora_route = (act, "", "")
 
         # In order to respond to a request, we have to build a path
         # and remove the `base_path` prefix from it.
@@ -236,12 +637,26 @@ class RestDispatcher(webapp.RequestHandler):
         path = list(path.split('/'))
         path.reverse()
 
-        # The key is now the first element in the path.
+        # The key is now the first element in the path.  If nothing
+        # follows the key, we assume the action is on the current object
+        # ("__self__").  Otherwise we capture a keyword that represents a
+        # path or alternate action to take.
         key = path.pop()
+        if len(path) == 0:
+            keyword = "__self__"
+        else:
+            keyword = path.pop()
+
+        # The request is admitted before it costs any datastore calls.
+        self._mora_admitted = self.admission.admit(self, act, keyword)
 
-        # We obtain the model instance from the key.
+        # We obtain the model instance from the key.  Key strings are
+        # decoded through mora's shared key cache.
         try:
-            model = db.get(key)
+            with db.timed('key'):
+                key = db.str_to_key(key)
+            with db.timed('get'):
+                model = db.get(key)
         except db.BadKeyError:
             raise DispatchError(404, "ResourceNotFound")
 
@@ -252,35 +667,181 @@ class RestDispatcher(webapp.RequestHandler):
 
         # We then can use the model to create an appropriate handler.
         if model_name in self.rest_handlers:
-            rest_handler = self.rest_handlers[model_name](model, self.request, self.response)
-            rest_handler.setup()
+            with db.timed('setup'):
+                rest_handler = self.rest_handlers[model_name](model, self.request, self.response)
+                rest_handler.rpcs = self.rpcs
+                rest_handler.setup()
         else:
             raise DispatchError(404, "ResourceNotFound")
 
-        # If nothing follows the key, we assume the action is on the
-        # current object ("__self__").  Otherwise we capture a keyword
-        # that represents a path or alternate action to take.
-        if len(path) == 0:
-            keyword = "__self__"
-        else:
-            keyword = path.pop()
-            if len(path) != 0:
-                raise DispatchError(400, "InvalidUri")
+        # Binary properties created with `as_url=True` are served as
+        # raw bytes from `<key>/_blob/<property>`.  They are part of the
+        # model's representation, so only handlers that implement `show`
+        # serve them.
+        if keyword == "_blob" and len(path) == 1:
+            self._mora_route = (act, model_name, keyword)
+            if act != 'GET' or \
+                    type(rest_handler).show.im_func is RestHandler.show.im_func:
+                raise DispatchError(405, "UnsupportedHttpVerb")
+            with db.timed('handler'):
+                self._serve_blob(rest_handler, path.pop())
+            return
+
+        if len(path) != 0:
+            raise DispatchError(400, "InvalidUri")
 
         # We then use the HTTP verb and keyword to lookup the method
-        # to call.
+        # to call.  The handler phase includes any serialization the
+        # handler does, which is also reported on its own.  The keyword
+        # comes from the client, so requests for keywords the handler
+        # does not know share one route rather than each adding a
+        # histogram.
         action_key = act + ' ' + keyword
-        if action_key in rest_handler._mora_verbs:
-            action_method = rest_handler._mora_verbs[action_key]
+        verbs = self.verbs(type(rest_handler))
+        if action_key not in verbs:
+            self._mora_route = (act, model_name, "unknown")
+            raise DispatchError(405, "UnsupportedHttpVerb")
+        self._mora_route = (act, model_name, keyword)
+        action_method = verbs[action_key]
+        self._mora_cache = rest_handler.cache_policy(action_method)
+        with db.timed('handler'):
             result = getattr(rest_handler, action_method)()
+
+
+    # The bytes are sent with a strong ETag, so clients can revalidate
+    # with `If-None-Match` and resume with `Range` and `If-Range`.  The
+    # caching policy is the one of the handler's `show`.  The value is
+    # read through the property rather than in its stored form, which
+    # for a `CompressedBlobProperty` is compressed.
+    def _serve_blob(self, rest_handler, name):
+        model = rest_handler.model
+        prop = model.properties().get(name)
+        if not getattr(prop, 'as_url', False):
+            raise DispatchError(404, "ResourceNotFound")
+        value = prop.__get__(model, type(model))
+        if value is None:
+            raise DispatchError(404, "ResourceNotFound")
+
+        etag = '"%s"' % hashlib.md5(value).hexdigest()
+        headers = self.response.headers
+        headers['ETag'] = etag
+        headers['Accept-Ranges'] = 'bytes'
+        self._mora_cache = rest_handler.cache_policy('show')
+
+        matches = [tag.strip() for tag in
+                   self.request.headers.get('If-None-Match', '').split(',')]
+        if etag in matches or '*' in matches:
+            self.response.status = 304
+            return
+
+        byte_range = None
+        if self.request.headers.get('If-Range', etag) == etag:
+            byte_range = _byte_range(self.request.headers.get('Range'),
+                                     len(value))
+        self.response.content_type = prop.content_type
+        if byte_range is not None:
+            start, end = byte_range
+            self.response.status = 206
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end,
+                                                           len(value))
+            value = value[start:end + 1]
+        self.response.out.write(value)
+
+    # The caching headers of a response the action did not turn into an
+    # error.  The route's verb is the one after any `_method` override.
+    def _cache_headers(self):
+        headers = self.response.headers
+        if self.response.status_int >= 400 or self._mora_route[0] != 'GET':
+            headers['Cache-Control'] = 'no-store'
+            return
+        if 'Cache-Control' in headers:
+            return
+        cache, vary = self._mora_cache or (None, None)
+        if cache:
+            headers['Cache-Control'] = cache
+        elif self._mora_default_cache:
+            headers['Cache-Control'] = self._mora_default_cache
+        if vary:
+            if headers.get('Vary'):
+                vary = headers['Vary'] + ', ' + vary
+            headers['Vary'] = vary
+
+
+# The `(start, end)` of a single byte range, or `None` for the whole
+# value.  Multiple ranges are answered with the whole value, which the
+# RFC allows.  A range that ends before it starts is invalid and, like
+# any header we cannot parse, ignored.
+def _byte_range(header, size):
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start, _, end = header[len('bytes='):].strip().partition('-')
+    try:
+        if start:
+            start = int(start)
+            if end and int(end) < start:
+                return None
+            end = min(int(end), size - 1) if end else size - 1
         else:
-            raise DispatchError(405, "UnsupportedHttpVerb")
+            start = max(0, size - int(end))
+            end = size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise DispatchError(416, "RequestedRangeNotSatisfiable",
+                            {'Content-Range': 'bytes */%d' % size})
+    return start, end
+
+
+### Metrics Handler
+
+# `MetricsHandler` exports the dispatcher's route histograms and
+# rejections, the key cache statistics and the reads
+# `db.single_flight` coalesced in the Prometheus text format.  Mount it
+# next to the dispatcher, preferably behind `login: admin`:
+#
+#      app = RestDispatcher.application([('/_mora/metrics',
+#                                         MetricsHandler)])
+class MetricsHandler(webapp.RequestHandler):
+
+    dispatcher = RestDispatcher
+
+    def get(self, *_):
+        lines = [self.dispatcher.metrics.text(),
+                 self.dispatcher.admission.text()]
+        stats = db.key_cache.stats()
+        for name in ('hits', 'misses', 'size'):
+            lines.append('# TYPE mora_key_cache_%s gauge\n'
+                         'mora_key_cache_%s %d\n' % (name, name, stats[name]))
+        stats = db.single_flight.stats()
+        for name in ('calls', 'coalesced', 'timeouts'):
+            lines.append('# TYPE mora_single_flight_%s counter\n'
+                         'mora_single_flight_%s %d\n' %
+                         (name, name, stats[name]))
+        self.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+        self.response.out.write(''.join(lines))
+
+### Warmup Handler
+
+# `WarmupHandler` runs `mora.warmup` and answers with its report as
+# JSON.  App Engine sends `/_ah/warmup` requests to new instances when
+# the `warmup` inbound service is enabled in app.yaml:
+#
+#      app = RestDispatcher.application([('/_ah/warmup', WarmupHandler)])
+#
+# Mount it after `RestDispatcher.setup` so the handlers are connected.
+class WarmupHandler(webapp.RequestHandler):
+
+    def get(self, *_):
+        import mora
+        report = mora.warmup()
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(codec.dumps(report))
 
 ### RestHandler
 
 # The RestHandler is attached to the model, request, and response.
-# You can override the provided `show`, `update` and `delete` methods
-# or create new methods.
+# You can override the provided `show`, `update`, `patch` and `delete`
+# methods or create new methods.
 #
 # RestHandler has these properties:
 #
@@ -292,9 +853,24 @@ class RestDispatcher(webapp.RequestHandler):
 #             "application/x-www-form-urlencoded" or
 #             "multipart/form-data"
 #   * body: the decoded body
+#   * rpcs: the `db.RpcCounter` counting this request's datastore
+#           calls, or None when RPC accounting is off
+#
+# Bodies larger than `max_body_size` bytes are refused with a 413
+# before they are parsed.  The default of `None` accepts any size.
+#
+# `cache` and `vary` are the caching policy of GET actions that have
+# none of their own, and `show_cache` that of `show`.  By default
+# `show` may be kept by the browser but has to be revalidated, and
+# other GET actions keep webapp's default `Cache-Control` header.
 class RestHandler(object):
 
     _mora_verbs = {}
+    rpcs = None
+    max_body_size = None
+    cache = None
+    show_cache = "private, no-cache"
+    vary = None
 
     params = property(lambda self: self.request.params)
 
@@ -303,18 +879,170 @@ class RestHandler(object):
         self.request = request
         self.response = response
 
+    # The `(cache, vary)` policy of an action method.
+    def cache_policy(self, action_method):
+        method = getattr(type(self), action_method, None)
+        policy = getattr(method, '_mora_cache', None)
+        if policy is not None:
+            return policy
+        if action_method == 'show':
+            return (self.show_cache, self.vary)
+        return (self.cache, self.vary)
+
+    # TODO: startswith or contains?
+    def _json_body(self):
+        content_type = self.request.content_type
+        # A merge patch is plain JSON with its own media-type.
+        return content_type.startswith('application/json') or \
+            content_type.startswith('application/merge-patch+json')
+
+    def _check_body_size(self, size):
+        if self.max_body_size is not None and size > self.max_body_size:
+            raise DispatchError(413, "RequestEntityTooLarge")
+
+    # The body is decoded once per request and then reused.
     @property
     def body(self):
-        # TODO: startswith or contains?
-        if self.request.content_type.startswith('application/json'):
-            return json.loads(self.request.body)
+        try:
+            return self.__dict__['_mora_body']
+        except KeyError:
+            pass
+
+        body = {}
+        if self._json_body():
+            self._check_body_size(self.request.content_length or 0)
+            text = self.request.body
+            self._check_body_size(len(text))
+            try:
+                body = codec.loads(text)
+            except ValueError:
+                raise DispatchError(400, "InvalidJson")
 
         # TODO: decode other media-types?
-        return {}
+        self._mora_body = body
+        return body
+
+    # `iter_body` yields the elements of a JSON array body one at a
+    # time as they are read from the request, or lists of up to
+    # `batch_size` elements when that is given, so a bulk upload can be
+    # written in batches without holding all of it in memory:
+    #
+    #      @rest_create("students")
+    #      def create_students(self):
+    #          for batch in self.iter_body(batch_size=100):
+    #              students = [Student() for _ in batch]
+    #              for student, data in zip(students, batch):
+    #                  student.from_json(data, save=False)
+    #              db.put(students)
+    #
+    # If `body` was already read its elements are yielded from there.
+    def iter_body(self, batch_size=None):
+        elements = self._iter_body()
+        if batch_size is None:
+            return elements
+        return self._batches(elements, batch_size)
+
+    def _iter_body(self):
+        if '_mora_body' in self.__dict__:
+            body = self._mora_body
+            if not isinstance(body, list):
+                raise DispatchError(400, "InvalidJson")
+            for element in body:
+                yield element
+            return
+
+        if not self._json_body():
+            return
+        self._check_body_size(self.request.content_length or 0)
+        read = self.request.body_file.read
+        consumed = [0]
+
+        def bounded_read(size):
+            chunk = read(size)
+            consumed[0] += len(chunk)
+            self._check_body_size(consumed[0])
+            return chunk
+
+        elements = codec.iter_array(bounded_read)
+        while True:
+            try:
+                element = next(elements)
+            except StopIteration:
+                return
+            except ValueError:
+                raise DispatchError(400, "InvalidJson")
+            yield element
+
+    def _batches(self, elements, batch_size):
+        batch = []
+        for element in elements:
+            batch.append(element)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
 
     def setup(self):
         pass
 
+    # `write_changes` answers a delta sync request (see
+    # `db.changes_since`).  The client passes the token from its last
+    # sync as `?since=` and gets back the changed models, the ids of
+    # deleted ones and the next token:
+    #
+    #      @rest_index("courses")
+    #      def course_list(self):
+    #          self.write_changes(Course, student=self.model)
+    def write_changes(self, model_class, limit=500, **filters):
+        since = self.request.get('since') or None
+        try:
+            changes = db.changes_since(model_class, since, limit=limit,
+                                       **filters)
+        except db.BadValueError:
+            raise DispatchError(400, "InvalidSyncToken")
+        changes['changed'] = [m.as_json() for m in changes['changed']]
+        self.response.content_type = 'application/json'
+        self.response.out.write(codec.dumps(changes))
+
+    # `fields` is the list of properties named by a `?fields=`
+    # parameter, or None when the client wants whole models.
+    @property
+    def fields(self):
+        fields = [f.strip() for f in self.request.get('fields').split(',')]
+        return [f for f in fields if f] or None
+
+    # `write_page` answers a paginated index request with up to `limit`
+    # models of `query`, a `db.Query`, and the cursor of the next page:
+    #
+    #      @rest_index("courses")
+    #      def course_list(self):
+    #          self.write_page(Course.all().filter('student =', self.model))
+    #
+    # The client passes the cursor back as `?cursor=`.  With
+    # `?fields=title,updated` only those properties are returned, read
+    # with a projection query where the model class allows it (see
+    # `db.Query.fetch_fields`).
+    def write_page(self, query, limit=20):
+        cursor = self.request.get('cursor') or None
+        fields = self.fields
+        try:
+            if cursor:
+                query.with_cursor(cursor)
+            if fields:
+                results = query.fetch_fields(fields, limit)
+            else:
+                results = query.fetch_json(limit)
+        except (db.BadValueError, db.BadRequestError):
+            if cursor:
+                raise DispatchError(400, "InvalidCursor")
+            raise
+        page = {'results': results, 'cursor': None}
+        if len(results) == limit:
+            page['cursor'] = query.cursor()
+        self.response.content_type = 'application/json'
+        self.response.out.write(codec.dumps(page))
+
     # REST methods should be very lightweight.  Use the `as_json`
     # method to push business logic into the model.  Here are some
     # example implementations for each method:
@@ -333,6 +1061,26 @@ class RestHandler(object):
     def update(self):
         raise DispatchError(405, "UnsupportedHttpVerb")
 
+    # A PATCH carries an [RFC 7386][rfc7386] merge patch.  Only the
+    # properties named in the patch are deserialized and the model is
+    # only written when one of them actually changed.  Because JSON
+    # `null` removes a member, the patch must be an object.
+    # [rfc7386]: http://tools.ietf.org/html/rfc7386 "JSON Merge Patch"
+    #
+    # Example:
+    #
+    #     def patch(self):
+    #         self.merge_patch()
+    #         self.response.out.write(self.model.to_json())
+    def patch(self):
+        raise DispatchError(405, "UnsupportedHttpVerb")
+
+    def merge_patch(self, include=None, exclude=None):
+        patch = self.body
+        if not isinstance(patch, dict):
+            raise DispatchError(400, "InvalidPatch")
+        return self.model.merge_patch(patch, include=include, exclude=exclude)
+
     # Example:
     #
     #     def destroy(self):
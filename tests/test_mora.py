@@ -1,9 +1,25 @@
+import io
+import os
+import sys
+import gzip
+import time
+import json
+import base64
+import shutil
+import hashlib
+import tempfile
 import unittest
 import datetime
+import threading
+import subprocess
 import iso8601
 
 import db
+from db import bulk
 from google.appengine.api import users
+from google.appengine.api import datastore
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import namespace_manager
 from google.appengine.ext import blobstore
 from google.appengine.ext import testbed
 
@@ -549,6 +565,15 @@ class MoraNonePropertiesTestCase(unittest.TestCase):
         self.assertEqual(none.blob, None)
         self.assertEqual(none.as_json()['blob'], None)
 
+        # serve the bytes from a URL
+        blob = db.BlobProperty(as_url=True, name='blob')
+        none.blob = 'insert a string'
+        url = '/%s/_blob/blob' % none.id
+        self.assertEqual(blob.as_json(none), url)
+        blob.from_json(none, url)
+        self.assertEqual(none.blob, 'insert a string')
+        none.blob = None
+
 
         ## Date
 
@@ -876,3 +901,2008 @@ class MoraNonePropertiesTestCase(unittest.TestCase):
         none.save()
         self.assertEqual(none.str_list, [])
         self.assertEqual(none.as_json()['str_list'], [])
+
+
+class MoraMergePatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+
+        # Then activate the testbed, which prepares the service stubs
+        # for use.
+        self.testbed.activate()
+
+        # Next, declare which service stubs you want to use.
+        self.testbed.init_datastore_v3_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testMergePatchFunction(self):
+        target = {'a': 'b', 'c': {'d': 'e', 'f': 'g'}}
+        patch = {'a': 'z', 'c': {'f': None}}
+        self.assertEqual(db.merge_patch(target, patch),
+                         {'a': 'z', 'c': {'d': 'e'}})
+        # the target is left alone
+        self.assertEqual(target, {'a': 'b', 'c': {'d': 'e', 'f': 'g'}})
+        self.assertEqual(db.merge_patch({'a': ['b']}, {'a': ['c']}),
+                         {'a': ['c']})
+        self.assertEqual(db.merge_patch({'a': 'b'}, ['c']), ['c'])
+
+    def testMergePatch(self):
+        widget = Widget()
+        widget.save()
+
+        changed = widget.merge_patch({'int_': 20,
+                                      'geopt': {'lat': 13.42},
+                                      'unknown': 1})
+        self.assertTrue(changed)
+        self.assertEqual(widget.int_, 20)
+        self.assertEqual(widget.geopt, db.GeoPt(13.42, 1.3))
+        self.assertEqual(widget.str_, 'word')
+
+        widget = Widget.get(widget.key())
+        self.assertEqual(widget.int_, 20)
+
+    def testMergePatchUnchanged(self):
+        widget = Widget()
+        widget.save()
+
+        changed = widget.merge_patch({'int_': 13,
+                                      'str_': 'word',
+                                      'id': 'ignored'})
+        self.assertFalse(changed)
+
+    def testMergePatchNull(self):
+        widget = Widget()
+        widget.save()
+
+        self.assertTrue(widget.merge_patch({'str_': None, 'list_': None}))
+        self.assertEqual(widget.str_, None)
+        self.assertEqual(widget.list_, [])
+
+
+class Scores(db.MoraModel):
+    scores = db.ListProperty(int, default=[])
+    calls = 0
+
+    @db.computed_property(db.IntegerProperty(), cache=True,
+                          depends=['scores'])
+    def total(self):
+        Scores.calls += 1
+        return sum(self.scores)
+
+
+class MoraComputedCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+
+        # Then activate the testbed, which prepares the service stubs
+        # for use.
+        self.testbed.activate()
+
+        # Next, declare which service stubs you want to use.
+        self.testbed.init_datastore_v3_stub()
+        Scores.calls = 0
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testCachedUntilDependencySet(self):
+        scores = Scores(scores=[1, 2, 3])
+        self.assertEqual(scores.total, 6)
+        self.assertEqual(scores.as_json()['total'], 6)
+        self.assertEqual(Scores.calls, 1)
+
+        scores.scores = [4]
+        self.assertEqual(scores.total, 4)
+        self.assertEqual(Scores.calls, 2)
+
+        scores.invalidate_computed()
+        self.assertEqual(scores.total, 4)
+        self.assertEqual(Scores.calls, 3)
+
+    def testCachedId(self):
+        scores = Scores()
+        self.assertEqual(scores.id, "")
+        scores.save()
+        self.assertEqual(scores.id, str(scores.key()))
+        self.assertEqual(Scores.get(scores.key()).id, str(scores.key()))
+
+
+class Article(db.MoraModel):
+    title = db.StringProperty()
+    tags = db.StringListProperty()
+    _json = db.MaterializedJsonProperty(version=1)
+
+
+class MoraMaterializedJsonTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+
+        # Then activate the testbed, which prepares the service stubs
+        # for use.
+        self.testbed.activate()
+
+        # Next, declare which service stubs you want to use.
+        self.testbed.init_datastore_v3_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testStoredCopy(self):
+        article = Article(title='Hello', tags=['a'])
+        article.save()
+        stored = Article.get(article.key())
+        self.assertTrue(stored._json.startswith('1.'))
+        self.assertFalse(article.id in stored._json)
+        self.assertFalse('_json' in stored.as_json())
+
+        text = stored.to_json()
+        self.assertTrue(article.id in text)
+        self.assertEqual(json.loads(text), stored.as_json())
+
+        # The copy is only used while it is current.
+        stored.title = 'Changed'
+        self.assertEqual(json.loads(stored.to_json())['title'], 'Changed')
+        stored.put()
+        self.assertEqual(json.loads(Article.get(article.key()).to_json()),
+                         stored.as_json())
+
+    def testEncoder(self):
+        # An encoder whose output differs from the standard library's in
+        # spacing and member order.
+        pretty = db.codec.Backend(
+            'pretty', lambda obj: json.dumps(obj, indent=2, sort_keys=True),
+            json.loads)
+        db.codec.register('pretty', lambda: pretty)
+        db.codec.configure(encoder='pretty')
+        try:
+            for article in (Article(title='Hello', tags=['a']), Article()):
+                article.save()
+                stored = Article.get(article.key())
+                self.assertTrue(
+                    Article._mora_materialized.stored_json(stored))
+                self.assertEqual(json.loads(stored.to_json()),
+                                 stored.as_json())
+        finally:
+            db.codec.BACKENDS[:] = [b for b in db.codec.BACKENDS
+                                    if b[0] != 'pretty']
+            db.codec.configure()
+
+        # A copy written by one encoder is used with another.
+        self.assertEqual(json.loads(stored.to_json()), stored.as_json())
+
+    def testVersion(self):
+        article = Article(title='Hello')
+        article.save()
+        stored = Article.get(article.key())
+        self.assertTrue(Article._mora_materialized.stored_json(stored))
+
+        Article._mora_materialized.version = 2
+        del Article._mora_json_shape
+        try:
+            self.assertEqual(Article._mora_materialized.stored_json(stored),
+                             None)
+            self.assertEqual(json.loads(stored.to_json()), stored.as_json())
+        finally:
+            Article._mora_materialized.version = 1
+            del Article._mora_json_shape
+
+
+class Journal(db.MoraModel):
+    name = db.StringProperty()
+
+
+class Entry(db.MoraModel):
+    title = db.StringProperty()
+    journal = db.ReferenceProperty(Journal)
+    updated = db.UpdatedProperty()
+
+
+class MoraDeltaSyncTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+
+        # Then activate the testbed, which prepares the service stubs
+        # for use.
+        self.testbed.activate()
+
+        # Next, declare which service stubs you want to use.
+        self.testbed.init_datastore_v3_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def changes(self, token, **kwargs):
+        return db.changes_since(Entry, token, settle=0, **kwargs)
+
+    def testChangesSince(self):
+        journal = Journal(name='mine')
+        journal.save()
+        other = Journal(name='other')
+        other.save()
+        entries = [Entry(title='%d' % i, journal=journal) for i in range(3)]
+        for entry in entries:
+            entry.save()
+        Entry(title='elsewhere', journal=other).save()
+
+        changes = self.changes(None, journal=journal)
+        self.assertEqual(len(changes['changed']), 3)
+        self.assertEqual(changes['deleted'], [])
+        token = changes['since']
+
+        self.assertEqual(self.changes(token, journal=journal)['changed'], [])
+
+        entries[1].title = 'changed'
+        entries[1].save()
+        deleted = entries[2].id
+        entries[2].delete()
+        changes = self.changes(token, journal=journal)
+        self.assertEqual([m.id for m in changes['changed']], [entries[1].id])
+        self.assertEqual(changes['deleted'], [deleted])
+        self.assertFalse(changes['more'])
+
+        changes = self.changes(changes['since'], journal=journal)
+        self.assertEqual(changes['changed'], [])
+        self.assertEqual(changes['deleted'], [])
+
+    def testPages(self):
+        for i in range(5):
+            Entry(title='%d' % i).save()
+        seen = []
+        token = None
+        while True:
+            changes = self.changes(token, limit=2)
+            seen.extend(m.title for m in changes['changed'])
+            token = changes['since']
+            if not changes['more']:
+                break
+        self.assertEqual(sorted(seen), ['0', '1', '2', '3', '4'])
+
+    def testDeleteByKey(self):
+        entry = Entry(title='gone')
+        entry.save()
+        token = self.changes(None)['since']
+        db.delete(entry.key())
+        self.assertEqual(self.changes(token)['deleted'], [entry.id])
+
+    def testRecreated(self):
+        entry = Entry(key_name='again', title='first')
+        entry.save()
+        token = self.changes(None)['since']
+        entry.delete()
+        Entry(key_name='again', title='second').save()
+        for since in (token, None):
+            changes = self.changes(since)
+            self.assertEqual([m.title for m in changes['changed']],
+                             ['second'])
+            self.assertEqual(changes['deleted'], [])
+
+    def testInvalidToken(self):
+        self.assertRaises(db.BadValueError, self.changes, 'garbage')
+
+
+class MoraKeyCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+
+        # Then activate the testbed, which prepares the service stubs
+        # for use.
+        self.testbed.activate()
+
+        # Next, declare which service stubs you want to use.
+        self.testbed.init_datastore_v3_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testEncodeDecode(self):
+        cache = db.KeyCache(size=2)
+        key = db.Key.from_path('Widget', 1)
+
+        self.assertEqual(cache.encode(key), str(key))
+        self.assertEqual(cache.encode(key), str(key))
+        self.assertEqual(cache.decode(str(key)), key)
+        self.assertEqual(cache.decode(unicode(key)), key)
+
+        stats = cache.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 3)
+
+        self.assertRaises(db.BadKeyError, cache.decode, 'not-a-key')
+
+    def testEviction(self):
+        cache = db.KeyCache(size=2)
+        keys = [db.Key.from_path('Widget', i) for i in range(1, 4)]
+        for key in keys:
+            cache.encode(key)
+        self.assertEqual(cache.stats()['size'], 2)
+
+        cache.encode(keys[0])
+        self.assertEqual(cache.stats()['hits'], 0)
+        cache.encode(keys[2])
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def testReferenceUsesCache(self):
+        base = Base()
+        base.save()
+        widget = Widget(reference=base)
+        widget.save()
+
+        db.key_cache.clear()
+        widget.as_json()
+        widget.as_json()
+        self.assertTrue(db.key_cache.stats()['hits'] > 0)
+
+
+class MoraTimingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+
+        # Then activate the testbed, which prepares the service stubs
+        # for use.
+        self.testbed.activate()
+
+        # Next, declare which service stubs you want to use.
+        self.testbed.init_datastore_v3_stub()
+
+    def tearDown(self):
+        db.stop_timer()
+        self.testbed.deactivate()
+
+    def testSerializePhase(self):
+        widget = Widget()
+        widget.save()
+
+        timer = db.start_timer()
+        widget.to_json()
+        widget.to_json()
+        self.assertTrue(db.stop_timer() is timer)
+        timer.finish()
+
+        self.assertEqual(timer.phases.keys(), ['serialize'])
+        header = timer.header()
+        self.assertTrue(header.startswith('serialize;dur='))
+        self.assertTrue(', total;dur=' in header)
+
+    def testNoTimer(self):
+        with db.timed('get') as phase:
+            pass
+        self.assertEqual(phase.timer, None)
+
+
+class MoraRpcCounterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+
+        # Then activate the testbed, which prepares the service stubs
+        # for use.
+        self.testbed.activate()
+
+        # Next, declare which service stubs you want to use.
+        self.testbed.init_datastore_v3_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testCounts(self):
+        b = B()
+        with db.RpcCounter() as rpcs:
+            b.put()
+            db.get(b.key())
+            b.a_set.fetch(10)
+            b.delete()
+        self.assertEqual(rpcs.put, 1)
+        self.assertEqual(rpcs.get, 1)
+        self.assertEqual(rpcs.query, 1)
+        self.assertEqual(rpcs.delete, 1)
+        self.assertEqual(db.current_rpc_counter(), None)
+
+    def testNested(self):
+        b = B()
+        b.put()
+        with db.RpcCounter() as outer:
+            with db.RpcCounter() as inner:
+                db.get(b.key())
+            db.get(b.key())
+        self.assertEqual(inner.get, 1)
+        self.assertEqual(outer.get, 2)
+
+    def testStrict(self):
+        b = B()
+        b.put()
+        for i in range(3):
+            A(b_ref=b).put()
+
+        def dereference_all():
+            for a in A.all().fetch(10):
+                # Each dereference is a separate get from the same line.
+                a.b_ref
+
+        with db.RpcCounter(threshold=2, strict=True):
+            self.assertRaises(db.TooManyRpcsError, dereference_all)
+
+        with db.RpcCounter(threshold=3, strict=True) as rpcs:
+            dereference_all()
+        self.assertEqual(rpcs.get, 3)
+
+    def testCallSites(self):
+        b = B()
+        b.put()
+
+        # Below the threshold no call site is looked up.
+        with db.RpcCounter(threshold=2) as rpcs:
+            db.get(b.key())
+            db.get(b.key())
+        self.assertEqual(rpcs.report()['sites'], [])
+
+        # Counted by kind, three gets from two places are too many.
+        with db.RpcCounter(threshold=2, strict=True):
+            db.get(b.key())
+            db.get(b.key())
+            self.assertRaises(db.TooManyRpcsError, db.get, b.key())
+
+        # Counted by call site, they are not.
+        with db.RpcCounter(threshold=2, strict=True,
+                           call_sites=True) as rpcs:
+            db.get(b.key())
+            for i in range(2):
+                db.get(b.key())
+        self.assertEqual(rpcs.get, 3)
+        self.assertEqual(sorted(site['count']
+                                for site in rpcs.report()['sites']), [1, 2])
+        for site in rpcs.report()['sites']:
+            self.assertTrue('test_mora.py' in site['site'], site['site'])
+
+
+class MoraWarmupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+
+        # Then activate the testbed, which prepares the service stubs
+        # for use.
+        self.testbed.activate()
+
+        # Next, declare which service stubs you want to use.
+        self.testbed.init_datastore_v3_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testWarmup(self):
+        widget = Widget()
+        widget.save()
+        before = widget.as_json()
+
+        self.assertTrue(db.warmup() >= 5)
+
+        self.assertTrue('_mora_json_properties' in Widget.__dict__)
+        self.assertTrue('_mora_item_property' in
+                        Widget.properties()['list_'].__dict__)
+        self.assertTrue(B.__dict__['a_set']._ReverseReferenceProperty__model
+                        is A)
+        self.assertTrue(db.class_for_kind('C') is C)
+        self.assertEqual(widget.as_json(), before)
+        self.assertEqual(set(widget.as_json(exclude=['list_'])),
+                         set(before) - set(['list_']))
+
+
+class MoraCodecTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+
+        # Then activate the testbed, which prepares the service stubs
+        # for use.
+        self.testbed.activate()
+
+        # Next, declare which service stubs you want to use.
+        self.testbed.init_datastore_v3_stub()
+
+    def tearDown(self):
+        db.codec.BACKENDS[:] = [b for b in db.codec.BACKENDS
+                                if b[0] != 'marker']
+        db.codec.configure()
+        self.testbed.deactivate()
+
+    def testSameOutput(self):
+        self.assertEqual(db.codec.dumps(db.codec.PROBE),
+                         json.dumps(db.codec.PROBE))
+        self.assertEqual(db.codec.loads(json.dumps(db.codec.PROBE)),
+                         db.codec.PROBE)
+        self.assertTrue(db.codec.compatible(db.codec.encoder()))
+
+    def testConfigure(self):
+        marker = db.codec.Backend('marker', lambda obj: 'marker',
+                                  lambda s: {'marker': True})
+        db.codec.register('marker', lambda: marker)
+        # The marker neither encodes nor decodes the probe like the
+        # standard library, so it is picked for neither direction.
+        self.assertTrue(db.codec.encoder() is not marker)
+        self.assertTrue(db.codec.decoder() is not marker)
+
+        widget = Widget()
+        widget.save()
+        db.codec.configure(encoder='marker')
+        self.assertEqual(widget.to_json(), 'marker')
+
+        self.assertRaises(ValueError, db.codec.configure, encoder='nope')
+
+    def testIterArray(self):
+        data = [{u'n': i, u's': u'caf\xe9 ' * i} for i in range(50)]
+        data += [12345, -1.5e10, u'x' * 1000, [], None]
+        text = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        for chunk_size in (1, 3, 64, 100000):
+            read = io.BytesIO(text).read
+            self.assertEqual(list(db.codec.iter_array(read, chunk_size)), data)
+
+        # Reads split the numbers at every offset, including right after
+        # a `.` or an `e`.
+        data = [1.5, 2e3, {u'a': 0.25}, -0.125e-3, 10, [7.75]]
+        text = json.dumps(data)
+        for chunk_size in range(1, len(text) + 1):
+            for offset in range(chunk_size):
+                read = io.BytesIO(' ' * offset + text).read
+                self.assertEqual(list(db.codec.iter_array(read, chunk_size)),
+                                 data)
+
+        self.assertEqual(list(db.codec.iter_array(io.BytesIO(' [ ] ').read)),
+                         [])
+        for bad in ('{}', '[1 2]', '[1]x', '[1,', '[1,]', '[1.]', '[1e]'):
+            elements = db.codec.iter_array(io.BytesIO(bad).read, 2)
+            self.assertRaises(ValueError, list, elements)
+
+
+class FailingExport(bulk.Export):
+
+    limit = 3
+
+    def _entity_line(self, entity):
+        if self.rows >= self.limit:
+            raise RuntimeError('interrupted')
+        return super(FailingExport, self)._entity_line(entity)
+
+
+class FailingLoad(bulk.Load):
+
+    limit = 3
+
+    def _load_chunk(self, chunk):
+        if self.rows >= self.limit:
+            raise RuntimeError('interrupted')
+        return super(FailingLoad, self)._load_chunk(chunk)
+
+
+class Scan(db.MoraModel):
+    image = db.BlobProperty(as_url=True)
+    thumbnail = db.ByteStringProperty()
+    pages = db.CompressedBlobProperty(as_url=True)
+
+
+class MoraBulkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+
+        # Then activate the testbed, which prepares the service stubs
+        # for use.
+        self.testbed.activate()
+
+        # Next, declare which service stubs you want to use.
+        self.testbed.init_datastore_v3_stub()
+
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'scores')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        self.testbed.deactivate()
+
+    def read(self, files):
+        rows = []
+        for name in files:
+            with gzip.open(name) as f:
+                rows.extend(json.loads(line) for line in f)
+        return rows
+
+    def testExport(self):
+        ids = set()
+        for i in range(7):
+            scores = Scores(scores=[i])
+            scores.save()
+            ids.add(scores.id)
+
+        report = bulk.export(Scores, self.path, shards=2, batch_size=2)
+        self.assertEqual(report['rows'], 7)
+        rows = self.read(report['files'])
+        self.assertEqual(set(row['id'] for row in rows), ids)
+        self.assertEqual(set(row['_kind'] for row in rows), set(['Scores']))
+        self.assertFalse(os.path.exists(self.path + '.checkpoint'))
+
+    def testResume(self):
+        for i in range(7):
+            Scores(scores=[i]).save()
+
+        self.assertRaises(RuntimeError, FailingExport(Scores, self.path,
+                                                      batch_size=2).run)
+        self.assertTrue(os.path.exists(self.path + '.checkpoint'))
+
+        report = bulk.export(Scores, self.path, batch_size=2)
+        self.assertEqual(report['rows'], 7)
+        self.assertEqual(report['exported'], 3)
+        rows = self.read(report['files'])
+        self.assertEqual(sorted(row['scores'][0] for row in rows), range(7))
+
+    def testLoad(self):
+        b = B()
+        b.save()
+        A(b_ref=b).save()
+        C(b_ref=b).save()
+        files = bulk.export(Base, self.path)['files']
+        for model in Base.all():
+            model.delete()
+
+        progress = []
+        report = bulk.load(files, keep_keys=True, batch_size=1,
+                           progress=lambda rows, seconds:
+                           progress.append(rows))
+        self.assertEqual(report['rows'], 3)
+        self.assertEqual(progress[-1], 3)
+        self.assertFalse(os.path.exists(files[0] + '.checkpoint'))
+
+        a = A.all().get()
+        self.assertEqual(a.b_ref.key(), b.key())
+        self.assertEqual(len(b.a_set.fetch(10)), 1)
+        self.assertEqual(C.all().count(), 1)
+
+    def testResumeLoad(self):
+        for i in range(7):
+            Scores(scores=[i]).save()
+        files = bulk.export(Scores, self.path)['files']
+        db.delete(Scores.all(keys_only=True).fetch(10))
+
+        self.assertRaises(RuntimeError, FailingLoad(files, workers=1,
+                                                    batch_size=1).run)
+        self.assertEqual(Scores.all().count(), 3)
+        self.assertTrue(os.path.exists(files[0] + '.checkpoint'))
+
+        report = bulk.load(files, batch_size=1)
+        self.assertEqual(report['rows'], 4)
+        self.assertEqual(sorted(m.scores[0] for m in Scores.all()), range(7))
+        self.assertFalse(os.path.exists(files[0] + '.checkpoint'))
+
+    def testBinaryRoundTrip(self):
+        image = ''.join(chr(i) for i in range(256))
+        scan = Scan(image=image, thumbnail='\xff\x00thumb',
+                    pages=image * 4)
+        scan.put()
+        files = bulk.export(Scan, self.path)['files']
+        row = self.read(files)[0]
+        self.assertEqual(row['image'], base64.urlsafe_b64encode(image))
+
+        for keep_keys in (True, False):
+            db.delete(Scan.all(keys_only=True).fetch(10))
+            bulk.load(files, keep_keys=keep_keys)
+            loaded = Scan.all().get()
+            self.assertEqual(loaded.key() == scan.key(), keep_keys)
+            self.assertEqual(loaded.image, image)
+            self.assertEqual(loaded.thumbnail, '\xff\x00thumb')
+            self.assertEqual(loaded.pages, image * 4)
+
+
+class MoraIdentityMapTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+
+        # Then activate the testbed, which prepares the service stubs
+        # for use.
+        self.testbed.activate()
+
+        # Next, declare which service stubs you want to use.
+        self.testbed.init_datastore_v3_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testGet(self):
+        b = B()
+        b.save()
+        a = A(b_ref=b)
+        a.save()
+
+        with db.IdentityMap() as identity_map:
+            with db.RpcCounter() as rpcs:
+                first = db.get(b.key())
+                self.assertTrue(db.get(b.id) is first)
+                loaded = db.get(a.key())
+                self.assertTrue(loaded.b_ref is first)
+                self.assertEqual(db.get([a.key(), b.key()]), [loaded, first])
+            self.assertEqual(rpcs.get, 2)
+            self.assertEqual(identity_map.hits, 4)
+        self.assertTrue(db.current_identity_map() is None)
+        self.assertFalse(db.get(b.key()) is first)
+
+    def testWrites(self):
+        b = B()
+        b.save()
+        c = B()
+        c.save()
+        with db.IdentityMap():
+            with db.RpcCounter() as rpcs:
+                db.get(b.key())
+                replacement = B(key=b.key())
+                replacement.put()
+                self.assertTrue(db.get(b.key()) is replacement)
+                replacement.delete()
+                self.assertEqual(db.get(b.key()), None)
+                db.delete(c.key())
+                self.assertEqual(db.get(c.key()), None)
+            self.assertEqual(rpcs.get, 1)
+
+    def testFailedWrite(self):
+        b = B()
+        b.save()
+
+        def fail(service, call, request, response):
+            if call == 'Put':
+                raise db.Error('write failed')
+
+        with db.IdentityMap():
+            with db.RpcCounter() as rpcs:
+                loaded = db.get(b.key())
+                created = B()
+                created.put()
+                self.assertTrue(db.get(created.key()) is created)
+                db.put([B(key=created.key())])
+                self.assertFalse(db.get(created.key()) is created)
+
+                apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+                    'fail_put', fail, 'datastore_v3')
+                self.assertRaises(db.Error, B(key=b.key()).put)
+                self.assertRaises(db.Error, db.put, [B(key=b.key())])
+                self.assertTrue(db.get(b.key()) is loaded)
+            self.assertEqual(rpcs.get, 1)
+
+    def testPrefetch(self):
+        b = B()
+        b.save()
+        for i in range(3):
+            A(b_ref=b).save()
+        models = A.all().fetch(10)
+        with db.RpcCounter() as rpcs:
+            db.prefetch(models, 'b_ref')
+            for model in models:
+                self.assertEqual(model.b_ref.key(), b.key())
+        self.assertEqual(rpcs.get, 1)
+
+
+class Listing(db.MoraModel):
+    query_cache = True
+    name = db.StringProperty()
+    rank = db.IntegerProperty()
+
+
+class MoraQueryCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+
+        # Then activate the testbed, which prepares the service stubs
+        # for use.
+        self.testbed.activate()
+
+        # Next, declare which service stubs you want to use.
+        self.testbed.init_datastore_v3_stub()
+
+        self.backend = db.query_cache.backend
+        db.query_cache.backend = db.MemoryQueryBackend()
+        db.query_cache.settle = 0
+
+    def tearDown(self):
+        db.query_cache.backend = self.backend
+        del db.query_cache.settle
+        self.testbed.deactivate()
+
+    def testFetch(self):
+        for i in range(3):
+            Listing(name=u'listing %d' % i, rank=i).put()
+        query = lambda: Listing.all().filter('rank >=', 1).order('rank')
+        first = query().fetch(10)
+        with db.RpcCounter() as rpcs:
+            second = query().fetch(10)
+        self.assertEqual([m.name for m in second], [m.name for m in first])
+        self.assertEqual(rpcs.query, 0)
+        self.assertEqual(rpcs.get, 1)
+
+        Listing(name=u'listing 3', rank=3).put()
+        with db.RpcCounter() as rpcs:
+            third = query().fetch(10)
+        self.assertEqual(len(third), 3)
+        self.assertEqual(rpcs.query, 1)
+
+        third[0].delete()
+        self.assertEqual(len(query().fetch(10)), 2)
+
+    def testSettle(self):
+        db.query_cache.settle = 60
+        Listing(name=u'listing', rank=1).put()
+        query = lambda: Listing.all().filter('rank >=', 1)
+        query().fetch(10)
+        with db.RpcCounter() as rpcs:
+            query().fetch(10)
+        self.assertEqual(rpcs.query, 1)
+
+        # Ancestor queries are consistent and cached at once.
+        b = B()
+        b.save()
+        ancestor = lambda: A.all().ancestor(b).cached()
+        self.assertEqual(ancestor().fetch(10), [])
+        A(b_ref=b, parent=b).save()
+        self.assertEqual(len(ancestor().fetch(10)), 1)
+        with db.RpcCounter() as rpcs:
+            self.assertEqual(len(ancestor().fetch(10)), 1)
+        self.assertEqual(rpcs.query, 0)
+
+        db.query_cache.backend.bumps[':Listing'] -= 60
+        query().fetch(10)
+        with db.RpcCounter() as rpcs:
+            query().fetch(10)
+        self.assertEqual(rpcs.query, 0)
+
+    def testCachedQuery(self):
+        b = B()
+        b.save()
+        A(b_ref=b).save()
+        self.assertEqual(len(b.a_set.cached().fetch(10)), 1)
+        with db.RpcCounter() as rpcs:
+            self.assertEqual(len(b.a_set.cached().fetch(10)), 1)
+            self.assertEqual(len(A.all(keys_only=True).fetch(10)), 1)
+        self.assertEqual(rpcs.query, 1)
+
+        A(b_ref=b).save()
+        self.assertEqual(len(b.a_set.cached().fetch(10)), 2)
+
+    def testTransaction(self):
+        listing = Listing(name=u'listing', rank=1)
+        listing.put()
+        self.assertEqual(len(Listing.all().fetch(10)), 1)
+
+        @db.transactional
+        def rename():
+            renamed = Listing.get(listing.key())
+            renamed.name = u'renamed'
+            renamed.put()
+        rename()
+        self.assertEqual(Listing.all().fetch(10)[0].name, u'renamed')
+
+    def testNamespace(self):
+        query = lambda: Listing.all().order('rank')
+        names = lambda: [m.name for m in query().fetch(10)]
+        try:
+            namespace_manager.set_namespace('a')
+            Listing(name=u'a', rank=1).put()
+            self.assertEqual(names(), [u'a'])
+
+            namespace_manager.set_namespace('b')
+            self.assertEqual(names(), [])
+            Listing(name=u'b', rank=1).put()
+            self.assertEqual(names(), [u'b'])
+
+            namespace_manager.set_namespace('a')
+            with db.RpcCounter() as rpcs:
+                self.assertEqual(names(), [u'a'])
+            self.assertEqual(rpcs.query, 0)
+        finally:
+            namespace_manager.set_namespace('')
+        generations = db.query_cache.backend.generations
+        self.assertEqual(generations['a:Listing'], 1)
+        self.assertEqual(generations['b:Listing'], 1)
+
+
+class MoraSingleFlightTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+
+        # Then activate the testbed, which prepares the service stubs
+        # for use.
+        self.testbed.activate()
+
+        # Next, declare which service stubs you want to use.
+        self.testbed.init_datastore_v3_stub()
+
+        self.flight = db.SingleFlight()
+        self.release = threading.Event()
+        self.calls = []
+        self.results = []
+
+    def tearDown(self):
+        self.release.set()
+        self.testbed.deactivate()
+
+    def fetch(self):
+        self.calls.append(1)
+        self.release.wait(5)
+        return [1, 2]
+
+    def read(self):
+        self.results.append(self.flight.run('key', frozenset(['A']),
+                                            self.fetch, tuple, list))
+
+    def start(self, count):
+        calls = self.flight.calls + count
+        threads = [threading.Thread(target=self.read) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        while self.flight.calls < calls:
+            time.sleep(0.01)
+        return threads
+
+    def testCoalesce(self):
+        threads = self.start(4)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.results, [[1, 2]] * 4)
+        self.assertEqual(self.flight.stats(),
+                         {'calls': 4, 'coalesced': 3, 'timeouts': 0})
+
+    def testForget(self):
+        threads = self.start(1)
+        self.flight.forget(frozenset(['A']))
+        threads += self.start(2)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.calls), 2)
+
+    def testTimeout(self):
+        self.flight.timeout = 0.05
+        threads = self.start(1) + self.start(1)
+        while not self.flight.timeouts:
+            time.sleep(0.01)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.calls), 2)
+
+    def testGet(self):
+        b = B()
+        b.save()
+        a = A(b_ref=b)
+        a.save()
+        self.assertEqual(db.get(a.key()).b_ref.key(), b.key())
+        self.assertEqual(db.get([b.id, a.key()])[1].key(), a.key())
+        self.assertEqual(len(b.a_set.fetch(10)), 1)
+
+    def testNamespace(self):
+        query = Listing.all().order('rank')
+        signature = query._mora_signature(10, 0)
+        other = Listing.all(namespace='other').order('rank')
+        self.assertNotEqual(other._mora_signature(10, 0), signature)
+        namespace_manager.set_namespace('tenant')
+        try:
+            self.assertNotEqual(query._mora_signature(10, 0), signature)
+        finally:
+            namespace_manager.set_namespace('')
+        self.assertEqual(query._mora_signature(10, 0), signature)
+
+
+class Document(db.MoraModel):
+    body = db.CompressedTextProperty()
+    data = db.CompressedBlobProperty()
+
+
+class MoraCompressedPropertyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+
+        # Then activate the testbed, which prepares the service stubs
+        # for use.
+        self.testbed.activate()
+
+        # Next, declare which service stubs you want to use.
+        self.testbed.init_datastore_v3_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testRoundTrip(self):
+        body = u'<p>caf\xe9</p>' * 200
+        document = Document(body=body, data='\x00\x01' * 500)
+        document.put()
+        self.assertTrue(len(Document.body.get_value_for_datastore(document))
+                        < len(body))
+
+        loaded = Document.get(document.key())
+        self.assertTrue(isinstance(loaded.__dict__['_body'], db._Deflated))
+        self.assertEqual(loaded.body, body)
+        self.assertTrue(isinstance(loaded.body, db.Text))
+        self.assertEqual(loaded.data, '\x00\x01' * 500)
+        self.assertEqual(loaded.as_json()['body'], body)
+        self.assertEqual(loaded.as_json()['data'],
+                         db.BlobProperty(name='data').as_json(loaded))
+
+        small = Document(body=u'short')
+        small.put()
+        self.assertEqual(Document.get(small.key()).body, u'short')
+        self.assertEqual(Document.get(small.key()).data, None)
+
+    def testUnreadValuesAreKept(self):
+        body = u'<p>caf\xe9</p>' * 200
+        document = Document(body=body, data='\x00\x01' * 500)
+        document.put()
+        stored = datastore.Get(document.key())
+
+        calls = []
+        zlib = db.zlib
+
+        class Zlib(object):
+            def __getattr__(self, name):
+                calls.append(name)
+                return getattr(zlib, name)
+
+        db.zlib = Zlib()
+        try:
+            loaded = Document.get(document.key())
+            loaded.put()
+            for name in ('body', 'data'):
+                value = getattr(Document, name).get_value_for_datastore(
+                    loaded)
+                self.assertTrue(isinstance(value, db.Blob))
+                self.assertEqual(value, stored[name])
+            self.assertEqual(datastore.Get(document.key())['body'],
+                             stored['body'])
+        finally:
+            db.zlib = zlib
+        self.assertEqual(calls, [])
+
+    def testUncompressed(self):
+        self.assertEqual(
+            Document.body.make_value_from_datastore(db.Text(u'legacy')),
+            u'legacy')
+        self.assertEqual(
+            Document.data.make_value_from_datastore(db.Blob('legacy')),
+            'legacy')
+
+
+class Profile(db.MoraModel):
+    settings = db.JsonProperty()
+    history = db.JsonProperty(compressed=True)
+
+
+class MoraJsonPropertyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+
+        # Then activate the testbed, which prepares the service stubs
+        # for use.
+        self.testbed.activate()
+
+        # Next, declare which service stubs you want to use.
+        self.testbed.init_datastore_v3_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testLazy(self):
+        settings = {u'theme': u'dark', u'panels': [1, 2, {u'open': True}]}
+        history = [{u'page': i} for i in range(100)]
+        profile = Profile(settings=settings, history=history)
+        profile.put()
+        self.assertEqual(Profile.settings.get_value_for_datastore(profile),
+                         json.dumps(settings, separators=(',', ':')))
+
+        loaded = Profile.get(profile.key())
+        self.assertTrue(isinstance(loaded.as_json()['settings'],
+                                   db.codec.RawJSON))
+        self.assertEqual(json.loads(loaded.to_json()), profile.as_json())
+        self.assertTrue(isinstance(loaded.__dict__['_settings'],
+                                   db._StoredJson))
+        self.assertEqual(loaded.settings, settings)
+        self.assertEqual(loaded.history, history)
+        self.assertEqual(loaded.as_json()['settings'], settings)
+
+    def testRawJsonValue(self):
+        settings = {u'theme': u'dark'}
+        history = [{u'page': i} for i in range(100)]
+        Profile(key_name='source', settings=settings, history=history).put()
+        data = Profile.get_by_key_name('source').as_json()
+
+        # Values copied from `as_json` are stored as their text.
+        copy = Profile(settings={u'copied': data['settings']},
+                       history=data['history'])
+        copy.put()
+        loaded = Profile.get(copy.key())
+        self.assertEqual(loaded.settings, {u'copied': settings})
+        self.assertEqual(loaded.history, history)
+
+    def testMergePatch(self):
+        profile = Profile(settings={u'theme': u'dark', u'font': u'serif'})
+        profile.put()
+        loaded = Profile.get(profile.key())
+        self.assertTrue(loaded.merge_patch({'settings': {'font': None}}))
+        self.assertEqual(Profile.get(profile.key()).settings,
+                         {u'theme': u'dark'})
+
+
+class MoraRawEntityTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+
+        # Then activate the testbed, which prepares the service stubs
+        # for use.
+        self.testbed.activate()
+
+        # Next, declare which service stubs you want to use.
+        self.testbed.init_datastore_v3_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def assertSameJson(self, model):
+        query = type(model).all().filter('__key__ =', model.key())
+        entity = query.fetch_entities(1)[0]
+        self.assertTrue(db.class_for_entity(entity) is type(model))
+        expected = type(model).get(model.key()).to_json()
+        self.assertEqual(json.loads(db.codec.dumps(db.entity_as_json(entity))),
+                         json.loads(expected))
+
+    def testEntityAsJson(self):
+        b = B()
+        b.save()
+        a = A(b_ref=b)
+        a.save()
+        self.assertSameJson(a)
+        self.assertSameJson(b)
+        scores = Scores(scores=[1, 2, 3])
+        scores.put()
+        self.assertSameJson(scores)
+        document = Document(body=u'<p>body</p>' * 100, data='\x00' * 10)
+        document.put()
+        self.assertSameJson(document)
+        profile = Profile(settings={u'theme': u'dark'})
+        profile.put()
+        self.assertSameJson(profile)
+
+    def testComputedProperty(self):
+        # A computed value stored by an older version of the code is
+        # computed again, as `as_json` does.
+        scores = Scores(scores=[1, 2, 3])
+        scores.put()
+        entity = datastore.Get(scores.key())
+        entity['total'] = 0
+        datastore.Put(entity)
+        self.assertEqual(db.entity_as_json(entity)['total'], 6)
+        self.assertEqual(Scores.all().fetch_json(1)[0]['total'], 6)
+
+    def testFetchJson(self):
+        for i in range(3):
+            Scores(scores=[i]).put()
+        query = Scores.all().order('total')
+        self.assertEqual(query.fetch_json(2, include=['scores']),
+                         [{'scores': [0]}, {'scores': [1]}])
+        query.with_cursor(query.cursor())
+        self.assertEqual([data['total'] for data in query.fetch_json(2)], [2])
+        self.assertEqual(Scores.all(keys_only=True).fetch_json(1),
+                         [db.key_to_str(Scores.all().order('total').get().key())])
+
+
+class Listed(db.MoraModel):
+    name = db.StringProperty()
+    year = db.IntegerProperty()
+    starts = db.DateTimeProperty()
+    notes = db.TextProperty()
+    tags = db.StringListProperty()
+
+
+class ProjectedListed(db.MoraModel):
+    projection_queries = True
+    name = db.StringProperty()
+    year = db.IntegerProperty()
+    starts = db.DateTimeProperty()
+
+
+class MoraProjectionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+
+        # Then activate the testbed, which prepares the service stubs
+        # for use.
+        self.testbed.activate()
+
+        # Next, declare which service stubs you want to use.
+        self.testbed.init_datastore_v3_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testProjectionFor(self):
+        self.assertEqual(db.projection_for(Listed, ['id', 'name', 'starts']),
+                         ('name', 'starts'))
+        self.assertEqual(db.projection_for(Listed, ['id']), None)
+        self.assertEqual(db.projection_for(Listed, ['name', 'notes']), None)
+        self.assertEqual(db.projection_for(Listed, ['name', 'tags']), None)
+        self.assertEqual(db.projection_for(Listed, ['name', 'unknown']), None)
+
+    def testFetchFields(self):
+        starts = datetime.datetime(2012, 9, 1, 8, 30)
+        for i in range(3):
+            Listed(name=u'Listed %d' % i, year=i, starts=starts,
+                  notes=u'notes', tags=[u'a', u'b']).put()
+        entries = Listed.all().order('year').fetch(3)
+
+        for fields in (['id', 'name', 'starts'], ['name', 'notes']):
+            expected = [e.as_json(include=fields) for e in entries]
+            self.assertEqual(
+                Listed.all().order('year').fetch_fields(fields, 3), expected)
+
+        query = Listed.all().order('year')
+        self.assertEqual(query.fetch_fields(['year'], 2),
+                         [{'year': 0}, {'year': 1}])
+        query.with_cursor(query.cursor())
+        self.assertEqual(query.fetch_fields(['year'], 2), [{'year': 2}])
+
+    def testMissingProperty(self):
+        # An entity written before `starts` existed.
+        for kind in ('Listed', 'ProjectedListed'):
+            entity = datastore.Entity(kind)
+            entity['name'] = u'old'
+            entity['year'] = 0
+            datastore.Put(entity)
+        starts = datetime.datetime(2012, 9, 1, 8, 30)
+        Listed(name=u'new', year=1, starts=starts).put()
+        ProjectedListed(name=u'new', year=1, starts=starts).put()
+
+        fields = ['name', 'starts']
+        new = {'name': u'new', 'starts': starts.isoformat('T') + '+00:00'}
+        self.assertEqual(Listed.all().order('year').fetch_fields(fields, 5),
+                         [{'name': u'old', 'starts': None}, new])
+
+        # Projection leaves it out, which is what the class opted into.
+        projected = ProjectedListed.all().order('year')
+        self.assertEqual(projected.fetch_fields(fields, 5), [new])
+
+
+class TaggedBlobReferenceProperty(db.BlobReferenceProperty):
+
+    def as_json(self, model_instance, value=None):
+        value = super(TaggedBlobReferenceProperty, self).as_json(
+            model_instance, value)
+        return {'tagged': value}
+
+
+class Upload(db.MoraModel):
+    blob = TaggedBlobReferenceProperty()
+
+
+class MoraBlobReferenceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # First, create an instance of the Testbed class.
+        self.testbed = testbed.Testbed()
+
+        # Then activate the testbed, which prepares the service stubs
+        # for use.
+        self.testbed.activate()
+
+        # Next, declare which service stubs you want to use.
+        self.testbed.init_datastore_v3_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def testSubclass(self):
+        prop = Upload.blob
+        self.assertTrue(isinstance(prop, TaggedBlobReferenceProperty))
+        self.assertTrue(isinstance(prop, db.BlobReferenceProperty))
+        self.assertTrue(isinstance(prop, blobstore.BlobReferenceProperty))
+        self.assertTrue(issubclass(TaggedBlobReferenceProperty,
+                                   blobstore.BlobReferenceProperty))
+        self.assertEqual(prop.data_type, blobstore.BlobInfo)
+
+        upload = Upload()
+        upload.put()
+        self.assertEqual(upload.as_json()['blob'], {'tagged': None})
+        upload.blob = blobstore.BlobKey('fake')
+        self.assertEqual(prop.get_value_for_datastore(upload),
+                         blobstore.BlobKey('fake'))
+
+
+# `mora.rest` imports the package's `mora.db`, which must not be loaded
+# next to the `db` these tests use, so the dispatcher is tested in a
+# fresh interpreter.  A test's script is appended to `DISPATCHER_SCRIPT`,
+# which starts the testbed and defines `request`, and prints its
+# results as JSON on its last line.
+def run_script(script):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([root] + sys.path)
+    output = subprocess.check_output([sys.executable, '-c', script], env=env)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+DISPATCHER_SCRIPT = """
+import json
+import webapp2
+from google.appengine.ext import testbed
+from mora import db
+from mora import rest
+
+bed = testbed.Testbed()
+bed.activate()
+bed.init_datastore_v3_stub()
+bed.init_memcache_stub()
+
+def request(path, method='GET', headers=None, body=None, app=None):
+    if app is None:
+        app = rest.RestDispatcher.application([('/_mora/metrics',
+                                                rest.MetricsHandler)])
+    request = webapp2.Request.blank(path, headers=headers)
+    request.method = method
+    if body is not None:
+        request.body = json.dumps(body)
+        request.content_type = 'application/json'
+    response = request.get_response(app)
+    return {'status': response.status_int,
+            'headers': dict(response.headers),
+            'body': response.body.decode('latin-1')}
+"""
+
+
+BLOB_SCRIPT = DISPATCHER_SCRIPT + """
+class Attachment(db.MoraModel):
+    data = db.CompressedBlobProperty(as_url=True, content_type='text/plain')
+
+class AttachmentHandler(rest.RestHandler):
+    model = Attachment
+
+    def show(self):
+        self.response.out.write(self.model.to_json())
+
+class Photo(db.MoraModel):
+    data = db.BlobProperty(as_url=True)
+
+class PhotoHandler(rest.RestHandler):
+    model = Photo
+
+class Unconnected(db.MoraModel):
+    data = db.BlobProperty(as_url=True)
+
+rest.RestDispatcher.setup('/graph', [AttachmentHandler, PhotoHandler])
+attachment = Attachment(data='0123456789' * 100)
+attachment.put()
+url = attachment.as_json()['data']
+etag = request(url)['headers']['ETag']
+photo = Photo(data='secret')
+photo.put()
+unconnected = Unconnected(data='x')
+unconnected.put()
+
+ranges = {}
+for header in ('bytes=0-9', 'bytes=990-', 'bytes=-5', 'bytes=995-2000',
+               'bytes=5-2', 'bytes=1000-', 'bytes=-0', 'bytes=0-1,5-6',
+               'bytes=x-y', 'items=0-9', None):
+    try:
+        ranges[str(header)] = rest._byte_range(header, 1000)
+    except rest.DispatchError as error:
+        ranges[str(header)] = [error.code, error.headers]
+
+print json.dumps({
+    'url': url,
+    'whole': request(url),
+    'range': request(url, headers={'Range': 'bytes=5-14'}),
+    'suffix': request(url, headers={'Range': 'bytes=-3'}),
+    'unsatisfiable': request(url, headers={'Range': 'bytes=1000-'}),
+    'invalid range': request(url, headers={'Range': 'bytes=5-3'}),
+    'not modified': request(url, headers={'If-None-Match': etag}),
+    'modified': request(url, headers={'If-None-Match': '"other"'}),
+    'if range': request(url, headers={'Range': 'bytes=0-1',
+                                      'If-Range': etag}),
+    'stale if range': request(url, headers={'Range': 'bytes=0-1',
+                                            'If-Range': '"other"'}),
+    'put': request(url, 'PUT'),
+    'unknown property': request('/graph/%s/_blob/name' % attachment.id),
+    'no show': request(photo.as_json()['data']),
+    'unconnected': unconnected.as_json()['data'],
+    'ranges': ranges})
+"""
+
+
+class MoraBlobDispatchTestCase(unittest.TestCase):
+
+    def testServeBlob(self):
+        results = run_script(BLOB_SCRIPT)
+        whole = results['whole']
+        self.assertEqual(whole['status'], 200)
+        self.assertEqual(whole['body'], u'0123456789' * 100)
+        self.assertTrue(whole['headers']['Content-Type'].startswith(
+            'text/plain'))
+        etag = '"%s"' % hashlib.md5('0123456789' * 100).hexdigest()
+        self.assertEqual(whole['headers']['ETag'], etag)
+        self.assertEqual(results['range']['status'], 206)
+        self.assertEqual(results['range']['body'], u'5678901234')
+        self.assertEqual(results['range']['headers']['Content-Range'],
+                         'bytes 5-14/1000')
+        self.assertEqual(results['suffix']['status'], 206)
+        self.assertEqual(results['suffix']['body'], u'789')
+
+        unsatisfiable = results['unsatisfiable']
+        self.assertEqual(unsatisfiable['status'], 416)
+        self.assertEqual(unsatisfiable['headers']['Content-Range'],
+                         'bytes */1000')
+
+        invalid = results['invalid range']
+        self.assertEqual(invalid['status'], 200)
+        self.assertEqual(invalid['body'], u'0123456789' * 100)
+
+        self.assertEqual(results['not modified']['status'], 304)
+        self.assertEqual(results['not modified']['body'], u'')
+        self.assertEqual(results['modified']['status'], 200)
+        self.assertEqual(results['if range']['status'], 206)
+        self.assertEqual(results['if range']['body'], u'01')
+        self.assertEqual(results['stale if range']['status'], 200)
+        self.assertEqual(len(results['stale if range']['body']), 1000)
+
+        self.assertEqual(results['put']['status'], 405)
+        self.assertEqual(results['unknown property']['status'], 404)
+        self.assertEqual(results['no show']['status'], 405)
+        self.assertTrue('secret' not in results['no show']['body'])
+
+        # Only models connected to the dispatcher get its path.
+        self.assertTrue(results['url'].startswith('/graph/'))
+        self.assertFalse(results['unconnected'].startswith('/graph/'))
+
+    def testByteRange(self):
+        ranges = run_script(BLOB_SCRIPT)['ranges']
+        self.assertEqual(ranges['bytes=0-9'], [0, 9])
+        self.assertEqual(ranges['bytes=990-'], [990, 999])
+        self.assertEqual(ranges['bytes=-5'], [995, 999])
+        self.assertEqual(ranges['bytes=995-2000'], [995, 999])
+        self.assertEqual(ranges['bytes=1000-'],
+                         [416, {'Content-Range': 'bytes */1000'}])
+        self.assertEqual(ranges['bytes=-0'],
+                         [416, {'Content-Range': 'bytes */1000'}])
+        for header in ('bytes=5-2', 'bytes=0-1,5-6', 'bytes=x-y',
+                       'items=0-9', 'None'):
+            self.assertEqual(ranges[header], None)
+
+
+PAGE_SCRIPT = DISPATCHER_SCRIPT + """
+import urllib
+
+class Shelf(db.MoraModel):
+    name = db.StringProperty()
+
+class Book(db.MoraModel):
+    projection_queries = True
+    title = db.StringProperty()
+    number = db.IntegerProperty()
+
+class ShelfHandler(rest.RestHandler):
+    model = Shelf
+
+    @rest.rest_index("books")
+    def book_list(self):
+        self.write_page(Book.all().order('number'), limit=2)
+
+rest.RestDispatcher.setup('/graph', [ShelfHandler])
+shelf = Shelf(name=u'Algebra')
+shelf.put()
+for i in range(3):
+    Book(title=u'Book %d' % i, number=i).put()
+books = '/graph/%s/books' % shelf.id
+
+results = {'first': request(books)}
+cursor = json.loads(results['first']['body'])['cursor']
+results['second'] = request(books + '?cursor=' + urllib.quote(cursor))
+results['fields'] = request(books + '?fields=title,%20id')
+results['invalid cursor'] = request(books + '?cursor=nonsense')
+print json.dumps(results)
+"""
+
+
+class MoraPageTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.results = run_script(PAGE_SCRIPT)
+
+    def page(self, name):
+        self.assertEqual(self.results[name]['status'], 200)
+        return json.loads(self.results[name]['body'])
+
+    def testPaging(self):
+        first = self.page('first')
+        self.assertEqual([b['number'] for b in first['results']], [0, 1])
+        self.assertTrue(first['cursor'])
+        second = self.page('second')
+        self.assertEqual([b['number'] for b in second['results']], [2])
+        self.assertEqual(second['cursor'], None)
+
+    def testFields(self):
+        results = self.page('fields')['results']
+        self.assertEqual([b['title'] for b in results], [u'Book 0', u'Book 1'])
+        for book in results:
+            self.assertEqual(sorted(book), ['id', 'title'])
+        self.assertEqual(results[0]['id'],
+                         self.page('first')['results'][0]['id'])
+
+    def testInvalidCursor(self):
+        invalid = self.results['invalid cursor']
+        self.assertEqual(invalid['status'], 400)
+        self.assertEqual(json.loads(invalid['body']),
+                         {'error': 'InvalidCursor'})
+
+
+PATCH_SCRIPT = DISPATCHER_SCRIPT + """
+class Member(db.MoraModel):
+    name = db.StringProperty()
+    nickname = db.StringProperty()
+    year = db.IntegerProperty()
+
+class MemberHandler(rest.RestHandler):
+    model = Member
+
+    def patch(self):
+        self.merge_patch()
+        self.response.out.write(self.model.to_json())
+
+class Group(db.MoraModel):
+    name = db.StringProperty()
+
+class GroupHandler(rest.RestHandler):
+    model = Group
+
+rest.RestDispatcher.setup('/graph', [MemberHandler, GroupHandler])
+member = Member(name=u'Ann', nickname=u'Annie', year=1)
+member.put()
+group = Group(name=u'Chess')
+group.put()
+path = '/graph/%s' % member.id
+results = {
+    'merge': request(path, 'PATCH', body={'year': 2, 'nickname': None}),
+    'not an object': request(path, 'PATCH', body=[{'year': 3}]),
+    'no patch': request('/graph/%s' % group.id, 'PATCH', body={}),
+    'other application': request(path, 'PATCH', body={'year': 4},
+                                 app=webapp2.WSGIApplication(
+                                     [rest.RestDispatcher.route()])),
+}
+stored = Member.get(member.key())
+results['stored'] = {'name': stored.name, 'nickname': stored.nickname,
+                     'year': stored.year}
+print json.dumps(results)
+"""
+
+
+class MoraPatchDispatchTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.results = run_script(PATCH_SCRIPT)
+
+    def testMergePatch(self):
+        merge = self.results['merge']
+        self.assertEqual(merge['status'], 200)
+        data = json.loads(merge['body'])
+        self.assertEqual((data['name'], data['nickname'], data['year']),
+                         (u'Ann', None, 2))
+        self.assertEqual(self.results['stored'],
+                         {'name': u'Ann', 'nickname': None, 'year': 2})
+
+    def testInvalidPatch(self):
+        invalid = self.results['not an object']
+        self.assertEqual(invalid['status'], 400)
+        self.assertEqual(json.loads(invalid['body']),
+                         {'error': 'InvalidPatch'})
+
+    def testUnsupported(self):
+        self.assertEqual(self.results['no patch']['status'], 405)
+
+    # Only the application built by the dispatcher was told about PATCH.
+    def testPerApplication(self):
+        self.assertEqual(self.results['other application']['status'], 501)
+
+
+METRICS_SCRIPT = DISPATCHER_SCRIPT + """
+class Student(db.MoraModel):
+    name = db.StringProperty()
+
+class StudentHandler(rest.RestHandler):
+    model = Student
+
+    def show(self):
+        self.response.out.write(self.model.to_json())
+
+    @rest.rest_index("courses")
+    def course_list(self):
+        self.response.out.write('[]')
+
+rest.RestDispatcher.setup('/graph', [StudentHandler])
+rest.RestDispatcher.metrics.reset()
+student = Student(name=u'Ann')
+student.put()
+results = {'show': request('/graph/%s' % student.id),
+           'index': request('/graph/%s/courses' % student.id)}
+for i in range(5):
+    request('/graph/%s/random%d' % (student.id, i))
+    request('/graph/nonsense%d/random%d' % (i, i))
+results['metrics'] = request('/_mora/metrics')
+print json.dumps(results)
+"""
+
+
+class MoraRouteMetricsTestCase(unittest.TestCase):
+
+    def testMetrics(self):
+        results = run_script(METRICS_SCRIPT)
+        timing = results['show']['headers']['Server-Timing']
+        phases = [entry.split(';')[0] for entry in timing.split(', ')]
+        for phase in ('key', 'get', 'setup', 'handler', 'total'):
+            self.assertTrue(phase in phases, timing)
+        self.assertTrue('Server-Timing' in results['index']['headers'])
+
+        counts = {}
+        for line in results['metrics']['body'].splitlines():
+            if line.startswith('mora_request_duration_seconds_count'):
+                labels, count = line.rsplit(' ', 1)
+                counts[labels[len('mora_request_duration_seconds_count'):]] = \
+                    int(count)
+        self.assertEqual(counts, {
+            '{verb="GET",kind="Student",keyword="__self__"}': 1,
+            '{verb="GET",kind="Student",keyword="courses"}': 1,
+            '{verb="GET",kind="Student",keyword="unknown"}': 5,
+            '{verb="GET",kind="",keyword=""}': 5})
+        self.assertTrue('mora_request_duration_seconds_bucket{verb="GET",'
+                        'kind="Student",keyword="unknown",le="+Inf"} 5' in
+                        results['metrics']['body'])
+
+
+ADMISSION_SCRIPT = DISPATCHER_SCRIPT + """
+import threading
+
+entered = threading.Event()
+release = threading.Event()
+
+class Course(db.MoraModel):
+    title = db.StringProperty()
+
+class CourseHandler(rest.RestHandler):
+    model = Course
+
+    def show(self):
+        entered.set()
+        release.wait(10)
+        self.response.out.write(self.model.to_json())
+
+    @rest.rest_index("fail")
+    def fail(self):
+        raise RuntimeError('failed')
+
+    @rest.rest_create("like")
+    def like(self):
+        self.response.out.write('{}')
+
+# Requests `path` in a thread and, once its handler was entered, the
+# other paths.
+def blocked(path, *paths):
+    entered.clear()
+    release.clear()
+    results = {}
+    thread = threading.Thread(
+        target=lambda: results.update(first=request(path)))
+    thread.start()
+    entered.wait(10)
+    results['others'] = [request(p) for p in paths]
+    release.set()
+    thread.join()
+    return results
+
+def configure(max_in_flight=None, concurrency_limits={}, rate_limits={},
+              retry_after=1):
+    rest.RestDispatcher.max_in_flight = max_in_flight
+    rest.RestDispatcher.concurrency_limits = concurrency_limits
+    rest.RestDispatcher.rate_limits = rate_limits
+    rest.RestDispatcher.retry_after = retry_after
+
+rest.RestDispatcher.setup('/graph', [CourseHandler])
+rest.RestDispatcher.admission.reset()
+course = Course(title=u'Algebra')
+course.put()
+show = '/graph/%s' % course.id
+results = {}
+
+configure(max_in_flight=1)
+results['max in flight'] = blocked(show, show)
+
+configure(concurrency_limits={'GET __self__': 1}, retry_after=7)
+results['route limit'] = blocked(show, show, '/graph/%s/fail' % course.id)
+
+configure(max_in_flight=1, concurrency_limits={'GET fail': 1})
+results['failures'] = [request('/graph/%s/fail' % course.id)
+                       for _ in range(3)]
+results['after failures'] = request(show)
+
+configure(rate_limits={'POST like': (0.5, 1)})
+results['rate'] = [request('/graph/%s/like' % course.id, 'POST')
+                   for _ in range(2)]
+
+configure()
+results['metrics'] = request('/_mora/metrics')
+
+# Rejected requests must not use up tokens.
+def tokens(key, setting):
+    limiter = rest.RestDispatcher.admission.limiters[(('rate', key), setting)]
+    return round(limiter.tokens, 2)
+
+configure(max_in_flight=1, rate_limits={'GET __self__': (0.001, 5)})
+blocked(show, show)
+results['tokens after concurrency'] = tokens('GET __self__', (0.001, 5))
+
+configure(rate_limits={'POST like': (0.001, 5), 'POST': (0.001, 1)})
+results['refunded'] = [request('/graph/%s/like' % course.id, 'POST')['status']
+                       for _ in range(2)]
+results['tokens after rate'] = tokens('POST like', (0.001, 5))
+print json.dumps(results)
+"""
+
+
+class MoraAdmissionTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.results = run_script(ADMISSION_SCRIPT)
+
+    def testMaxInFlight(self):
+        results = self.results['max in flight']
+        self.assertEqual(results['first']['status'], 200)
+        rejected = results['others'][0]
+        self.assertEqual(rejected['status'], 503)
+        self.assertEqual(rejected['headers']['Retry-After'], '1')
+        self.assertEqual(json.loads(rejected['body']),
+                         {'error': 'ServiceUnavailable'})
+
+    def testRouteLimit(self):
+        results = self.results['route limit']
+        self.assertEqual(results['first']['status'], 200)
+        rejected, other_route = results['others']
+        self.assertEqual(rejected['status'], 503)
+        self.assertEqual(rejected['headers']['Retry-After'], '7')
+        self.assertEqual(other_route['status'], 500)
+
+    def testReleasedWhenHandlerRaises(self):
+        self.assertEqual([r['status'] for r in self.results['failures']],
+                         [500, 500, 500])
+        self.assertEqual(self.results['after failures']['status'], 200)
+
+    def testRateLimit(self):
+        accepted, rejected = self.results['rate']
+        self.assertEqual(accepted['status'], 200)
+        self.assertEqual(rejected['status'], 429)
+        self.assertEqual(rejected['headers']['Retry-After'], '2')
+        self.assertEqual(json.loads(rejected['body']),
+                         {'error': 'TooManyRequests'})
+
+    def testRejectedRequestsKeepTokens(self):
+        self.assertEqual(self.results['tokens after concurrency'], 4)
+        self.assertEqual(self.results['refunded'], [200, 429])
+        self.assertEqual(self.results['tokens after rate'], 4)
+
+    def testRejectionMetrics(self):
+        body = self.results['metrics']['body']
+        for line in ('# TYPE mora_rejected_requests_total counter',
+                     'mora_rejected_requests_total'
+                     '{limit="*",reason="concurrency"} 1',
+                     'mora_rejected_requests_total'
+                     '{limit="GET __self__",reason="concurrency"} 1',
+                     'mora_rejected_requests_total'
+                     '{limit="POST like",reason="rate"} 1'):
+            self.assertTrue(line in body.splitlines(), line)
+        self.assertFalse('reason="concurrency"} 2' in body)
+
+
+CACHE_SCRIPT = DISPATCHER_SCRIPT + """
+class Lesson(db.MoraModel):
+    title = db.StringProperty()
+
+class LessonHandler(rest.RestHandler):
+    model = Lesson
+
+    def show(self):
+        self.response.out.write(self.model.to_json())
+
+    def update(self):
+        self.response.out.write(self.model.to_json())
+
+    def patch(self):
+        self.response.out.write(self.model.to_json())
+
+    def destroy(self):
+        self.response.out.write('{}')
+
+    @rest.rest_index("public", cache="public, max-age=60",
+                     vary="Accept-Language")
+    def public(self):
+        self.response.headers['Vary'] = 'Cookie'
+        self.response.out.write('[]')
+
+    @rest.rest_index("private")
+    @rest.cache_control("private, max-age=5")
+    def private(self):
+        self.response.out.write('[]')
+
+    @rest.rest_index("plain")
+    def plain(self):
+        self.response.out.write('[]')
+
+    @rest.rest_index("own", cache="public, max-age=60")
+    def own(self):
+        self.response.headers['Cache-Control'] = 'max-age=1'
+        self.response.out.write('[]')
+
+    @rest.rest_index("missing", cache="public, max-age=60")
+    def missing(self):
+        raise rest.DispatchError(404, "ResourceNotFound")
+
+    @rest.rest_create("lessons")
+    def create(self):
+        self.response.out.write('{}')
+
+class Quiz(db.MoraModel):
+    title = db.StringProperty()
+
+class QuizHandler(rest.RestHandler):
+    model = Quiz
+    cache = "public, max-age=30"
+    vary = "Accept"
+
+    @rest.cache_control("public, max-age=600")
+    def show(self):
+        self.response.out.write(self.model.to_json())
+
+    @rest.rest_index("questions")
+    def questions(self):
+        self.response.out.write('[]')
+
+rest.RestDispatcher.setup('/graph', [LessonHandler, QuizHandler])
+lesson = Lesson(title=u'One')
+lesson.put()
+quiz = Quiz(title=u'Two')
+quiz.put()
+path = '/graph/%s' % lesson.id
+results = {}
+for keyword in ('public', 'private', 'plain', 'own', 'missing', 'unknown'):
+    results[keyword] = request('%s/%s' % (path, keyword))
+results['show'] = request(path)
+results['quiz show'] = request('/graph/%s' % quiz.id)
+results['quiz index'] = request('/graph/%s/questions' % quiz.id)
+results['PUT'] = request(path, 'PUT', body={})
+results['PATCH'] = request(path, 'PATCH', body={})
+results['DELETE'] = request(path, 'DELETE')
+results['POST'] = request(path + '/lessons', 'POST', body={})
+results['_method PUT'] = request(path + '?_method=PUT')
+results['_method DELETE'] = request(path + '/public?_method=DELETE')
+print json.dumps(results)
+"""
+
+
+class MoraCacheControlTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.results = run_script(CACHE_SCRIPT)
+
+    def header(self, name, header='Cache-Control'):
+        return self.results[name]['headers'].get(header)
+
+    def testPolicies(self):
+        self.assertEqual(self.header('public'), 'public, max-age=60')
+        self.assertEqual(self.header('public', 'Vary'),
+                         'Cookie, Accept-Language')
+        self.assertEqual(self.header('private'), 'private, max-age=5')
+        self.assertEqual(self.header('private', 'Vary'), None)
+        self.assertEqual(self.header('show'), 'private, no-cache')
+        self.assertEqual(self.header('quiz show'), 'public, max-age=600')
+        self.assertEqual(self.header('quiz show', 'Vary'), None)
+        self.assertEqual(self.header('quiz index'), 'public, max-age=30')
+        self.assertEqual(self.header('quiz index', 'Vary'), 'Accept')
+
+    def testActionHeaderWins(self):
+        self.assertEqual(self.header('own'), 'max-age=1')
+
+    def testDefault(self):
+        self.assertEqual(self.results['plain']['status'], 200)
+        self.assertEqual(self.header('plain'), 'no-cache')
+
+    def testNoStore(self):
+        for name in ('missing', 'unknown', 'PUT', 'PATCH', 'DELETE', 'POST',
+                     '_method PUT', '_method DELETE'):
+            self.assertEqual(self.header(name), 'no-store', name)
+        self.assertEqual(self.results['missing']['status'], 404)
+        self.assertEqual(self.results['unknown']['status'], 405)
+        self.assertEqual(self.results['_method PUT']['status'], 200)
+
+
+# The import budget is measured in a fresh interpreter so that modules
+# this test run already imported do not hide the cost.  App Engine's own
+# modules are imported first, so the modules that appear afterwards are
+# the ones mora pulls in.  The times are reported but not asserted on,
+# since they depend on the machine.
+IMPORT_BUDGET_SCRIPT = """
+import json, sys, time
+from google.appengine.ext import db
+from google.appengine.ext.db import polymodel
+import webapp2
+
+lazy = ('base64', 'traceback', 'inspect', 'xml.sax.saxutils',
+        'google.appengine.api.memcache')
+before = set(sys.modules)
+
+start = time.time()
+import mora.db
+import_db = time.time() - start
+
+start = time.time()
+from mora import rest
+import_rest = time.time() - start
+
+handlers = []
+for i in range(50):
+    model = type('Budget%d' % i, (mora.db.MoraModel,),
+                 {'name': mora.db.StringProperty()})
+    handlers.append(type('BudgetHandler%d' % i, (rest.RestHandler,),
+                         {'model': model}))
+start = time.time()
+rest.RestDispatcher.setup('/graph', handlers)
+setup = time.time() - start
+
+print json.dumps({
+    'times': {'import mora.db': import_db,
+              'import mora.rest': import_rest,
+              'RestDispatcher.setup (50 handlers)': setup},
+    'eagerly imported': [name for name in lazy
+                         if name in sys.modules and name not in before],
+    'scanned': [handler.__name__ for handler in handlers
+                if '_mora_verbs' in handler.__dict__]})
+"""
+
+
+class MoraImportBudgetTestCase(unittest.TestCase):
+
+    def testImportBudget(self):
+        report = run_script(IMPORT_BUDGET_SCRIPT)
+        sys.stderr.write('\nimport budget: %r\n' % report['times'])
+
+        self.assertEqual(report['eagerly imported'], [])
+        self.assertEqual(report['scanned'], [])